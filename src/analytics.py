@@ -0,0 +1,244 @@
+# -*- encoding: utf-8 -*-
+# analytics shared by stats.py, plot.py and mapot.py: the probe requests are loaded
+# into NumPy columns, and aggregated per mac (or per mac and day) with vectorized
+# group by instead of python loops over the rows
+
+import time
+import numpy as np
+
+# granularity of timezone offsets, see day_codes
+QUARTER = 15*60
+
+class MacTable:
+    '''address, vendor and U/L bit of the mac addresses, indexed by their code'''
+    def __init__(self, names, vendors, laa):
+        self.names = np.asarray(names, dtype=object)
+        self.vendors = np.asarray(vendors, dtype=object)
+        self.laa = np.asarray(laa, dtype=bool)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, vendor, laa):
+        '''add a virtual mac and returns its code'''
+        self.names = np.append(self.names, np.array([name], dtype=object))
+        self.vendors = np.append(self.vendors, np.array([vendor], dtype=object))
+        self.laa = np.append(self.laa, laa)
+        return len(self.names)-1
+
+    def startswith(self, prefix):
+        return np.array([n.startswith(prefix) for n in self.names.tolist()], dtype=bool)
+
+class Probes:
+    '''columns of probe requests. A row stands for count probe requests of the same
+    mac, with the same ssid and rssi, seen between first and last: a single probe
+    request has a count of 1, and rows already grouped by the db can be mixed
+    with single ones. mac and ssid are codes in the macs and ssids tables'''
+    def __init__(self, first, mac, ssid, rssi, macs, ssids, last=None, count=None):
+        self.first = np.asarray(first, dtype=np.float64)
+        self.last = self.first if last is None else np.asarray(last, dtype=np.float64)
+        self.mac = np.asarray(mac, dtype=np.int64)
+        self.ssid = np.asarray(ssid, dtype=np.int64)
+        self.rssi = np.asarray(rssi, dtype=np.int64)
+        if count is None:
+            count = np.ones(len(self.first), dtype=np.int64)
+        self.count = np.asarray(count, dtype=np.int64)
+        # code of the mac of each row before any merge
+        self.origin = self.mac
+        self.macs = macs
+        self.ssids = np.asarray(ssids, dtype=object)
+
+    def __len__(self):
+        return len(self.first)
+
+    def select(self, mask):
+        '''returns the rows selected by mask'''
+        p = Probes(self.first[mask], self.mac[mask], self.ssid[mask], self.rssi[mask], self.macs,
+            self.ssids, self.last[mask], self.count[mask])
+        p.origin = self.origin[mask]
+        return p
+
+    def merge(self, selected, name, vendor='UNKNOWN', laa=False):
+        '''merge the mac selected by a mask on the mac table into a virtual mac'''
+        if not selected[self.mac].any():
+            return
+        code = self.macs.add(name, vendor, laa)
+        remap = np.arange(len(self.macs))
+        remap[:-1][selected] = code
+        self.mac = remap[self.mac]
+
+    def merge_laa(self):
+        '''merge all LAA mac into a virtual mac called 'LAA' '''
+        self.merge(self.macs.laa.copy(), 'LAA', laa=True)
+
+    def merge_oui(self, prefixes):
+        '''merge the mac starting with each prefix into a virtual mac named after it'''
+        for prefix in prefixes:
+            self.merge(self.macs.startswith(prefix), prefix)
+
+def _starts(keys):
+    '''returns the index of the first element of each run of equal keys'''
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+def day_codes(dates, fmt='%Y-%m-%d'):
+    '''returns the day of each timestamp as a code, and the sorted list of days.
+    localtime() is only called once per quarter of an hour, as timezone offsets
+    are multiples of it'''
+    quarters, inv = np.unique(np.floor_divide(dates, QUARTER).astype(np.int64), return_inverse=True)
+    names = [time.strftime(fmt, time.localtime(q*QUARTER)) for q in quarters.tolist()]
+    days, codes = np.unique(np.array(names, dtype=object), return_inverse=True)
+    return codes[inv], days.tolist()
+
+class Aggregates:
+    '''aggregates of the rows of each group: count, first and last appearance, and
+    count, sum, min, max and median of the rssi values'''
+    def __init__(self, probes, keys, zero=False, ssids=False):
+        self.keys, groups = np.unique(keys, return_inverse=True)
+        n = len(self.keys)
+
+        order = np.argsort(groups, kind='stable')
+        starts = _starts(groups[order])
+        self.count = np.zeros(n, dtype=np.int64)
+        self.first = np.zeros(n)
+        self.last = np.zeros(n)
+        self.origin = np.zeros(n, dtype=np.int64)
+        if n > 0:
+            self.count = np.add.reduceat(probes.count[order], starts)
+            self.first = np.minimum.reduceat(probes.first[order], starts)
+            self.last = np.maximum.reduceat(probes.last[order], starts)
+            # mac of the first appearance, which gives the vendor of a virtual mac.
+            # Ties go to the lowest mac, not to depend on the order of the rows
+            at_first = probes.first == self.first[groups]
+            self.origin = np.full(n, np.iinfo(np.int64).max)
+            np.minimum.at(self.origin, groups[at_first], probes.origin[at_first])
+
+        # rssi values of 0 are left out unless zero is set
+        mask = slice(None) if zero else probes.rssi != 0
+        g, r, w = groups[mask], probes.rssi[mask], probes.count[mask]
+        self.rssi_count = np.zeros(n, dtype=np.int64)
+        self.rssi_sum = np.zeros(n, dtype=np.int64)
+        self.rssi_min = np.zeros(n, dtype=np.int64)
+        self.rssi_max = np.zeros(n, dtype=np.int64)
+        self.rssi_median = np.zeros(n, dtype=np.int64)
+        if len(g) > 0:
+            order = np.lexsort((r, g))
+            g, r, w = g[order], r[order], w[order]
+            starts = _starts(g)
+            ends = np.concatenate((starts[1:], [len(g)]))
+            ids = g[starts]
+            # the sorted values of a group are repeated by their weight: the value
+            # of rank k is the first one with a cumulated weight over k
+            cum = np.cumsum(w)
+            base = cum[starts] - w[starts]
+            count = cum[ends-1] - base
+            lo = np.searchsorted(cum, base + (count-1)//2, side='right')
+            hi = np.searchsorted(cum, base + count//2, side='right')
+            self.rssi_count[ids] = count
+            self.rssi_sum[ids] = np.add.reduceat(r*w, starts)
+            self.rssi_min[ids] = r[starts]
+            self.rssi_max[ids] = r[ends-1]
+            self.rssi_median[ids] = (r[lo] + r[hi])//2
+
+        self.ssids = group_ssids(probes, groups, n) if ssids else None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rssi_avg(self):
+        return self.rssi_sum//np.maximum(self.rssi_count, 1)
+
+class LiveAggregates:
+    '''aggregates of the rows of a group like Aggregates, updated in place by each new
+    row so that the cost of an update does not depend on the rows already seen. The
+    rssi values are counted by value to give the median'''
+    def __init__(self, zero=False):
+        self.zero = zero
+        self.count = 0
+        self.first = np.inf
+        self.last = -np.inf
+        self.origin = None
+        self.ssids = set()
+        self.rssi = {}
+
+    def add(self, origin, ssid, rssi, count, first, last):
+        self.count += count
+        # same tie break as Aggregates for the mac of the first appearance
+        if first < self.first or (first == self.first and origin < self.origin):
+            self.first = first
+            self.origin = origin
+        if last > self.last:
+            self.last = last
+        self.ssids.add(ssid)
+        if self.zero or rssi != 0:
+            self.rssi[rssi] = self.rssi.get(rssi, 0) + count
+
+    def rssi_stats(self):
+        '''returns the count, min, max, average and median of the rssi values'''
+        values = sorted(self.rssi.items())
+        count = sum(w for _, w in values)
+        if count == 0:
+            return 0, 0, 0, 0, 0
+        lo, hi = (count-1)//2, count//2
+        cum = 0
+        for r, w in values:
+            if cum <= lo < cum + w:
+                low = r
+            if cum <= hi < cum + w:
+                high = r
+                break
+            cum += w
+        total = sum(r*w for r, w in values)
+        return count, values[0][0], values[-1][0], total//count, (low + high)//2
+
+def group_ssids(probes, groups, n):
+    '''returns the sorted list of ssids (the empty one left out) of each of the n groups'''
+    pairs = np.unique(groups*len(probes.ssids) + probes.ssid)
+    g, s = np.divmod(pairs, len(probes.ssids))
+    ssids = [[] for _ in range(n)]
+    for i, name in zip(g.tolist(), probes.ssids[s].tolist()):
+        if name != '':
+            ssids[i].append(name)
+    for lst in ssids:
+        lst.sort()
+    return ssids
+
+def mac_stats(probes):
+    '''returns the aggregates of each mac with their ssids, rssi values of 0 left out'''
+    return Aggregates(probes, probes.mac, ssids=True)
+
+def day_stats(probes, fmt='%Y-%m-%d'):
+    '''returns the aggregates of each mac and day, keyed by mac code * number of
+    days + day code, and the list of days'''
+    codes, days = day_codes(probes.first, fmt)
+    return Aggregates(probes, probes.mac*len(days) + codes, zero=True), days
+
+def ssid_macs(probes):
+    '''returns the UAA mac that probed each ssid, as a list of (ssid, macs)'''
+    mask = ~probes.macs.laa[probes.mac]
+    pairs = np.unique(probes.ssid[mask]*len(probes.macs) + probes.mac[mask])
+    s, m = np.divmod(pairs, len(probes.macs))
+    starts = _starts(s)
+    macs = np.split(probes.macs.names[m], starts[1:]) if len(starts) else []
+    return [(ssid, ms.tolist()) for ssid, ms in zip(probes.ssids[s[starts]].tolist(), macs) if ssid != '']
+
+def timelines(probes):
+    '''returns the code of each mac, and the index of its rows sorted by time'''
+    order = np.lexsort((probes.first, probes.mac))
+    starts = _starts(probes.mac[order])
+    if len(starts) == 0:
+        return probes.mac[:0], []
+    return probes.mac[order[starts]], np.split(order, starts[1:])
+
+def hll_estimates(registers):
+    '''returns the HyperLogLog estimate of the number of distinct values of each row
+    of a 2d array of registers, see sketch.py'''
+    m = registers.shape[1]
+    alpha = 0.7213/(1 + 1.079/m)
+    e = alpha*m*m/np.ldexp(1.0, -registers.astype(np.int64)).sum(axis=1)
+    # linear counting for the small cardinalities, when some registers are still empty
+    zeros = (registers == 0).sum(axis=1)
+    small = (e <= 2.5*m) & (zeros > 0)
+    e[small] = m*np.log(m/zeros[small])
+    return np.rint(e).astype(np.int64)
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+# cold storage of the probe requests: the rows of each closed hour are moved out of
+# the probemon table into a compressed columnar block of the archive table
+
+import sqlite3
+import argparse
+import struct
+import time
+import sys
+import os.path
+import zlib
+import lzma
+from array import array
+
+from db import init_db, VersionError
+
+BLOCK_SPAN = 60*60 # one block per hour
+CODECS = {'zlib': (lambda b: zlib.compress(b, 9), zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress)}
+# first timestamp in microseconds, number of rows, number of distinct mac and ssid
+HEADER = struct.Struct('<qIII')
+BLOOM_BITS_PER_MAC = 10
+BLOOM_HASHES = 4
+MASK64 = (1 << 64) - 1
+
+def _to_bytes(arr):
+    # the columns are stored in little endian
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+def _from_bytes(typecode, data, offset, count):
+    arr = array(typecode)
+    end = offset + count*arr.itemsize
+    arr.frombytes(data[offset:end])
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr, end
+
+def _index_typecode(size):
+    return 'H' if size <= 1 << 16 else 'I'
+
+def _bloom_positions(mac_id, nbits):
+    # double hashing from two 64-bit multiplicative hashes of the mac id
+    h1 = (mac_id * 0x9e3779b97f4a7c15) & MASK64
+    h2 = ((mac_id ^ 0x5bd1e995) * 0xc2b2ae3d27d4eb4f) & MASK64 | 1
+    return [((h1 + i*h2) & MASK64) % nbits for i in range(BLOOM_HASHES)]
+
+def bloom_build(mac_ids):
+    nbits = max(64, len(mac_ids)*BLOOM_BITS_PER_MAC + 7) // 8 * 8
+    bloom = bytearray(nbits//8)
+    for m in mac_ids:
+        for p in _bloom_positions(m, nbits):
+            bloom[p >> 3] |= 1 << (p & 7)
+    return bytes(bloom)
+
+def bloom_contains(bloom, mac_id):
+    nbits = len(bloom)*8
+    return all(bloom[p >> 3] & (1 << (p & 7)) for p in _bloom_positions(mac_id, nbits))
+
+def encode_block(rows, codec):
+    '''encode rows of (date, mac, ssid, rssi) sorted by date into a compressed block'''
+    macs = sorted(set(r[1] for r in rows))
+    ssids = sorted(set(r[2] for r in rows))
+    mac_index = {m: i for i, m in enumerate(macs)}
+    ssid_index = {s: i for i, s in enumerate(ssids)}
+
+    # timestamps are delta-encoded in microseconds
+    stamps = [round(r[0]*1000000) for r in rows]
+    deltas = array('I', (b-a for a, b in zip(stamps, stamps[1:])))
+    payload = [HEADER.pack(stamps[0], len(rows), len(macs), len(ssids)),
+        _to_bytes(array('I', macs)), _to_bytes(array('I', ssids)), _to_bytes(deltas),
+        _to_bytes(array(_index_typecode(len(macs)), (mac_index[r[1]] for r in rows))),
+        _to_bytes(array(_index_typecode(len(ssids)), (ssid_index[r[2]] for r in rows))),
+        array('b', (r[3] for r in rows)).tobytes()]
+    compress, _ = CODECS[codec]
+    return compress(b''.join(payload)), bloom_build(macs)
+
+def decode_block(data, codec):
+    '''decode a block into the columns (dates, macs, ssids, rssi)'''
+    _, decompress = CODECS[codec]
+    data = decompress(data)
+    first, count, nmacs, nssids = HEADER.unpack_from(data)
+    offset = HEADER.size
+    macs, offset = _from_bytes('I', data, offset, nmacs)
+    ssids, offset = _from_bytes('I', data, offset, nssids)
+    deltas, offset = _from_bytes('I', data, offset, count-1)
+    mac_idx, offset = _from_bytes(_index_typecode(nmacs), data, offset, count)
+    ssid_idx, offset = _from_bytes(_index_typecode(nssids), data, offset, count)
+    rssi, offset = _from_bytes('b', data, offset, count)
+
+    dates = [first/1000000]
+    ts = first
+    for d in deltas:
+        ts += d
+        dates.append(ts/1000000)
+    return dates, [macs[i] for i in mac_idx], [ssids[i] for i in ssid_idx], rssi
+
+def has_blocks(c, after=None, before=None):
+    '''returns True if some archived blocks overlap the range ]after, before['''
+    sql = 'select 1 from archive where (? is null or end > ?) and (? is null or start < ?) limit 1'
+    c.execute(sql, (after, after, before, before))
+    return c.fetchone() is not None
+
+def block_ranges(c, after=None, before=None):
+    '''returns the start, end and number of rows of the archived blocks overlapping
+    the range ]after, before[, by start'''
+    sql = 'select start, end, count from archive where (? is null or end > ?) and (? is null or start < ?) order by start'
+    c.execute(sql, (after, after, before, before))
+    return c.fetchall()
+
+def iter_blocks(c, after=None, before=None, mac_ids=None):
+    '''yield the columns (dates, macs, ssids, rssi) of the archived blocks overlapping
+    the range ]after, before[, that may contain one of the set of mac_ids. The
+    rows of the blocks are not filtered'''
+    sql = 'select id, start, end, bloom from archive where 1'
+    sql_args = []
+    if after is not None:
+        sql += ' and end > ?'
+        sql_args.append(after)
+    if before is not None:
+        sql += ' and start < ?'
+        sql_args.append(before)
+    sql += ' order by start'
+    cur = c.connection.cursor()
+    cur.execute(sql, sql_args)
+    blocks = cur.fetchall()
+    for block_id, start, end, bloom in blocks:
+        if mac_ids is not None and not any(bloom_contains(bloom, m) for m in mac_ids):
+            continue
+        cur.execute('select codec, data from archive where id=?', (block_id,))
+        codec, data = cur.fetchone()
+        yield decode_block(data, codec)
+
+def iter_rows(c, after=None, before=None, mac_ids=None):
+    '''yield the archived rows (date, mac, ssid, rssi) with after < date < before,
+    decompressing only the blocks overlapping that range, that may contain one of
+    the set of mac_ids'''
+    for columns in iter_blocks(c, after, before, mac_ids):
+        for row in zip(*columns):
+            if after is not None and row[0] <= after:
+                continue
+            if before is not None and row[0] >= before:
+                continue
+            if mac_ids is not None and row[1] not in mac_ids:
+                continue
+            yield row
+
+def archive_db(conn, c, before, codec, verbose=False):
+    '''move the rows older than before into blocks of BLOCK_SPAN seconds'''
+    # only archive closed blocks
+    before = before - before % BLOCK_SPAN
+    total = 0
+    while True:
+        c.execute('select min(date) from probemon')
+        first = c.fetchone()[0]
+        if first is None or first >= before:
+            break
+        start = first - first % BLOCK_SPAN
+        end = start + BLOCK_SPAN
+        c.execute('select date, mac, ssid, rssi from probemon where date >= ? and date < ? order by date',
+            (start, end))
+        rows = c.fetchall()
+        data, bloom = encode_block(rows, codec)
+        c.execute('insert into archive (start, end, count, codec, bloom, data) values (?, ?, ?, ?, ?, ?)',
+            (start, end, len(rows), codec, bloom, data))
+        c.execute('delete from probemon where date >= ? and date < ?', (start, end))
+        # one transaction per block not to lock the db for too long
+        conn.commit()
+        total += len(rows)
+        if verbose:
+            t = time.strftime('%Y-%m-%dT%H:%M', time.localtime(start))
+            print(f'{t}: {len(rows)} rows in {len(data)} bytes')
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description='Move old probe requests into compressed archive blocks')
+    parser.add_argument('-b', '--before', required=True, help='archive probe requests before this timestamp')
+    parser.add_argument('-c', '--codec', choices=list(CODECS.keys()), default='zlib', help='compression to use')
+    parser.add_argument('-d', '--db', default='probemon.db', help='file name of the db')
+    parser.add_argument('--vacuum', action='store_true', default=False, help='vacuum the db to reclaim the free space')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='be verbose')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f'Error: file not found {args.db}', file=sys.stderr)
+        sys.exit(-1)
+    try:
+        before = time.mktime(time.strptime(args.before, '%Y-%m-%dT%H:%M'))
+    except ValueError:
+        try:
+            before = time.mktime(time.strptime(args.before, '%Y-%m-%d'))
+        except ValueError:
+            print("Error: can't parse date timestamp", file=sys.stderr)
+            sys.exit(-1)
+    # never archive the current hour
+    before = min(before, time.time())
+
+    conn = sqlite3.connect(args.db)
+    c = conn.cursor()
+    try:
+        init_db(conn, c)
+    except VersionError as v:
+        print(f'Error: {v}', file=sys.stderr)
+        sys.exit(-1)
+    start = time.monotonic()
+    total = archive_db(conn, c, before, args.codec, args.verbose)
+    print(f':: Archived {total} rows in {time.monotonic()-start:.2f}s')
+    if args.vacuum:
+        c.execute('vacuum;')
+    conn.close()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
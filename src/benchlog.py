@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+# measure the throughput of the writers of probemon.py on synthetic probe requests:
+# insert_into_db with the sqlite backend, then with the log backend, followed by
+# the compactor loading the segments of the log into the db
+
+import sqlite3
+import argparse
+import random
+import tempfile
+import time
+import sys
+import os.path
+
+import probemon
+import probelog
+import presence
+import sketch
+from db import init_db
+
+def synthetic(count, macs, seed):
+    '''returns count probe requests of macs mac addresses, as the fields of insert_into_db'''
+    rng = random.Random(seed)
+    addresses = [':'.join('%02x' % rng.randrange(256) for _ in range(6)) for _ in range(macs)]
+    ssids = ['', 'home', 'office', 'cafe']
+    start = time.time() - count*0.01
+    return [[start + i*0.01, rng.choice(addresses), 'UNKNOWN', rng.choice(ssids), rng.randint(-90, -20)]
+        for i in range(count)]
+
+def write(path, rows, commit, backend):
+    '''insert the rows into a new db like process_queue does, with a commit every
+    commit rows. Returns the time spent writing, and loading the log'''
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    init_db(conn, c)
+    probemon.cache = probemon.MyCache(128)
+    probemon.sketches = sketch.Sketches()
+    probemon.presence_index = presence.Presence()
+    probemon.probe_log = probelog.ProbeLog(f'{path}.log', 1) if backend == 'log' else None
+    start = time.perf_counter()
+    for i in range(0, len(rows), commit):
+        for fields in rows[i:i+commit]:
+            probemon.insert_into_db(list(fields), conn, c)
+        probemon.sketches.flush(c)
+        probemon.presence_index.flush(c)
+        conn.commit()
+    elapsed = time.perf_counter() - start
+    compacted = 0
+    if probemon.probe_log is not None:
+        probemon.probe_log.close()
+        start = time.perf_counter()
+        probelog.compact(conn, c, probelog.list_segments(f'{path}.log'))
+        compacted = time.perf_counter() - start
+    c.execute('select count(*) from probemon')
+    total = c.fetchone()[0]
+    conn.close()
+    if total != len(rows):
+        print(f'Error: {total} rows in the db instead of {len(rows)}', file=sys.stderr)
+        sys.exit(-1)
+    return elapsed, compacted
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the throughput of the sqlite and log writers of probemon.py')
+    parser.add_argument('-c', '--commit', type=int, default=1000, help='number of probe requests per commit')
+    parser.add_argument('-m', '--macs', type=int, default=100, help='number of mac addresses')
+    parser.add_argument('-n', '--count', type=int, default=300000, help='number of probe requests')
+    args = parser.parse_args()
+
+    if args.commit < 1 or args.macs < 1 or args.count < 1:
+        print('Error: --commit, --macs and --count must be at least 1', file=sys.stderr)
+        sys.exit(-1)
+
+    rows = synthetic(args.count, args.macs, 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in ('sqlite', 'log'):
+            elapsed, compacted = write(os.path.join(tmp, f'{backend}.db'), rows, args.commit, backend)
+            line = f'{backend:6s} writer: {args.count/elapsed:9.0f} rows/s'
+            if compacted > 0:
+                line += f', compactor: {args.count/compacted:9.0f} rows/s'
+            print(line)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+# measure the time to render the timeline of plot.py into an image, on synthetic
+# probe requests: plot_data is timed with the non-interactive Agg backend, from the
+# binning of the probe requests to the image written
+
+import argparse
+import resource
+import tempfile
+import time
+import sys
+import os.path
+import numpy as np
+
+import plot
+
+START = 1791763200.0
+DAY = 24*60*60
+
+def synthetic(count, total, gaps, seed):
+    '''returns count mac addresses and total probe requests over a day, as the dates
+    and rows of plot_data: the number of probe requests of a mac follows a Zipf law,
+    and a hole of 2 hours (or 10 minutes every hour with gaps) has none'''
+    rng = np.random.default_rng(seed)
+    weights = rng.zipf(1.5, count).astype(np.float64)
+    counts = rng.multinomial(total - count, weights/weights.sum()) + 1
+    macs = ['%02x:%02x:%02x:%02x:%02x:%02x' % tuple(rng.integers(0, 256, 6)) for _ in range(count)]
+    if gaps:
+        offsets = rng.uniform(0, 24*50*60, total)
+        offsets = offsets//(50*60)*3600 + offsets%(50*60)
+    else:
+        offsets = rng.uniform(0, 22*3600, total)
+        offsets += np.where(offsets >= 10*3600, 2*3600, 0)
+    rows = np.repeat(np.arange(count), counts)
+    # the mac are sorted from the most seen, like select_data does
+    order = np.argsort(-counts, kind='stable')
+    rank = np.empty(count, dtype=np.int64)
+    rank[order] = np.arange(count)
+    return [macs[i] for i in order], START + offsets, rank[rows]
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the render time of the timeline of plot.py on synthetic data')
+    parser.add_argument('-g', '--gaps', action='store_true', default=False, help='leave a gap of 10 minutes every hour instead of a hole of 2 hours')
+    parser.add_argument('-i', '--image', help='file name of the image, a temporary one by default')
+    parser.add_argument('-m', '--macs', type=int, default=5000, help='number of mac addresses')
+    parser.add_argument('-n', '--runs', type=int, default=3, help='number of runs, the fastest is kept')
+    parser.add_argument('-p', '--points', type=int, default=1000000, help='number of probe requests')
+    args = parser.parse_args()
+
+    if args.runs < 1 or args.macs < 1 or args.points < args.macs:
+        print('Error: --runs and --macs must be at least 1, and --points at least --macs', file=sys.stderr)
+        sys.exit(-1)
+
+    macs, dates, rows = synthetic(args.macs, args.points, args.gaps, 1)
+    plot.import_matplotlib('Agg')
+    with tempfile.TemporaryDirectory() as tmp:
+        options = argparse.Namespace(db='synthetic', image=args.image or os.path.join(tmp, 'plot.png'),
+            knownmac=[], label=False, legend=False, span='d', span_time=DAY, start_time=START,
+            end_time=START + DAY, title=None)
+        times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            plot.plot_data(macs, dates, rows, options)
+            times.append(time.perf_counter() - start)
+            plot.plt.close('all')
+    # ru_maxrss is in kilobytes on linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss//1024
+    print(f'{len(macs)} mac, {len(dates)} probe requests: rendered in {min(times):.2f}s, max RSS {rss}MB')
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
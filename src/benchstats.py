@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+# measure the time of the stats of stats.py computed by group by queries (the default
+# view, with -p, --day-by-day and --list-mac-ssids) on a synthetic db, with the
+# scripts of one or more source directories: the db is created with the schema of
+# the first version, then upgraded by the db.py of each directory
+
+import sqlite3
+import argparse
+import bisect
+import itertools
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import sys
+import os.path
+
+# name and arguments of stats.py of each mode
+MODES = [('default', []), ('-p', ['-p']), ('--day-by-day -m 3', ['--day-by-day', '-m', '3']),
+    ('--list-mac-ssids', ['--list-mac-ssids'])]
+MACS = 20000
+SSIDS = 2000
+VENDORS = 50
+INTERVAL = 0.3 # seconds between two probe requests
+
+def create_db(path, count, uniform, seed):
+    '''create a db of count probe requests with the schema of the first version. The
+    activity of the mac is skewed, each mac probes for 1 to 4 ssids (or the broadcast
+    one) with a rssi around its own mean. With uniform, the mac, ssid and rssi of
+    each row are drawn uniformly'''
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute('create table vendor(id integer not null primary key, name text)')
+    c.execute('''create table mac(id integer not null primary key, address text, vendor integer,
+        foreign key(vendor) references vendor(id))''')
+    c.execute('create table ssid(id integer not null primary key, name text)')
+    c.execute('''create table probemon(date float, mac integer, ssid integer, rssi integer,
+        foreign key(mac) references mac(id), foreign key(ssid) references ssid(id))''')
+    c.execute('create index idx_probemon_date on probemon(date)')
+    c.executemany('insert into vendor (name) values (?)', [(f'Vendor {i}',) for i in range(VENDORS)])
+    c.executemany('insert into mac (address, vendor) values (?, ?)', [(':'.join('%02x' % rng.randrange(256) for _ in range(6)),
+        rng.randint(1, VENDORS)) for _ in range(MACS)])
+    c.executemany('insert into ssid (name) values (?)', [('',)] + [(f'net{i}',) for i in range(SSIDS)])
+    profiles = [(rng.sample(range(2, SSIDS + 2), rng.randint(1, 4)), rng.randint(-85, -35)) for _ in range(MACS)]
+    weights = list(itertools.accumulate(1/(i + 1)**0.8 for i in range(MACS)))
+    start = time.time() - count*INTERVAL
+    def rows():
+        for i in range(count):
+            if uniform:
+                yield (start + i*INTERVAL, rng.randint(1, MACS), rng.randint(1, SSIDS + 1), rng.randint(-100, -1))
+                continue
+            mac = bisect.bisect(weights, rng.random()*weights[-1])
+            ssids, mean = profiles[mac]
+            ssid = rng.choice(ssids) if rng.random() < 0.8 else 1
+            yield (start + i*INTERVAL, mac + 1, ssid, max(-100, min(-1, int(rng.gauss(mean, 6)))))
+    c.executemany('insert into probemon values (?, ?, ?, ?)', rows())
+    conn.commit()
+    conn.close()
+
+def run(src, db, args):
+    '''returns the time to run the stats.py of src on db with args'''
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(src, 'stats.py'), '--db', db] + args, cwd=src,
+        stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the time of the group by modes of stats.py on a synthetic db')
+    parser.add_argument('-d', '--db', help='file name of the synthetic db, created if it does not exist (temporary by default)')
+    parser.add_argument('-n', '--rows', type=int, default=10000000, help='number of probe requests of the db')
+    parser.add_argument('-r', '--runs', type=int, default=1, help='number of runs of each mode, the fastest is kept')
+    parser.add_argument('-u', '--uniform', action='store_true', default=False, help='draw the mac, ssid and rssi of each row uniformly')
+    parser.add_argument('src', nargs='*', help='directories of the scripts to compare (default to the one of this script)')
+    args = parser.parse_args()
+
+    if args.rows < 1 or args.runs < 1:
+        print('Error: --rows and --runs must be at least 1', file=sys.stderr)
+        sys.exit(-1)
+    sources = [os.path.abspath(s) for s in args.src] or [os.path.dirname(os.path.abspath(__file__))]
+    for src in sources:
+        if not os.path.exists(os.path.join(src, 'stats.py')):
+            print(f'Error: stats.py not found in {src}', file=sys.stderr)
+            sys.exit(-1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = args.db or os.path.join(tmp, 'bench.db')
+        if not os.path.exists(db):
+            print(f':: Creating a db of {args.rows} probe requests')
+            create_db(db, args.rows, args.uniform, 1)
+        times = []
+        for i, src in enumerate(sources):
+            # each version reads its own copy of the db, with its schema
+            copy = os.path.join(tmp, f'{i}.db')
+            shutil.copyfile(db, copy)
+            if os.path.exists(os.path.join(src, 'db.py')):
+                print(f':: Upgrading the db with {src}')
+                subprocess.run([sys.executable, os.path.join(src, 'db.py'), '-d', copy], cwd=src,
+                    stdout=subprocess.DEVNULL, check=True)
+            times.append([min(run(src, copy, mode) for _ in range(args.runs)) for _, mode in MODES])
+            os.remove(copy)
+
+    for i, src in enumerate(sources):
+        print(f'[{i}] {src}')
+    header = '%-20s' % 'MODE' + ''.join('%9s' % f'[{i}]' for i in range(len(sources)))
+    if len(sources) > 1:
+        header += '%9s' % 'SPEEDUP'
+    print(header)
+    for m, (name, _) in enumerate(MODES):
+        line = '%-20s' % name + ''.join('%8.1fs' % t[m] for t in times)
+        if len(sources) > 1:
+            line += '%8.1fx' % (times[0][m]/times[-1][m])
+        print(line)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
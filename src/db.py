@@ -0,0 +1,471 @@
+# -*- encoding: utf-8 -*-
+# helpers shared by the scripts to access the probemon db
+
+import sqlite3
+import argparse
+import base64
+import binascii
+import time
+import sys
+import os.path
+
+# mask of the U/L bit in the 48-bit integer value of a mac address
+LAA_MASK = 0b00000010 << 40
+
+def mac_to_int(mac):
+    '''convert a mac address string to its 48-bit integer value, None if invalid'''
+    try:
+        value = int(mac.replace(':', ''), 16)
+    except (AttributeError, ValueError):
+        return None
+    if len(mac) != 17 or value >> 48:
+        return None
+    return value
+
+def mac_fields(mac):
+    '''returns the (value, oui, laa) columns of the mac table for mac'''
+    value = mac_to_int(mac)
+    if value is None:
+        return None, None, 0
+    return value, value >> 24, int(value & LAA_MASK != 0)
+
+def mac_prefix_range(prefix):
+    '''convert a partial mac address to the [low, high) range of its integer values
+    returns None if it is not a plain hexadecimal prefix'''
+    digits = prefix.replace(':', '')
+    if len(digits) == 0 or len(digits) > 12:
+        return None
+    try:
+        value = int(digits, 16)
+    except ValueError:
+        return None
+    shift = 4*(12-len(digits))
+    return value << shift, (value+1) << shift
+
+def ssid_text(name):
+    '''returns the text of a ssid name: the names stored in base64 because they are
+    not valid utf-8 are decoded as latin-1, the most common other encoding'''
+    if not name.startswith('b64_'):
+        return name
+    try:
+        return base64.b64decode(name[4:], validate=True).decode('latin-1')
+    except binascii.Error:
+        return name
+
+class VersionError(Exception):
+    pass
+
+# version of the schema of the db, stored in pragma user_version
+SCHEMA_VERSION = 12
+# number of rows updated per transaction when backfilling a column
+MIGRATION_BATCH = 10000
+# span of the date ranges of the probe requests a backfill commits at once
+BACKFILL_SPAN = 24*60*60
+# number of rows of each index sampled by analyze, to refresh the statistics of the
+# query planner quickly on big db
+ANALYSIS_LIMIT = 1000
+# number of tiles of the timeline stored per transaction when building them all, and
+# per hourly pass of probemon.py
+TILE_BATCH = 16
+# add count probe requests of a mac for a ssid, seen between first and last
+MAC_SSID_UPSERT = '''insert into mac_ssid (mac, ssid, first, last, count) values (?, ?, ?, ?, ?)
+    on conflict(mac, ssid) do update set first=min(first, excluded.first),
+    last=max(last, excluded.last), count=count+excluded.count'''
+# index the text of a new ssid, see ssid_text; the rowid is the id of the ssid
+SSID_FTS_INSERT = 'insert into ssid_fts (rowid, name) values (?, ?)'
+
+def get_vendor_id(c, name):
+    '''returns the id of a vendor, inserted if it is a new one'''
+    c.execute('select id from vendor where name=?', (name,))
+    row = c.fetchone()
+    if row is None:
+        c.execute('insert into vendor (name) values(?)', (name,))
+        c.execute('select id from vendor where name=?', (name,))
+        row = c.fetchone()
+    return row[0]
+
+def get_mac_id(c, address, vendor):
+    '''returns the id of a mac address, inserted with the vendor id if it is a new one'''
+    c.execute('select id from mac where address=?', (address,))
+    row = c.fetchone()
+    if row is None:
+        c.execute('insert into mac (address,vendor,value,oui,laa) values(?, ?, ?, ?, ?)',
+            (address, vendor) + mac_fields(address))
+        c.execute('select id from mac where address=?', (address,))
+        row = c.fetchone()
+    return row[0]
+
+def get_ssid_id(c, name):
+    '''returns the id of a ssid, inserted and indexed if it is a new one'''
+    c.execute('select id from ssid where name=?', (name,))
+    row = c.fetchone()
+    if row is None:
+        c.execute('insert into ssid (name) values(?)', (name,))
+        c.execute('select id from ssid where name=?', (name,))
+        row = c.fetchone()
+        index_ssid(c, row[0], name)
+    return row[0]
+
+def has_ssid_fts(c):
+    '''returns True if the db has the trigram index of the ssids, that needs sqlite 3.34'''
+    c.execute("select name from sqlite_master where name='ssid_fts'")
+    return c.fetchone() is not None
+
+def index_ssid(c, ssid_id, name):
+    '''index the text of a new ssid, if the db has the trigram index'''
+    if has_ssid_fts(c):
+        c.execute(SSID_FTS_INSERT, (ssid_id, ssid_text(name)))
+
+def migration_1(conn, c, batch):
+    # create tables if they do not exist: that's the schema of unversioned db
+    sql = 'create table if not exists vendor(id integer not null primary key, name text);'
+    c.execute(sql)
+    sql = '''create table if not exists mac(id integer not null primary key, address text,
+        vendor integer,
+        foreign key(vendor) references vendor(id)
+        );'''
+    c.execute(sql)
+    sql = 'create table if not exists ssid(id integer not null primary key, name text);'
+    c.execute(sql)
+    sql = '''create table if not exists probemon(date float,
+        mac integer,
+        ssid integer,
+        rssi integer,
+        foreign key(mac) references mac(id),
+        foreign key(ssid) references ssid(id)
+        );'''
+    c.execute(sql)
+    sql = 'create index if not exists idx_probemon_date on probemon(date);'
+    c.execute(sql)
+
+def migration_2(conn, c, batch):
+    # read indexes: the covering one on date answers time range queries without
+    # touching the table, the one on (mac, date) answers per-mac queries
+    sql = 'drop index if exists idx_probemon_date;' # superseded by the covering index
+    c.execute(sql)
+    sql = 'create index if not exists idx_probemon_date_cover on probemon(date, mac, ssid, rssi);'
+    c.execute(sql)
+    sql = 'create index if not exists idx_probemon_mac_date on probemon(mac, date);'
+    c.execute(sql)
+    # indexes for look up on the dimension tables
+    sql = 'create index if not exists idx_mac_address on mac(address);'
+    c.execute(sql)
+    sql = 'create index if not exists idx_ssid_name on ssid(name);'
+    c.execute(sql)
+    sql = 'create index if not exists idx_vendor_name on vendor(name);'
+    c.execute(sql)
+
+def migration_3(conn, c, batch):
+    # integer value, OUI and U/L bit of mac addresses
+    columns = [row[1] for row in c.execute('pragma table_info(mac)')]
+    if 'value' not in columns:
+        c.execute('alter table mac add column value integer;')
+        c.execute('alter table mac add column oui integer;')
+        c.execute('alter table mac add column laa integer not null default 0;')
+        conn.commit()
+    backfill(conn, c, batch, 'select id, address from mac where id > ? order by id limit ?',
+        'update mac set value=?, oui=?, laa=? where id=?',
+        lambda row: mac_fields(row[1]) + (row[0],))
+    sql = 'create index if not exists idx_mac_value on mac(value);'
+    c.execute(sql)
+    sql = 'create index if not exists idx_mac_oui on mac(oui);'
+    c.execute(sql)
+    sql = 'create index if not exists idx_mac_laa on mac(laa);'
+    c.execute(sql)
+
+def migration_4(conn, c, batch):
+    # compressed blocks of archived probe requests, see archive.py
+    sql = '''create table if not exists archive(id integer not null primary key,
+        start float,
+        end float,
+        count integer,
+        codec text,
+        bloom blob,
+        data blob
+        );'''
+    c.execute(sql)
+    sql = 'create index if not exists idx_archive_start on archive(start, end);'
+    c.execute(sql)
+
+def migration_5(conn, c, batch):
+    # segments of the probe log being loaded into the db, see probelog.py
+    sql = 'create table if not exists segment(name text not null primary key);'
+    c.execute(sql)
+
+def migration_6(conn, c, batch):
+    # covering index in the order of the group by queries of stats.py: the stats of
+    # each mac are read from it without sorting the table
+    sql = 'create index if not exists idx_probemon_mac_cover on probemon(mac, ssid, rssi, date);'
+    c.execute(sql)
+
+def migration_7(conn, c, batch):
+    # co-occurrence of each mac and ssid over the whole history (archive included),
+    # maintained at ingest with MAC_SSID_UPSERT
+    sql = '''create table if not exists mac_ssid(mac integer not null,
+        ssid integer not null,
+        first float,
+        last float,
+        count integer,
+        primary key(mac, ssid),
+        foreign key(mac) references mac(id),
+        foreign key(ssid) references ssid(id)
+        ) without rowid;'''
+    c.execute(sql)
+    sql = 'create index if not exists idx_mac_ssid_ssid on mac_ssid(ssid, mac);'
+    c.execute(sql)
+    # the rows of the probemon table by range of mac ids, grouped in the order of
+    # idx_probemon_mac_cover, then the archived ones by day
+    c.execute('select min(id), max(id) from mac')
+    mac_ids = c.fetchone()
+    c.execute('select min(start), max(end) from archive')
+    days = c.fetchone()
+    steps = [mac_ids + (batch,), days + (BACKFILL_SPAN,)]
+    for step, start, end in backfill_ranges(conn, c, 7, 'mac_ssid', steps):
+        if step == 0:
+            c.execute('''select mac, ssid, min(date), max(date), count(*) from probemon
+                where mac >= ? and mac < ? group by mac, ssid''', (start, end))
+            c.executemany(MAC_SSID_UPSERT, c.fetchall())
+            continue
+        pairs = {}
+        for dates, macs, ssids in archived_rows(c, start, end):
+            for date, mac, ssid in zip(dates, macs, ssids):
+                try:
+                    p = pairs[(mac, ssid)]
+                    p[1] = date
+                    p[2] += 1
+                except KeyError:
+                    pairs[(mac, ssid)] = [date, date, 1]
+        c.executemany(MAC_SSID_UPSERT, [k + tuple(v) for k, v in pairs.items()])
+
+def migration_8(conn, c, batch):
+    # trigram full-text index of the text of the ssids, for substring searches
+    try:
+        sql = "create virtual table if not exists ssid_fts using fts5(name, tokenize='trigram');"
+        c.execute(sql)
+    except sqlite3.OperationalError:
+        # no trigram tokenizer before sqlite 3.34: search_ssids scans the ssid table
+        return
+    # start over if a previous backfill was interrupted
+    c.execute('delete from ssid_fts;')
+    conn.commit()
+    backfill(conn, c, batch, 'select id, name from ssid where id > ? order by id limit ?',
+        SSID_FTS_INSERT, lambda row: (row[0], ssid_text(row[1])))
+
+def migration_9(conn, c, batch):
+    # HyperLogLog sketches of the distinct mac of each hour and day, maintained at
+    # ingest, see sketch.py
+    sql = '''create table if not exists sketch(level text not null,
+        start float not null,
+        end float,
+        registers blob,
+        primary key(level, start)
+        ) without rowid;'''
+    c.execute(sql)
+    import sketch
+    c.execute('select id, address from mac')
+    hashes = {mac: sketch.mac_hash(address) for mac, address in c.fetchall()}
+    sketches = sketch.Sketches()
+    for _, start, end in backfill_ranges(conn, c, 9, 'sketch', [data_range(c) + (BACKFILL_SPAN,)]):
+        # the rows of a mac in a quarter of an hour all fall into the same buckets
+        # the quarter first, for the distinct keys to come in order from the date index
+        c.execute(f'''select distinct cast(date/{sketch.QUARTER} as integer), mac from probemon
+            where date >= ? and date < ?''', (start, end))
+        for quarter, mac in c.fetchall():
+            sketches.add_hash(quarter*sketch.QUARTER, hashes[mac])
+        for dates, macs, ssids in archived_rows(c, start, end):
+            for mac, quarter in set(zip(macs, (int(d//sketch.QUARTER) for d in dates))):
+                sketches.add_hash(quarter*sketch.QUARTER, hashes[mac])
+        sketches.flush(c)
+
+def migration_10(conn, c, batch):
+    # capture files imported into the db, see ingest.py
+    sql = '''create table if not exists capture(path text not null primary key,
+        size integer,
+        mtime float,
+        count integer
+        );'''
+    c.execute(sql)
+
+def migration_11(conn, c, batch):
+    # presence index of the minutes of each day in which a mac was seen, maintained
+    # at ingest, see presence.py
+    sql = '''create table if not exists presence(day integer not null,
+        mac integer not null,
+        minutes blob,
+        primary key(day, mac)
+        ) without rowid;'''
+    c.execute(sql)
+    sql = 'create index if not exists idx_presence_mac on presence(mac);'
+    c.execute(sql)
+    import presence
+    import numpy as np
+    index = presence.Presence()
+    # the ranges are days, the rows are read from idx_probemon_date_cover
+    for _, start, end in backfill_ranges(conn, c, 11, 'presence', [data_range(c) + (presence.DAY,)]):
+        c.execute('select date, mac from probemon where date >= ? and date < ?', (start, end))
+        rows = np.array(c.fetchall(), dtype=np.float64).reshape(-1, 2)
+        index.add_many(rows[:, 0], rows[:, 1].astype(np.int64))
+        for dates, macs, ssids in archived_rows(c, start, end):
+            index.add_many(np.array(dates), np.array(macs, dtype=np.int64))
+        index.flush(c)
+
+def migration_12(conn, c, batch):
+    # tiles of the timeline at several levels, built as they close, see tiles.py
+    sql = '''create table if not exists tile(level text not null,
+        tile integer not null,
+        hash text,
+        cells blob,
+        primary key(level, tile)
+        ) without rowid;'''
+    c.execute(sql)
+    import tiles # not at the top, as tiles imports archive that imports this module
+    # the tiles already stored are skipped: an interrupted migration resumes
+    while tiles.build(c, limit=TILE_BATCH) > 0:
+        conn.commit()
+
+MIGRATIONS = [migration_1, migration_2, migration_3, migration_4, migration_5, migration_6,
+    migration_7, migration_8, migration_9, migration_10, migration_11, migration_12]
+
+def backfill(conn, c, batch, select, update, convert):
+    '''update rows by batch of rows, committing after each one not to hold the
+    write lock for too long. select must take the last id seen and the
+    size of the batch as arguments and return the id as first column'''
+    last_id = 0
+    while True:
+        c.execute(select, (last_id, batch))
+        rows = c.fetchall()
+        if len(rows) == 0:
+            break
+        c.executemany(update, [convert(row) for row in rows])
+        conn.commit()
+        last_id = rows[-1][0]
+
+def data_range(c):
+    '''returns the first and last timestamp of the probe requests of the db, archived
+    ones included'''
+    # one query each, for sqlite to read them from the index
+    c.execute('select min(date) from probemon')
+    first = c.fetchone()[0]
+    c.execute('select max(date) from probemon')
+    last = c.fetchone()[0]
+    c.execute('select min(start), max(end) from archive')
+    start, end = c.fetchone()
+    if start is not None:
+        first = start if first is None else min(first, start)
+        last = end if last is None else max(last, end)
+    return first, last
+
+def backfill_ranges(conn, c, version, table, steps):
+    '''yield the step and the [start, end[ range of each batch of the steps of the
+    backfill of a table, a list of (first, last, span) to cover [first, last] by
+    ranges of span. The end of each range is committed with the rows added to the
+    table after it: an interrupted migration resumes from there, and only starts
+    over, emptying the table, if it never committed a range'''
+    c.execute('''create table if not exists backfill(version integer not null primary key,
+        step integer,
+        position float
+        );''')
+    c.execute('select step, position from backfill where version=?', (version,))
+    row = c.fetchone()
+    if row is None:
+        c.execute(f'delete from {table};')
+        row = (0, None)
+    for step, (first, last, span) in enumerate(steps):
+        if step < row[0] or first is None:
+            continue
+        first = row[1] if step == row[0] and row[1] is not None else first - first % span
+        for start in range(int(first), int(last)+1, span):
+            yield step, start, start+span
+            c.execute('insert or replace into backfill (version, step, position) values (?, ?, ?)',
+                (version, step, start+span))
+            conn.commit()
+    c.execute('delete from backfill where version=?', (version,))
+    conn.commit()
+
+def archived_rows(c, start, end):
+    '''yield the columns (dates, macs, ssids) of the archived probe requests in
+    [start, end[, by block'''
+    import archive # not at the top, as archive imports this module
+    for dates, macs, ssids, rssi in archive.iter_blocks(c, start, end):
+        rows = [row for row in zip(dates, macs, ssids) if start <= row[0] < end]
+        if len(rows) > 0:
+            yield tuple(zip(*rows))
+
+def get_version(c):
+    c.execute('pragma user_version;')
+    return c.fetchone()[0]
+
+def check_version(c):
+    '''check that the db can be read by this version of the scripts'''
+    version = get_version(c)
+    if version > SCHEMA_VERSION:
+        raise VersionError(f'db schema version {version} is newer than the supported version {SCHEMA_VERSION}')
+    if version < SCHEMA_VERSION:
+        raise VersionError(f'db schema version {version} is outdated, upgrade it with db.py')
+
+def migrate(conn, c, batch=MIGRATION_BATCH, verbose=False):
+    '''apply in order the migrations not yet applied to the db'''
+    version = get_version(c)
+    if version > SCHEMA_VERSION:
+        raise VersionError(f'db schema version {version} is newer than the supported version {SCHEMA_VERSION}')
+    for n in range(version, SCHEMA_VERSION):
+        if verbose:
+            print(f':: Applying migration {n+1}')
+        start = time.monotonic()
+        MIGRATIONS[n](conn, c, batch)
+        # user_version can't be bound as a parameter
+        c.execute(f'pragma user_version = {n+1};')
+        conn.commit()
+        if verbose:
+            print(f'   done in {time.monotonic()-start:.2f}s')
+
+def init_db(conn, c):
+    migrate(conn, c)
+    # gather statistics for the query planner if it has never been done
+    c.execute("select name from sqlite_master where name='sqlite_stat1'")
+    if c.fetchone() is None:
+        c.execute(f'pragma analysis_limit = {ANALYSIS_LIMIT};')
+        c.execute('analyze;')
+        conn.commit()
+
+    sql = 'pragma synchronous = normal;'
+    c.execute(sql)
+    sql = 'pragma temp_store = 2;' # to store temp table and indices in memory
+    c.execute(sql)
+    sql = 'pragma journal_mode = off;' # disable journal for rollback (we don't use this)
+    c.execute(sql)
+    conn.commit()
+
+def optimize_db(conn, c):
+    # refresh the statistics of the query planner, limiting the work done on big db
+    c.execute(f'pragma analysis_limit = {ANALYSIS_LIMIT};')
+    c.execute('pragma optimize;')
+    conn.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description='Upgrade the schema of the db to the latest version')
+    parser.add_argument('-d', '--db', default='probemon.db', help='file name of the db')
+    parser.add_argument('-b', '--batch', type=int, default=MIGRATION_BATCH, help='number of rows updated per transaction')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f'Error: file not found {args.db}', file=sys.stderr)
+        sys.exit(-1)
+
+    conn = sqlite3.connect(args.db)
+    c = conn.cursor()
+    version = get_version(c)
+    print(f':: Schema version {version}, latest version {SCHEMA_VERSION}')
+    try:
+        migrate(conn, c, args.batch, verbose=True)
+    except VersionError as v:
+        print(f'Error: {v}', file=sys.stderr)
+        sys.exit(-1)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
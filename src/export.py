@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+# export the probe requests of the db as CSV, NDJSON or columns in a NumPy .npz file,
+# to feed other tools. Rows are streamed by chunks, the names of the mac, vendor and
+# ssid are looked up in memory instead of being joined by the db
+
+import sqlite3
+import argparse
+import json
+import time
+import sys
+import os.path
+import numpy as np
+
+# avoid IOError when quitting less
+from signal import signal, SIGPIPE, SIG_DFL
+signal(SIGPIPE, SIG_DFL)
+
+from stats import parse_ts, load_macs, load_ssids, iter_records, ROW_DTYPE, NUMOFSECSINADAY
+from db import check_version, VersionError
+
+FORMATS = ['csv', 'ndjson', 'npz']
+COLUMNS = ['date', 'mac', 'laa', 'vendor', 'ssid', 'rssi']
+BUFFER_SIZE = 1 << 20
+
+class Encoder:
+    '''encode the values of a table by code, each one only once'''
+    def __init__(self, values, encode):
+        self.values = values
+        self.encode = encode
+        self.encoded = np.empty(len(values), dtype=object)
+        self.done = np.zeros(len(values), dtype=bool)
+
+    def __call__(self, codes):
+        '''returns the encoded values of an array of codes'''
+        new = np.unique(codes[~self.done[codes]])
+        for code in new.tolist():
+            self.encoded[code] = self.encode(self.values[code])
+        self.done[new] = True
+        return self.encoded[codes]
+
+def iso_times(dates, cache):
+    '''returns the local time of dates in ISO 8601, cached by second in cache'''
+    seconds, inv = np.unique(dates.astype(np.int64), return_inverse=True)
+    times = []
+    for s in seconds.tolist():
+        try:
+            times.append(cache[s])
+        except KeyError:
+            t = cache[s] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(s))
+            times.append(t)
+    return np.array(times, dtype=object)[inv]
+
+def csv_field(value):
+    '''quote a field like the csv module does by default'''
+    if any(ch in value for ch in ',"\r\n'):
+        return '"%s"' % value.replace('"', '""')
+    return value
+
+def write_text(chunks, table, ssid_names, fmt, iso, out):
+    '''write the chunks as csv or ndjson, returns the number of rows written'''
+    # the strings are encoded once, then each line is a join of encoded fields
+    encode = csv_field if fmt == 'csv' else json.dumps
+    macs = Encoder(table.names, encode)
+    vendors = Encoder(table.vendors, encode)
+    ssids = Encoder(ssid_names, encode)
+    laa = np.array(['0', '1'] if fmt == 'csv' else ['false', 'true'], dtype=object)
+    cache = {}
+
+    if fmt == 'csv':
+        out.write('%s\n' % ','.join(COLUMNS))
+        line = '%s,%s,%s,%s,%s,%s\n'
+    else:
+        line = '{"date": %s, "mac": %s, "laa": %s, "vendor": %s, "ssid": %s, "rssi": %s}\n'
+    total = 0
+    for rec in chunks:
+        if iso:
+            dates = iso_times(rec['first'], cache)
+            if fmt == 'ndjson':
+                dates = ['"%s"' % d for d in dates.tolist()]
+        else:
+            dates = map(repr, rec['first'].tolist())
+        columns = (dates, macs(rec['mac']), laa[table.laa[rec['mac']].astype(np.int64)],
+            vendors(rec['mac']), ssids(rec['ssid']), map(str, rec['rssi'].tolist()))
+        out.write(''.join(map(line.__mod__, zip(*columns))))
+        total += len(rec)
+    return total
+
+def write_npz(chunks, table, ssid_names, iso, path):
+    '''write the chunks as columns in a .npz file, returns the number of rows written.
+    mac and ssid are codes in the mac, vendor, laa and ssid tables of the file'''
+    chunks = list(chunks)
+    if len(chunks) == 0:
+        chunks = [np.zeros(0, dtype=ROW_DTYPE)]
+    rec = np.concatenate(chunks)
+    del chunks
+    # only keep the mac and ssid of the exported rows, with codes of the smallest type
+    mac_ids, mac = np.unique(rec['mac'], return_inverse=True)
+    ssid_ids, ssid = np.unique(rec['ssid'], return_inverse=True)
+    columns = {'mac': mac.astype(np.uint32), 'ssid': ssid.astype(np.uint32), 'rssi': rec['rssi'].astype(np.int8),
+        'mac_names': np.array(table.names[mac_ids].tolist(), dtype=str),
+        'vendors': np.array(table.vendors[mac_ids].tolist(), dtype=str),
+        'laa': table.laa[mac_ids],
+        'ssid_names': np.array([ssid_names[i] for i in ssid_ids.tolist()], dtype=str)}
+    if iso:
+        columns['date'] = np.array(iso_times(rec['first'], {}).tolist(), dtype=str)
+    else:
+        columns['date'] = rec['first']
+    np.savez(path, **columns)
+    return len(rec)
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the probe requests of the database')
+    parser.add_argument('-a', '--after', help='filter before this timestamp')
+    parser.add_argument('-b', '--before', help='filter after this timestamp')
+    parser.add_argument('-d', '--day', action='store_true', help='filter only for the past day')
+    parser.add_argument('--db', default='probemon.db', help='file name of database')
+    parser.add_argument('-f', '--format', choices=FORMATS, default='csv', help='format of the export')
+    parser.add_argument('-i', '--iso', action='store_true', help='use ISO 8601 local time instead of epoch timestamps')
+    parser.add_argument('-m', '--mac', action='append', help='filter for that mac address')
+    parser.add_argument('-o', '--output', help='file name of the export (default to stdout, except for npz)')
+    parser.add_argument('-r', '--rssi', type=int, help='filter for that minimal RSSI value')
+    parser.add_argument('-z', '--zero', action='store_true', help='filter rssi value of 0')
+    args = parser.parse_args()
+
+    if args.day and (args.before or args.after):
+        print('Error: --day conflicts with --after or --before', file=sys.stderr)
+        sys.exit(-1)
+
+    if args.format == 'npz' and args.output is None:
+        print('Error: npz format needs an --output file', file=sys.stderr)
+        sys.exit(-1)
+
+    before = None
+    after = None
+    if args.after:
+        after = parse_ts(args.after)
+    if args.before:
+        before = parse_ts(args.before)
+    if args.day:
+        before = time.time() # now
+        after = before - NUMOFSECSINADAY # since one day in the past
+
+    if not os.path.exists(args.db):
+        print(f'Error: file not found {args.db}', file=sys.stderr)
+        sys.exit(-1)
+
+    conn = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+    c = conn.cursor()
+    sql = 'pragma query_only = on;'
+    c.execute(sql)
+    sql = 'pragma temp_store = 2;' # to store temp table and indices in memory
+    c.execute(sql)
+    conn.commit()
+
+    try:
+        check_version(c)
+    except VersionError as v:
+        print(f'Error: {v}', file=sys.stderr)
+        conn.close()
+        sys.exit(-1)
+
+    start = time.monotonic()
+    table, selected = load_macs(c, args.mac)
+    ssids = load_ssids(c)
+    mac_ids = np.flatnonzero(selected).tolist() if args.mac else None
+    chunks = iter_records(c, 'select mac,ssid,rssi,1,date,date', 'order by date', after, before,
+        mac_ids, args.rssi, args.zero, selected, True)
+    if args.format == 'npz':
+        total = write_npz(chunks, table, ssids, args.iso, args.output)
+    else:
+        if args.output is None:
+            out = open(sys.stdout.fileno(), 'w', buffering=BUFFER_SIZE, newline='', closefd=False)
+        else:
+            out = open(args.output, 'w', buffering=BUFFER_SIZE, newline='')
+        with out:
+            total = write_text(chunks, table, ssids, args.format, args.iso, out)
+    conn.close()
+    elapsed = time.monotonic() - start
+    print(f':: Exported {total} rows in {elapsed:.2f}s ({total/max(elapsed, 1e-6):.0f} rows/s)', file=sys.stderr)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
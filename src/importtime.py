@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+# measure the time spent importing modules at the start of the scripts, with
+# python -X importtime, and check that the heavy modules are only imported on the
+# code paths that use them: a regression makes each invocation slower
+
+import sqlite3
+import argparse
+import subprocess
+import tempfile
+import time
+import sys
+import os.path
+
+# the interactive backends of matplotlib are only needed to open a window
+GUI_MODULES = ('tkinter', 'PyQt5', 'PyQt6', 'PySide2', 'PySide6', 'gi', 'wx')
+# script, arguments and the modules it must not import
+CASES = [('plot.py', ['-h'], ('matplotlib', 'PIL', 'scapy')),
+    ('probemon.py', ['-h'], ('numpy', 'scapy', 'grpc', 'manuf')),
+    ('stats.py', ['-h'], ('matplotlib', 'scapy')),
+    ('export.py', ['-h'], ('matplotlib', 'scapy')),
+    ('ingest.py', ['-h'], ('matplotlib', 'scapy')),
+    ('archive.py', ['-h'], ('numpy', 'matplotlib', 'scapy')),
+    ('db.py', ['-h'], ('numpy', 'matplotlib', 'scapy')),
+    ('merge.py', ['-h'], ('matplotlib', 'scapy'))]
+
+def import_times(script, args):
+    '''returns the cumulative import time of the modules imported by a script in
+    seconds, by module, with the ones imported at the top level first'''
+    cmd = [sys.executable, '-X', 'importtime', os.path.join(os.path.dirname(os.path.abspath(__file__)), script)]
+    proc = subprocess.run(cmd + args, capture_output=True, text=True)
+    top, nested = {}, {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # nested imports are indented by 2 spaces per level, after the first one
+        level = (len(name) - len(name.lstrip()) - 1)//2
+        (top if level == 0 else nested)[name.strip()] = int(cumulative)/1e6
+    return top, nested
+
+def plot_case(db, image):
+    '''returns the case of a plot of the last hour of a db into an image'''
+    conn = sqlite3.connect(f'file:{db}?mode=ro', uri=True)
+    last = conn.execute('select max(date) from probemon').fetchone()[0]
+    conn.close()
+    if last is None:
+        print(f'Error: no probe requests in {db}', file=sys.stderr)
+        sys.exit(-1)
+    start = time.strftime('%Y-%m-%dT%H:%M', time.localtime(last - 60*60))
+    return ('plot.py', ['-b', db, '-i', image, '-s', start, '--span-time', '1h'], GUI_MODULES + ('scapy',))
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import time of the scripts at startup')
+    parser.add_argument('-b', '--db', help='also plot the last hour of that db into an image')
+    parser.add_argument('-m', '--max', type=float, help='maximal import time of a script, in seconds')
+    parser.add_argument('-n', '--runs', type=int, default=3, help='number of runs of each script, the fastest is kept')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='show the slowest imports of each script')
+    args = parser.parse_args()
+
+    if args.runs < 1:
+        print('Error: --runs must be at least 1', file=sys.stderr)
+        sys.exit(-1)
+    if args.db is not None and not os.path.exists(args.db):
+        print(f'Error: file not found {args.db}', file=sys.stderr)
+        sys.exit(-1)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        cases = list(CASES)
+        if args.db is not None:
+            cases.append(plot_case(args.db, os.path.join(tmp, 'plot.png')))
+        for script, script_args, forbidden in cases:
+            runs = [import_times(script, script_args) for _ in range(args.runs)]
+            top, nested = min(runs, key=lambda r: sum(r[0].values()))
+            total = sum(top.values())
+            # a module is imported once, at the top level or nested
+            imported = set(top) | set(nested)
+            bad = sorted(m for m in imported if m.split('.')[0] in forbidden)
+            status = 'ok'
+            if bad:
+                status = 'imports ' + ', '.join(sorted(set(m.split('.')[0] for m in bad)))
+            elif args.max is not None and total > args.max:
+                status = f'slower than {args.max:.3f}s'
+            failed |= status != 'ok'
+            print(f'{script} {" ".join(script_args[:1])}: {total:.3f}s {status}')
+            if args.verbose:
+                for name, t in sorted(top.items(), key=lambda x: -x[1])[:5]:
+                    print(f'    {name:30s} {t:.3f}s')
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
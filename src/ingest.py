@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+# import the probe requests of pcap, pcapng and kismet files into the db. The files
+# are parsed by a pool of processes, reading only the time, transmitter address,
+# ssid and rssi of each probe request, and written by this process only, one file
+# per transaction. A file already imported is skipped, so that an interrupted
+# import is resumed by running the same command again
+
+import sqlite3
+import argparse
+import multiprocessing
+import time
+import sys
+import os
+import os.path
+import numpy as np
+from manuf import manuf
+
+import config
+import pcapfile
+import probelog
+import presence
+import sketch
+import tiles
+from db import init_db, optimize_db, get_vendor_id, get_mac_id, get_ssid_id, mac_to_int, VersionError
+
+MANUF_FILE = './manuf'
+# first bytes of a sqlite db, like a kismet one
+SQLITE_MAGIC = b'SQLite format 3\0'
+
+def parse(path):
+    '''returns the path, the columns of the probe requests of a capture file (see
+    pcapfile._probe_columns) or an error, and the time spent. It runs in the
+    processes of the pool'''
+    start = time.monotonic()
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(len(SQLITE_MAGIC))
+        if magic == SQLITE_MAGIC:
+            columns = pcapfile.read_kismet_probes(path)
+        else:
+            columns = pcapfile.read_probes(path)
+    except (OSError, pcapfile.PcapError) as e:
+        return path, None, str(e), time.monotonic() - start
+    return path, columns, None, time.monotonic() - start
+
+class Writer:
+    '''write the probe requests of capture files into the db. The vendor, mac and
+    ssid ids are resolved like probemon.insert_into_db, once per distinct value'''
+    def __init__(self, conn, c, vendor_db, ignored):
+        self.conn = conn
+        self.c = c
+        self.vendor_db = vendor_db
+        self.ignored = [v for v in map(mac_to_int, ignored) if v is not None]
+        self.vendors = {}
+        self.macs = {}
+        self.ssids = {}
+        self.hashes = {}
+        self.sketches = sketch.Sketches()
+        self.presence = presence.Presence()
+
+    def mac_id(self, mac):
+        try:
+            return self.macs[mac]
+        except KeyError:
+            pass
+        # look up vendor from OUI value in MAC address
+        vendor = self.vendor_db.get_manuf_long(mac)
+        if vendor is None:
+            vendor = 'UNKNOWN'
+        try:
+            vendor_id = self.vendors[vendor]
+        except KeyError:
+            vendor_id = self.vendors[vendor] = get_vendor_id(self.c, vendor)
+        self.macs[mac] = get_mac_id(self.c, mac, vendor_id)
+        self.hashes[mac] = sketch.mac_hash(mac)
+        return self.macs[mac]
+
+    def ssid_id(self, ssid):
+        try:
+            return self.ssids[ssid]
+        except KeyError:
+            self.ssids[ssid] = get_ssid_id(self.c, ssid)
+            return self.ssids[ssid]
+
+    def write(self, path, stat, columns):
+        '''write the columns of the probe requests of a file, and record the file as
+        imported in the same transaction. Returns the number of probe requests'''
+        dates, macs, ssids, rssi, ssid_names = columns
+        keep = ~np.isin(macs, self.ignored)
+        dates, macs, ssids, rssi = dates[keep], macs[keep], ssids[keep], rssi[keep]
+        values, inv = np.unique(macs, return_inverse=True)
+        names = pcapfile.mac_names(values)
+        mac_ids = np.array([self.mac_id(m) for m in names], dtype=np.int64)
+        ssid_ids = np.array([self.ssid_id(s) for s in ssid_names], dtype=np.int64)
+
+        # the rows are inserted in time order, like the ones of probemon.py
+        order = np.argsort(dates, kind='stable')
+        records = np.zeros(len(dates), dtype=probelog.DTYPE)
+        records['date'] = dates[order]
+        records['mac'] = mac_ids[inv[order]]
+        records['ssid'] = ssid_ids[ssids[order]]
+        records['rssi'] = rssi[order]
+        probelog.insert_records(self.c, records)
+
+        # the rows of a mac in a quarter of an hour all fall into the same buckets
+        quarters = np.floor_divide(dates, sketch.QUARTER).astype(np.int64)
+        if len(quarters) > 0:
+            first = quarters.min()
+            span = quarters.max() - first + 1
+            pairs = np.unique(inv*span + quarters - first)
+            for m, q in zip(*np.divmod(pairs, span)):
+                self.sketches.add_hash(int(q + first)*sketch.QUARTER, self.hashes[names[m]])
+        self.sketches.flush(self.c)
+        self.presence.add_many(dates, mac_ids[inv])
+        self.presence.flush(self.c)
+        if len(dates) > 0:
+            # the tiles of the timeline are built again at the end of the import
+            tiles.invalidate(self.c, dates.min(), dates.max())
+
+        self.c.execute('insert or replace into capture (path, size, mtime, count) values (?, ?, ?, ?)',
+            (path, stat.st_size, stat.st_mtime, len(records)))
+        self.conn.commit()
+        return len(records)
+
+def pending(c, paths):
+    '''returns the paths not yet imported, with their stat'''
+    todo = {}
+    for path in paths:
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            print(f'Error: {e}', file=sys.stderr)
+            continue
+        c.execute('select size, mtime from capture where path=?', (path,))
+        row = c.fetchone()
+        if row is None:
+            todo[path] = stat
+        elif row != (stat.st_size, stat.st_mtime):
+            # importing it again would duplicate the probe requests already imported
+            print(f'Warning: {path} changed since it was imported, skipped', file=sys.stderr)
+        else:
+            print(f':: Skipping {path}, already imported')
+    return todo
+
+def main():
+    parser = argparse.ArgumentParser(description='Import the probe requests of pcap, pcapng or kismet files into the db')
+    parser.add_argument('-d', '--db', default='probemon.db', help='file name of the db')
+    parser.add_argument('-I', '--ignore', action='append', help='mac address to ignore')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of processes parsing the files')
+    parser.add_argument('files', nargs='+', help='pcap, pcapng or kismet files to import')
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        print('Error: --jobs must be at least 1', file=sys.stderr)
+        sys.exit(-1)
+    if args.ignore is not None:
+        config.IGNORED = args.ignore
+
+    conn = sqlite3.connect(args.db)
+    c = conn.cursor()
+    try:
+        init_db(conn, c)
+    except VersionError as v:
+        print(f'Error: {v}', file=sys.stderr)
+        sys.exit(-1)
+    # a file is written in a single transaction, rolled back if the import is
+    # interrupted: it needs the rollback journal that init_db disables
+    sql = 'pragma journal_mode = delete;'
+    c.execute(sql)
+
+    todo = pending(c, args.files)
+    if len(todo) == 0:
+        conn.close()
+        return
+    vendor_db = manuf.MacParser(manuf_name=MANUF_FILE, update=not os.path.isfile(MANUF_FILE))
+    writer = Writer(conn, c, vendor_db, config.IGNORED)
+
+    start = time.monotonic()
+    total = 0
+    pool = multiprocessing.Pool(min(args.jobs, len(todo))) if args.jobs > 1 else None
+    try:
+        # the files are written as soon as they are parsed, in any order
+        results = pool.imap_unordered(parse, todo) if pool is not None else map(parse, todo)
+        for n, (path, columns, error, elapsed) in enumerate(results, 1):
+            if error is not None:
+                print(f'Error: [{n}/{len(todo)}] {error}', file=sys.stderr)
+                continue
+            t = time.monotonic()
+            count = writer.write(path, todo[path], columns)
+            total += count
+            print(f':: [{n}/{len(todo)}] {path}: {count} probe requests (parsed in {elapsed:.2f}s, written in {time.monotonic()-t:.2f}s)')
+    finally:
+        if pool is not None:
+            pool.terminate()
+    tiles.build(c)
+    conn.commit()
+    optimize_db(conn, c)
+    conn.close()
+    print(f':: Imported {total} probe requests in {time.monotonic()-start:.2f}s')
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
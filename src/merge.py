@@ -4,6 +4,13 @@ import sqlite3
 import sys
 import argparse
 
+from db import init_db, mac_fields, get_version, SCHEMA_VERSION, MAC_SSID_UPSERT, index_ssid
+from db import VersionError, get_vendor_id, get_mac_id
+import archive
+import presence
+import sketch
+import tiles
+
 parser = argparse.ArgumentParser(description='Merge one db into the current one')
 parser.add_argument('-o', '--output', default='probemon.db', help='file name of the target/output db')
 parser.add_argument('-i', '--input', help='file name of the input db', required=True)
@@ -11,13 +18,34 @@ args = parser.parse_args()
 
 conn_in = sqlite3.connect(args.input)
 c_in = conn_in.cursor()
+if get_version(c_in) > SCHEMA_VERSION:
+    print(f'Error: schema version of {args.input} is newer than the supported version {SCHEMA_VERSION}', file=sys.stderr)
+    sys.exit(-1)
 
 conn_out = sqlite3.connect(args.output)
 c_out = conn_out.cursor()
+try:
+    init_db(conn_out, c_out)
+except VersionError as v:
+    print(f'Error: {v}', file=sys.stderr)
+    sys.exit(-1)
+
+def input_rows():
+    '''yield the rows of the probemon table of the input db, then its archived rows'''
+    cur = conn_in.cursor()
+    cur.execute('select * from probemon')
+    yield from cur
+    cur.execute("select name from sqlite_master where name='archive'")
+    if cur.fetchone() is not None:
+        yield from archive.iter_rows(cur)
 
-c_in.execute('select * from probemon')
-for row in c_in.fetchall():
+sketches = sketch.Sketches()
+index = presence.Presence()
+first, last = None, None
+for row in input_rows():
     time, mac, ssid, rssi = row
+    first = time if first is None else min(first, time)
+    last = time if last is None else max(last, time)
 
     c_in.execute('select address,vendor from mac where id = ?', (mac,))
     mac_add, vendor_id = c_in.fetchone()
@@ -34,7 +62,8 @@ for row in c_in.fetchall():
     c_out.execute('select id from mac where address = ?', (mac_add,))
     r = c_out.fetchone()
     if r is None:
-        c_out.execute('insert into mac (address, vendor) values (?, ?)', (mac_add, vendor_id,))
+        c_out.execute('insert into mac (address, vendor, value, oui, laa) values (?, ?, ?, ?, ?)',
+            (mac_add, vendor_id) + mac_fields(mac_add))
         c_out.execute('select id from mac where address = ?', (mac_add,))
         r = c_out.fetchone()
     mac_id = r[0]
@@ -47,10 +76,36 @@ for row in c_in.fetchall():
         c_out.execute('insert into ssid (name) values (?)', (ssid_name,))
         c_out.execute('select id from ssid where name = ?', (ssid_name,))
         r = c_out.fetchone()
+        index_ssid(c_out, r[0], ssid_name)
     ssid_id = r[0]
 
     c_out.execute('insert into probemon values (?, ?, ?, ?)', (time, mac_id, ssid_id, rssi))
+    c_out.execute(MAC_SSID_UPSERT, (mac_id, ssid_id, time, time, 1))
+    sketches.add(time, mac_add)
+    index.add(time, mac_id)
+
+# the sketches of the input db also count its archived rows
+c_in.execute("select name from sqlite_master where name='sketch'")
+if c_in.fetchone() is not None:
+    c_in.execute('select level, start, end, registers from sketch')
+    for level, start, end, registers in c_in.fetchall():
+        sketches.merge(level, start, end, sketch.decode(registers))
+# the sketches of the output db now count the mac of both db
+sketches.flush(c_out)
 
+# so does the presence index, with the ids of the mac in the output db
+c_in.execute("select name from sqlite_master where name='presence'")
+if c_in.fetchone() is not None:
+    c_in.execute('''select presence.day, presence.minutes, mac.address, vendor.name from presence
+    inner join mac on mac.id=presence.mac inner join vendor on vendor.id=mac.vendor''')
+    for day, minutes, mac_add, vendor_name in c_in.fetchall():
+        mac_id = get_mac_id(c_out, mac_add, get_vendor_id(c_out, vendor_name))
+        index.merge(mac_id, day, presence.to_bitmap(minutes))
+index.flush(c_out)
+# the tiles of the timeline with the merged rows are built again
+if first is not None:
+    tiles.invalidate(c_out, first, last)
+tiles.build(c_out)
 conn_out.commit()
 
 conn_out.close()
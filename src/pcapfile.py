@@ -0,0 +1,386 @@
+# -*- encoding: utf-8 -*-
+# streaming reader of the 802.11 frames of pcap and pcapng files. The records are
+# walked with struct on a memory map of the file, by chunks, then the fields needed
+# are read at fixed offsets of the radiotap and 802.11 headers of a whole chunk with
+# NumPy, instead of dissecting every packet with scapy. The packets of a kismet db
+# are read the same way, by chunks of rows
+
+import base64
+import mmap
+import sqlite3
+import struct
+from array import array
+import numpy as np
+
+# link types of the 802.11 frames, with or without a radiotap header
+LINKTYPE_IEEE802_11 = 105
+LINKTYPE_IEEE802_11_RADIOTAP = 127
+# first byte of the frame control of a probe request: subtype 4 of the management type
+PROBE_REQUEST = 0x40
+# first byte of the frame control of the control frames without a transmitter
+# address (CTS and ACK)
+NO_ADDR2 = (0xc4, 0xd4)
+CHUNK_SIZE = 1 << 18 # number of records read at once
+# length of the header of a management frame, and max length of a ssid
+DOT11_HEADER = 24
+SSID_LENGTH = 32
+# (bit in the present word, alignment, size) of the radiotap fields before the
+# antenna signal, the bit of which is RADIOTAP_ANTSIGNAL
+RADIOTAP_FIELDS = ((0, 8, 8), (1, 1, 1), (2, 1, 1), (3, 2, 4), (4, 2, 2))
+RADIOTAP_ANTSIGNAL = 5
+
+PCAP_MAGIC = {b'\xd4\xc3\xb2\xa1': ('<', 1e-6), b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9), b'\xa1\xb2\x3c\x4d': ('>', 1e-9)}
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 1
+PCAPNG_EPB = 6
+PCAPNG_BYTE_ORDER = 0x1a2b3c4d
+# if_tsresol option of an interface description block
+PCAPNG_TSRESOL = 9
+
+# devices of a kismet db to keep, the AP and bridged devices are left out
+KISMET_DEVICES = ('Wi-Fi Device', 'Wi-Fi Client')
+# the broadcast and null addresses are never kept
+KISMET_EXCLUDED = '''select lower(devmac) from devices where type not in (?, ?)
+    union values ('ff:ff:ff:ff:ff:ff'), ('00:00:00:00:00:00')'''
+# first bytes of the multicast addresses, never kept as destination
+MULTICAST = '01:00:5e'
+
+class PcapError(Exception):
+    pass
+
+def _gather(buf, offsets, size):
+    '''returns the size bytes at each offset of buf, as rows of a 2d array'''
+    return buf[offsets[:, None] + np.arange(size)]
+
+def _tsresol(mm, endian, offset, end):
+    # walk the options of an interface description block
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(endian + 'HH', mm, offset)
+        if code == 0:
+            break
+        if code == PCAPNG_TSRESOL:
+            value = mm[offset+4]
+            # the high bit tells a power of 2 instead of a power of 10
+            return 2.0**-(value & 0x7f) if value & 0x80 else 10.0**-value
+        offset += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+class PcapReader:
+    '''reader of the packets of a pcap or pcapng file, by chunks of records. The file
+    is unmapped once the reader and the arrays viewing buf are released'''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                self.mm = b'' # empty file
+        self.buf = np.frombuffer(self.mm, dtype=np.uint8)
+        if bytes(self.mm[:4]) in PCAP_MAGIC:
+            self.chunks = self._pcap_chunks
+        elif len(self.mm) >= 12 and struct.unpack_from('<I', self.mm)[0] == PCAPNG_SHB:
+            self.chunks = self._pcapng_chunks
+        else:
+            raise PcapError(f'{path} is not a pcap or pcapng file')
+
+    def release(self, start, end):
+        '''drop the pages of the bytes [start, end) of the file from memory, once a
+        chunk is read, to keep the memory flat on big files'''
+        if isinstance(self.mm, mmap.mmap) and hasattr(mmap, 'MADV_DONTNEED'):
+            start -= start % mmap.PAGESIZE
+            if end > start:
+                self.mm.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def _records(self, offsets, dates, linktypes, lengths):
+        # leave out a truncated record at the end of the file
+        mask = offsets + lengths <= len(self.mm)
+        return dates[mask], linktypes[mask], offsets[mask], lengths[mask]
+
+    def _pcap_chunks(self):
+        '''yield the (dates, link types, offsets, lengths) arrays of the packets of a
+        chunk of records: the data of a packet is buf[offset:offset+length]'''
+        endian, resolution = PCAP_MAGIC[bytes(self.mm[:4])]
+        linktype, = struct.unpack_from(endian + 'I', self.mm, 20)
+        length_of = struct.Struct(endian + 'I').unpack_from
+        mm = self.mm
+        # a record header is 16 bytes long, its third field is the length of the packet
+        offset, end = 24, len(mm) - 16
+        while offset <= end:
+            start = offset
+            offsets = array('q')
+            append = offsets.append
+            for _ in range(CHUNK_SIZE):
+                if offset > end:
+                    break
+                append(offset)
+                offset += 16 + length_of(mm, offset+8)[0]
+            offsets = np.frombuffer(offsets, dtype=np.int64)
+            headers = _gather(self.buf, offsets, 16).view(endian + 'u4')
+            dates = headers[:, 0] + headers[:, 1]*resolution
+            linktypes = np.full(len(offsets), linktype)
+            yield self._records(offsets + 16, dates, linktypes, headers[:, 2].astype(np.int64))
+            self.release(start, offset)
+
+    def _pcapng_chunks(self):
+        '''same as _pcap_chunks for a pcapng file, reading only its enhanced packet blocks'''
+        mm = self.mm
+        offset, end = 0, len(mm) - 12
+        endian = '<'
+        interfaces = []
+        offsets = array('q')
+        start = offset
+        while offset <= end:
+            block_type, block_length = struct.unpack_from(endian + 'II', mm, offset)
+            if block_type == PCAPNG_SHB or len(offsets) == CHUNK_SIZE:
+                if len(offsets) > 0:
+                    yield self._pcapng_records(offsets, endian, interfaces)
+                    self.release(start, offset)
+                    offsets = array('q')
+                    start = offset
+            if block_type == PCAPNG_SHB:
+                # each section sets its own byte order and interfaces
+                magic, = struct.unpack_from('<I', mm, offset+8)
+                endian = '<' if magic == PCAPNG_BYTE_ORDER else '>'
+                block_length, = struct.unpack_from(endian + 'I', mm, offset+4)
+                interfaces = []
+            if block_length < 12 or offset + block_length > len(mm):
+                break # corrupted or truncated block
+            if block_type == PCAPNG_IDB:
+                linktype, = struct.unpack_from(endian + 'H', mm, offset+8)
+                interfaces.append((linktype, _tsresol(mm, endian, offset+16, offset+block_length-4)))
+            elif block_type == PCAPNG_EPB:
+                offsets.append(offset)
+            offset += block_length
+        if len(offsets) > 0:
+            yield self._pcapng_records(offsets, endian, interfaces)
+
+    def _pcapng_records(self, offsets, endian, interfaces):
+        offsets = np.frombuffer(offsets, dtype=np.int64)
+        # interface id, high and low 32 bits of the timestamp and length of the packet
+        fields = _gather(self.buf, offsets + 8, 16).view(endian + 'u4')
+        linktypes = np.array([i[0] for i in interfaces], dtype=np.int64)[fields[:, 0]]
+        resolutions = np.array([i[1] for i in interfaces])[fields[:, 0]]
+        stamps = (fields[:, 1].astype(np.uint64) << np.uint64(32)) | fields[:, 2]
+        return self._records(offsets + 28, stamps*resolutions, linktypes, fields[:, 3].astype(np.int64))
+
+def _clip(buf, offsets):
+    '''returns the bytes at offsets, the ones past the end of buf read as its last byte'''
+    return buf[np.minimum(offsets, len(buf)-1)]
+
+def _u32(buf, offsets):
+    b = _clip(buf, offsets[:, None] + np.arange(4)).astype(np.uint32)
+    return b[:, 0] | b[:, 1] << 8 | b[:, 2] << 16 | b[:, 3] << 24
+
+def dot11_headers(buf, linktypes, offsets, lengths):
+    '''returns the offset of the 802.11 header of each packet, and the mask of the
+    802.11 frames'''
+    starts = offsets.copy()
+    radiotap = linktypes == LINKTYPE_IEEE802_11_RADIOTAP
+    mask = (radiotap & (lengths >= 4)) | (linktypes == LINKTYPE_IEEE802_11)
+    # the length of the radiotap header is the little endian short at offset 2
+    rt = offsets[radiotap & mask]
+    starts[radiotap & mask] += buf[rt+2].astype(np.int64) | buf[rt+3].astype(np.int64) << 8
+    return starts, mask
+
+def mac_values(buf, offsets):
+    '''returns the 48-bit integer value of the mac addresses at offsets'''
+    values = np.zeros(len(offsets), dtype=np.int64)
+    for i in range(6):
+        values = values << 8 | buf[offsets+i]
+    return values
+
+def mac_names(values):
+    '''returns the addresses of 48-bit integer values of mac'''
+    names = []
+    for v in values.tolist():
+        h = '%012x' % v
+        names.append(':'.join((h[0:2], h[2:4], h[4:6], h[6:8], h[8:10], h[10:12])))
+    return names
+
+def read_addr2(path, only_pr=False):
+    '''returns the timestamps and transmitter addresses (as 48-bit integers) of the
+    802.11 frames of a pcap or pcapng file, only of the probe requests with only_pr'''
+    dates, macs = [], []
+    reader = PcapReader(path)
+    buf = reader.buf
+    for d, linktypes, offsets, lengths in reader.chunks():
+        starts, mask = dot11_headers(buf, linktypes, offsets, lengths)
+        # addr2 ends at offset 16 of the 802.11 header
+        mask &= starts + 16 <= offsets + lengths
+        starts, d = starts[mask], d[mask]
+        fc = buf[starts]
+        if only_pr:
+            keep = fc == PROBE_REQUEST
+        else:
+            keep = ~np.isin(fc, NO_ADDR2)
+        dates.append(d[keep])
+        macs.append(mac_values(buf, starts[keep] + 10))
+    if len(dates) == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+    return np.concatenate(dates), np.concatenate(macs)
+
+def read_kismet(path, only_pr=False):
+    '''returns the timestamps of the source and destination addresses of the 802.11
+    packets of a kismet db, only of the probe requests with only_pr, as dates, codes
+    of the addresses and their list. Only the addresses of the wifi clients and
+    devices are kept'''
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    c = conn.cursor()
+    sql = 'pragma query_only = on;'
+    c.execute(sql)
+    sql = 'pragma temp_store = 2;' # to store temp table and indices in memory
+    c.execute(sql)
+    conn.commit()
+
+    try:
+        c.execute(KISMET_EXCLUDED, KISMET_DEVICES)
+        excluded = [row[0] for row in c.fetchall()]
+        # the blob of a packet is only read with only_pr, to check its frame control
+        columns = 'ts_sec, sourcemac, destmac, dlt, packet' if only_pr else 'ts_sec, sourcemac, destmac'
+        c.execute(f"select {columns} from packets where phyname='IEEE802.11'")
+    except sqlite3.DatabaseError as e:
+        conn.close()
+        raise PcapError(f'{path} is not a kismet db: {e}')
+    # the addresses are coded as they are read, then filtered once per address
+    codes = {}
+    dates, src, dst = [], [], []
+    while True:
+        rows = c.fetchmany(CHUNK_SIZE)
+        if len(rows) == 0:
+            break
+        d = np.fromiter((r[0] for r in rows), dtype=np.float64, count=len(rows))
+        s = np.fromiter((codes.setdefault(r[1], len(codes)) for r in rows), dtype=np.int64, count=len(rows))
+        t = np.fromiter((codes.setdefault(r[2], len(codes)) for r in rows), dtype=np.int64, count=len(rows))
+        if only_pr:
+            packets = [r[4] for r in rows]
+            lengths = np.array([len(p) for p in packets], dtype=np.int64)
+            offsets = np.cumsum(lengths) - lengths
+            # a null byte past the last packet for the frame control of a too short one
+            buf = np.frombuffer(b''.join(packets) + b'\0', dtype=np.uint8)
+            linktypes = np.fromiter((r[3] for r in rows), dtype=np.int64, count=len(rows))
+            starts, mask = dot11_headers(buf, linktypes, offsets, lengths)
+            mask &= starts < offsets + lengths
+            keep = mask & (buf[np.where(mask, starts, len(buf)-1)] == PROBE_REQUEST)
+            d, s, t = d[keep], s[keep], t[keep]
+        dates.append(d)
+        src.append(s)
+        dst.append(t)
+    conn.close()
+    if len(dates) == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64), []
+    dates, src, dst = np.concatenate(dates), np.concatenate(src), np.concatenate(dst)
+
+    # the same address can be written in upper or lower case, a missing one is null
+    names = np.array([(m or '00:00:00:00:00:00').lower() for m in codes], dtype=object)
+    names, remap = np.unique(names, return_inverse=True)
+    kept = ~np.isin(names, excluded)
+    multicast = np.array([m.startswith(MULTICAST) for m in names.tolist()], dtype=bool)
+    src, dst = remap[src], remap[dst]
+    src_kept, dst_kept = kept[src], (kept & ~multicast)[dst]
+    return (np.concatenate((dates[src_kept], dates[dst_kept])),
+        np.concatenate((src[src_kept], dst[dst_kept])), names.tolist())
+
+def radiotap_rssi(buf, offsets, ends):
+    '''returns the antenna signal (in dBm) of the radiotap headers at offsets, ending
+    at ends, or 0 if there is none. The same fields as probemon.parse_rssi are read'''
+    valid = offsets + 8 <= ends
+    present = _u32(buf, offsets + 4)
+    # skip the extended present words
+    rel = np.full(len(offsets), 8)
+    more = valid & (present >> 31 == 1)
+    while more.any():
+        more &= offsets + rel + 4 <= ends
+        word = _u32(buf, offsets + rel)
+        rel += 4*more
+        more &= word >> 31 == 1
+    for bit, align, size in RADIOTAP_FIELDS:
+        # the fields are aligned from the start of the header
+        aligned = (rel + align - 1) // align * align
+        rel = np.where((present >> bit) & 1 == 1, aligned + size, rel)
+    has = valid & ((present >> RADIOTAP_ANTSIGNAL) & 1 == 1) & (offsets + rel < ends)
+    return np.where(has, _clip(buf, offsets + rel).view(np.int8), 0).astype(np.int8)
+
+def ssid_rows(buf, offsets, ends):
+    '''returns the ssid elements at offsets as rows of 1+SSID_LENGTH bytes: the length
+    of the ssid, then its bytes padded with null bytes. A missing or truncated
+    element gives an empty ssid'''
+    head = _clip(buf, offsets[:, None] + np.arange(2))
+    length = np.where((offsets + 2 <= ends) & (head[:, 0] == 0), head[:, 1], 0)
+    length = np.where(offsets + 2 + length <= ends, np.minimum(length, SSID_LENGTH), 0)
+    rows = _clip(buf, offsets[:, None] + 2 + np.arange(SSID_LENGTH))
+    rows = np.where(np.arange(SSID_LENGTH) < length[:, None], rows, 0)
+    return np.column_stack((length, rows)).astype(np.uint8)
+
+def ssid_name(data):
+    '''returns the name of a ssid like probemon.py: in base64 if it is not valid utf-8'''
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return 'b64_%s' % base64.b64encode(data).decode()
+
+def probe_requests(buf, linktypes, offsets, lengths):
+    '''returns the mask of the probe requests of a chunk of packets, and their
+    transmitter address (as 48-bit integers), ssid (see ssid_rows) and rssi'''
+    starts, mask = dot11_headers(buf, linktypes, offsets, lengths)
+    ends = offsets + lengths
+    mask &= starts + DOT11_HEADER <= ends
+    mask[mask] = buf[starts[mask]] == PROBE_REQUEST
+    starts, ends, offsets = starts[mask], ends[mask], offsets[mask]
+    rssi = np.zeros(len(starts), dtype=np.int8)
+    radiotap = linktypes[mask] == LINKTYPE_IEEE802_11_RADIOTAP
+    rssi[radiotap] = radiotap_rssi(buf, offsets[radiotap], starts[radiotap])
+    return mask, mac_values(buf, starts + 10), ssid_rows(buf, starts + DOT11_HEADER, ends), rssi
+
+def _probe_columns(chunks):
+    '''returns the columns of the probe requests of chunks of (buf, dates, link types,
+    offsets, lengths): dates, transmitter addresses, ssid codes, rssi, and the list
+    of ssid names'''
+    dates, macs, ssids, rssi = [], [], [], []
+    codes = {}
+    for buf, d, linktypes, offsets, lengths in chunks:
+        mask, m, rows, r = probe_requests(buf, linktypes, offsets, lengths)
+        # each distinct ssid of a chunk is decoded once
+        rows, inv = np.unique(rows.view(np.dtype((np.void, rows.shape[1]))).ravel(), return_inverse=True)
+        names = [ssid_name(bytes(row)[1:1+row[0]]) for row in rows.view(np.uint8).reshape(len(rows), -1)]
+        chunk_codes = np.array([codes.setdefault(n, len(codes)) for n in names], dtype=np.int64)
+        dates.append(d[mask])
+        macs.append(m)
+        ssids.append(chunk_codes[inv.ravel()])
+        rssi.append(r)
+    if len(dates) == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int8), []
+    return (np.concatenate(dates), np.concatenate(macs), np.concatenate(ssids), np.concatenate(rssi),
+        list(codes))
+
+def read_probes(path):
+    '''returns the columns of the probe requests of a pcap or pcapng file, see
+    _probe_columns'''
+    reader = PcapReader(path)
+    return _probe_columns((reader.buf,) + chunk for chunk in reader.chunks())
+
+def _kismet_chunks(c):
+    while True:
+        rows = c.fetchmany(CHUNK_SIZE)
+        if len(rows) == 0:
+            break
+        packets = [r[3] for r in rows]
+        lengths = np.array([len(p) for p in packets], dtype=np.int64)
+        buf = np.frombuffer(b''.join(packets), dtype=np.uint8)
+        dates = np.array([r[0] + r[1]*1e-6 for r in rows])
+        linktypes = np.array([r[2] for r in rows], dtype=np.int64)
+        yield buf, dates, linktypes, np.cumsum(lengths) - lengths, lengths
+
+def read_kismet_probes(path):
+    '''returns the columns of the probe requests of the packets of a kismet db, see
+    _probe_columns'''
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    c = conn.cursor()
+    sql = 'pragma query_only = on;'
+    c.execute(sql)
+    try:
+        c.execute("select ts_sec, ts_usec, dlt, packet from packets where phyname='IEEE802.11'")
+        return _probe_columns(_kismet_chunks(c))
+    except sqlite3.DatabaseError as e:
+        raise PcapError(f'{path} is not a kismet db: {e}')
+    finally:
+        conn.close()
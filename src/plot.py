@@ -2,30 +2,29 @@
 
 from datetime import datetime
 import time
-from cycler import cycler
-import matplotlib
-#matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-import matplotlib.patches as mpatches
 import argparse
+import multiprocessing
 import sqlite3
 import sys
 import os.path
 import os
-import re
-from scapy.all import sniff
-from scapy.layers import dot11
+import numpy as np
 
-IS_WINDOW_OPENED = False
 NUMOFSECSINADAY = 60*60*24
 # standard colors without red and gray
 COLORS = ['tab:blue', 'tab:orange', 'tab:green', 'tab:purple', 'tab:brown', 'tab:pink', 'tab:olive', 'tab:cyan']
 REFRESH_TIME = 60 # in seconds
+# read connections of a process of the batch mode, by db
+CONNECTIONS = {}
 
 # read config variable from config.py file
 import config
-config.MERGED = (m[:8] for m in config.MERGED)
+import analytics
+import archive
+import pcapfile
+from db import check_version, VersionError
+from stats import add_arg, build_sql_where, last_rowid, load_probes, mac_regex
+config.MERGED = tuple(m[:8] for m in config.MERGED)
 
 # draws a rectangle as custom legend handler
 class MyLine2DHandler(object):
@@ -36,295 +35,555 @@ class MyLine2DHandler(object):
         handlebox.add_artist(patch)
         return patch
 
+def import_matplotlib(backend=None):
+    '''import matplotlib, only when there is something to plot, and with backend
+    instead of the default one: an interactive one is only needed for a window'''
+    global matplotlib, plt, ticker, mpatches, LineCollection, PolyCollection, cycler
+    import matplotlib
+    if backend is not None:
+        matplotlib.use(backend)
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+    import matplotlib.patches as mpatches
+    from matplotlib.collections import LineCollection, PolyCollection
+    from cycler import cycler
+
 def is_local_bit_set(mac):
     byte = mac.split(':')
     return int(byte[0], 16) & 0b00000010 == 0b00000010
 
+def probes_from_codes(dates, mac, names):
+    '''returns the timestamps of mac, codes in the list of names, as analytics.Probes'''
+    laa = [is_local_bit_set(m) for m in names]
+    zeros = np.zeros(len(dates), dtype=np.int64)
+    return analytics.Probes(dates, mac, zeros, zeros, analytics.MacTable(names, ['']*len(names), laa), [''])
+
+def open_db(path):
+    '''returns a read only connection to the db and its cursor, or raises VersionError'''
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    c = conn.cursor()
+    sql = 'pragma query_only = on;'
+    c.execute(sql)
+    sql = 'pragma temp_store = 2;' # to store temp table and indices in memory
+    c.execute(sql)
+    sql = 'pragma journal_mode = off;' # disable journal for rollback (we don't use this)
+    c.execute(sql)
+    conn.commit()
+
+    try:
+        check_version(c)
+    except VersionError:
+        conn.close()
+        raise
+    return conn, c
+
+class LiveProbes:
+    '''probe requests of the db in the time window, kept in memory and updated with
+    the rows added to the probemon table since the last poll, like stats.Watcher.
+    The rows older than the window are dropped, only the time and mac are kept'''
+    def __init__(self, c, after, before, macs, rssi):
+        self.c = c
+        self.before = before
+        self.rssi = rssi
+        self.regex = mac_regex(macs) if macs else None
+        # the rows added while loading are read by the first poll
+        self.version = self.data_version()
+        self.last_rowid = last_rowid(c)
+        probes = load_probes(c, after, before, macs, rssi, False)
+        self.first = probes.first
+        self.mac = probes.mac
+        self.names = probes.macs.names
+        self.vendors = probes.macs.vendors
+        self.laa = probes.macs.laa
+        # load_macs only reads the mac matching the filters
+        self.selected = self.names != ''
+        # rowid and last date after the load, see poll
+        self.loaded = (last_rowid(c), self.first[-1]) if len(self.first) else None
+
+    def data_version(self):
+        self.c.execute('pragma data_version')
+        return self.c.fetchone()[0]
+
+    def lookup(self, mac_ids):
+        '''read the mac added to the db since the last lookup, and filter them'''
+        size = int(mac_ids.max()) + 1 if len(mac_ids) else 0
+        n = len(self.names)
+        if size <= n:
+            return
+        names = np.full(size-n, '', dtype=object)
+        vendors = np.full(size-n, '', dtype=object)
+        laa = np.zeros(size-n, dtype=bool)
+        sql = '''select mac.id,mac.address,vendor.name,mac.laa from mac
+        inner join vendor on vendor.id=mac.vendor where mac.id>=? and mac.id<?'''
+        self.c.execute(sql, (n, size))
+        for mac_id, address, vendor, flag in self.c.fetchall():
+            names[mac_id-n] = address
+            vendors[mac_id-n] = vendor
+            laa[mac_id-n] = flag
+        selected = names != ''
+        if self.regex is not None:
+            selected &= np.array([self.regex.match(m) is not None for m in names.tolist()], dtype=bool)
+        self.names = np.concatenate((self.names, names))
+        self.vendors = np.concatenate((self.vendors, vendors))
+        self.laa = np.concatenate((self.laa, laa))
+        self.selected = np.concatenate((self.selected, selected))
+
+    def poll(self, after):
+        '''drop the rows before after, and add the rows inserted since the last poll.
+        Returns the number of probe requests added. Nothing is read while the data
+        version of the db is unchanged'''
+        # the rows are sorted by time
+        start = np.searchsorted(self.first, after, side='right')
+        self.first, self.mac = self.first[start:], self.mac[start:]
+        version = self.data_version()
+        if version == self.version:
+            return 0
+        self.version = version
+        # the new rows are read by rowid, not by date: the probe log, merge.py and
+        # ingest.py insert rows older than the last ones. Unlike load_probes, all the
+        # mac are read, as new ones can match the filters
+        sql_where, sql_args = build_sql_where(after, self.before, None, self.rssi, False)
+        sql_where = add_arg(sql_where, 'and', 'probemon.rowid>?') if sql_where else 'where probemon.rowid>?'
+        self.c.execute(f'select rowid,date,mac from probemon not indexed {sql_where}', sql_args + [self.last_rowid])
+        rows = self.c.fetchall()
+        if len(rows) == 0:
+            return 0
+        rowid = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        dates = np.fromiter((r[1] for r in rows), dtype=np.float64, count=len(rows))
+        mac = np.fromiter((r[2] for r in rows), dtype=np.int64, count=len(rows))
+        self.last_rowid = int(rowid.max())
+        self.lookup(mac)
+        keep = self.selected[mac]
+        if self.loaded is not None:
+            # the rows inserted while loading may have been loaded: as before, the ones
+            # not later than the last row loaded are skipped
+            loaded, last = self.loaded
+            keep &= (rowid > loaded) | (dates > last)
+            self.loaded = None
+        self.first = np.concatenate((self.first, dates[keep]))
+        self.mac = np.concatenate((self.mac, mac[keep]))
+        if np.any(np.diff(self.first) < 0):
+            # the late rows are moved to their place in time
+            order = np.argsort(self.first, kind='stable')
+            self.first, self.mac = self.first[order], self.mac[order]
+        return int(keep.sum())
+
+    def probes(self):
+        '''returns the rows as analytics.Probes, on a copy of the mac table as mac
+        are merged into it'''
+        zeros = np.zeros(len(self.first), dtype=np.int64)
+        table = analytics.MacTable(self.names, self.vendors, self.laa)
+        return analytics.Probes(self.first, self.mac, zeros, zeros, table, [''])
+
 def get_data(args):
-    ts = {}
     if args.pcap:
         if args.verbose:
             print(f':: Processing pcap file {args.pcap}')
-        if args.only_pr:
-            packets = sniff(offline=args.pcap, verbose=0, filter='wlan type mgt subtype probe-req')
-        else:
-            packets = sniff(offline=args.pcap, verbose=0)
-        for packet in packets:
-            if packet.addr2 in config.IGNORED:
-                continue
-
-            if packet.addr2 in ts:
-                ts[packet.addr2].append(packet.time)
-            else:
-                ts[packet.addr2] = [packet.time]
+        # the packets are streamed, only their time and addr2 are read
+        try:
+            dates, values = pcapfile.read_addr2(args.pcap, args.only_pr)
+        except pcapfile.PcapError as e:
+            print(f'Error: {e}', file=sys.stderr)
+            sys.exit(-1)
+        values, mac = np.unique(values, return_inverse=True)
+        probes = probes_from_codes(dates, mac, pcapfile.mac_names(values))
+        ignored = np.isin(probes.macs.names, config.IGNORED)
+        probes = probes.select(~ignored[probes.mac])
     elif args.kismet:
         if args.verbose:
             print(f':: Processing kismet file {args.kismet}')
-        # sqlite3
-        conn = sqlite3.connect(f'file:{args.kismet}?mode=ro', uri=True)
-        c = conn.cursor()
-        sql = 'pragma query_only = on;'
-        c.execute(sql)
-        sql = 'pragma temp_store = 2;' # to store temp table and indices in memory
-        c.execute(sql)
-        sql = 'pragma journal_mode = off;' # disable journal for rollback (we don't use this)
-        c.execute(sql)
-        conn.commit()
-
-        sql = 'select ts_sec, ts_usec, lower(sourcemac), lower(destmac), packet from packets where phyname="IEEE802.11";'
-        c.execute(sql)
-        for row in c.fetchall():
-            if args.only_pr:
-                # keep only the probe request
-                packet = dot11.RadioTap(row[4])
-                if packet.type != 0 or packet.subtype != 4:
-                    continue
-            if row[2] in ts:
-                ts[row[2]].append(row[0])
-            else:
-                ts[row[2]] = [row[0]]
-            # filter out multicast mac addresses. TODO: use the exact range 00:00:00-7f:ff:ff
-            if row[3] in ts and not row[3].startswith('01:00:5e'):
-                ts[row[3]].append(row[0])
-            else:
-                ts[row[3]] = [row[0]]
+        # the rows are streamed, the devices are filtered by the db
         try:
-            del ts['ff:ff:ff:ff:ff:ff']
-            del ts['00:00:00:00:00:00']
-        except KeyError as k:
-            pass
-        # filter to keep only wifi client and device
-        sql = 'select lower(devmac),type from devices'
-        c.execute(sql)
-        for row in c.fetchall():
-            if row[1] not in ['Wi-Fi Device','Wi-Fi Client']:
-                try:
-                    del ts[row[0]]
-                except KeyError as k:
-                    pass
-        conn.close()
+            dates, mac, names = pcapfile.read_kismet(args.kismet, args.only_pr)
+        except pcapfile.PcapError as e:
+            print(f'Error: {e}', file=sys.stderr)
+            sys.exit(-1)
+        probes = probes_from_codes(dates, mac, names)
     else:
         # sqlite3
-        conn = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
-        c = conn.cursor()
-        sql = 'pragma query_only = on;'
-        c.execute(sql)
-        sql = 'pragma temp_store = 2;' # to store temp table and indices in memory
-        c.execute(sql)
-        sql = 'pragma journal_mode = off;' # disable journal for rollback (we don't use this)
-        c.execute(sql)
-        conn.commit()
-
+        try:
+            conn, c = open_db(args.db)
+        except VersionError as v:
+            print(f'Error: {v}', file=sys.stderr)
+            sys.exit(-1)
         # keep only the data between 2 timestamps ignoring IGNORED macs with rssi
         # greater than the min value
-        arg_list = ','.join(['?']*len(config.IGNORED))
-        sql = '''select date,mac.address,rssi from probemon
-            inner join mac on mac.id=probemon.mac
-            where date <= ? and date >= ?
-            and mac.address not in (%s)
-            and rssi > ?
-            order by date''' % (arg_list,)
-        try:
-            c.execute(sql, (args.end_time, args.start_time) + config.IGNORED + (args.rssi,))
-        except sqlite3.OperationalError as e:
-            time.sleep(2)
-            c.execute(sql, (args.end_time, args.start_time) + config.IGNORED + (args.rssi,))
-        for row in c.fetchall():
-            if row[1] in ts:
-                ts[row[1]].append(row[0])
-            else:
-                ts[row[1]] = [row[0]]
+        probes = load_probes(c, args.start_time, args.end_time, args.mac, args.rssi, False)
         conn.close()
-
-    def match(m, s):
-        # match on start of mac address and use % as wild-card like in SQL syntax
-        if '%' in m:
-            m = m.replace('%', '.*')
-        else:
-            m = m+'.*'
-        m = '^'+m
-        return re.search(m, s) is not None
-
-    if None in ts.keys():
-        del ts[None]
-    macs = list(ts.keys())
-    if args.mac :
-        # keep mac with args.mac as substring
-        macs = [m for m in list(ts.keys()) if any(match(am.lower(), m) for am in args.mac)]
-
-    # filter our data set based on min probe request or mac appearence
-    for k,v in list(ts.items()):
-        if (len(v) <= args.min and k not in args.knownmac) or k not in macs:
-            del ts[k]
-
-    # sort the data on frequency of appearence
-    data = sorted(list(ts.items()), key=lambda x:len(x[1]))
-    data.reverse()
-    macs = [x for x,_ in data]
-    times = [x for _,x in data]
+    return select_data(probes, args)
+
+def select_data(probes, args):
+    '''returns the mac to plot, and the dates and rows of their probe requests'''
+    # keep mac with args.mac as substring, and filter our data set based on min
+    # probe request or mac appearence
+    # the db only returns the matching mac, but virtual mac and the mac of the
+    # pcap and kismet files are matched here
+    names = probes.macs.names.tolist()
+    count = np.bincount(probes.mac, minlength=len(names))
+    keep = (count > args.min) | np.array([m in args.knownmac for m in names], dtype=bool)
+    keep &= count > 0
+    if args.mac:
+        regex = mac_regex(args.mac)
+        keep &= np.array([regex.match(m) is not None for m in names], dtype=bool)
+    probes = probes.select(keep[probes.mac])
 
     # merge all LAA mac into one plot for a virtual MAC called 'LAA'
     if args.privacy:
-        indx = [i for i,m in enumerate(macs) if is_local_bit_set(m)]
-        if len(indx) > 0:
-            t = []
-            # merge all times for LAA macs
-            for i in indx:
-                t.extend(times[i])
-            macs = [m for i,m in enumerate(macs) if i not in indx]
-            times = [x for i,x in enumerate(times) if i not in indx]
-            macs.append('LAA')
-            times.append(sorted(t))
+        probes.merge_laa()
 
     # merge all same vendor mac into one plot for a virtual MAC called 'OUI'
-    for mv in config.MERGED:
-        indx = [i for i,m in enumerate(macs) if m[:8] == mv]
-        if len(indx) > 0:
-            t = []
-            # merge all times for vendor macs
-            for i in indx:
-                t.extend(times[i])
-            macs = [m for i,m in enumerate(macs) if i not in indx]
-            times = [x for i,x in enumerate(times) if i not in indx]
-            macs.append(mv)
-            times.append(sorted(t))
-
-    return (macs, times)
-
-def plot_data(macs, times, args):
-    global IS_WINDOW_OPENED
-
-    # initialize plot
-    if IS_WINDOW_OPENED:
-        plt.close('all')
-    fig, ax = plt.subplots()
-    # change margin around axis to the border
-    fig.subplots_adjust(left=0.05, right=0.95, top=0.95, bottom=0.07)
-    # set our custom color cycler (without red and gray)
-    ax.set_prop_cycle(cycler('color', COLORS))
-
-    # calculate size of marker given the number of macs to display and convert from inch to point
-    markersize = (fig.get_figheight()/len(macs))*72
-    # set default line style for the plot
-    matplotlib.rc('lines', linestyle=':', linewidth=0.3, marker='|', markersize=markersize)
-    # plot
-    lines = []
-    for i,p in enumerate(times):
-        # reverse order to get most frequent at top
-        n = len(times)-i-1
-        # constant value
-        q = [n]*len(p)
-        label = macs[i]
-        if macs[i] in args.knownmac:
-            line, = ax.plot(p, q, color='tab:red', label=label)
-        elif macs[i] == 'LAA' or is_local_bit_set(macs[i]):
-            if macs[i] != 'LAA':
-                label = '%s (LAA)' % macs[i]
-            line, = ax.plot(p, q, color='tab:gray', label=label)
+    real = len(probes.macs)
+    probes.merge_oui(config.MERGED)
+
+    # sort the data on frequency of appearence, the merged vendor macs last
+    count = np.bincount(probes.mac, minlength=len(probes.macs))
+    first = np.full(len(probes.macs), np.inf)
+    np.minimum.at(first, probes.mac, probes.first)
+    keys = np.flatnonzero(count)
+    order = np.lexsort((first[keys], count[keys]))[::-1]
+    codes = keys[order]
+    codes = codes[codes < real].tolist()
+    merged = keys[keys >= real]
+    codes += [c for m in config.MERGED for c in merged.tolist() if probes.macs.names[c] == m]
+    macs = probes.macs.names[codes].tolist()
+    # the row of each probe request is the rank of its mac
+    rank = np.full(len(probes.macs), -1)
+    rank[codes] = np.arange(len(codes))
+    rows = rank[probes.mac]
+    mask = rows >= 0
+
+    return (macs, probes.first[mask], rows[mask])
+
+class Timeline:
+    '''figure of the probe requests of each mac. Its artists are created once, and
+    updated in place with new data'''
+    def __init__(self, args):
+        self.args = args
+        self.macs = []
+        fig, ax = plt.subplots()
+        self.fig, self.ax = fig, ax
+        # change margin around axis to the border
+        fig.subplots_adjust(left=0.05, right=0.95, top=0.95, bottom=0.07)
+        # set our custom color cycler (without red and gray)
+        ax.set_prop_cycle(cycler('color', COLORS))
+
+        if args.image:
+            fig.set_size_inches(config.HEIGHT/config.DPI, config.WIDTH/config.DPI)
+            fig.set_dpi(config.DPI)
+
+        # the ticks of the mac of each color, a dotted line from the first to the last
+        # probe request of each mac, and a grey background on the periods without data
+        self.ticks = {}
+        for color in ['tab:red', 'tab:gray'] + COLORS:
+            self.ticks[color] = ax.add_line(matplotlib.lines.Line2D([], [], color=color, linewidth=1.0,
+                solid_capstyle='butt'))
+        self.spans = ax.add_collection(LineCollection([], linewidths=0.3, linestyles=':'))
+        self.gaps = ax.add_collection(PolyCollection([], transform=ax.get_xaxis_transform(),
+            facecolor='#bbbbbb', edgecolor='none', alpha=0.5))
+        self.labels = []
+        self.legend = None
+
+        # define helper function for labels and ticks
+        def showdate(tick, pos):
+            return time.strftime('%Y-%m-%d', time.localtime(tick))
+        def showtime(tick, pos):
+            return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(tick))
+        def showhourminute(tick, pos):
+            return time.strftime('%H:%M', time.localtime(tick))
+        def showhour(tick, pos):
+            return time.strftime('%Hh', time.localtime(tick))
+        def showmac(tick, pos):
+            try:
+                m = self.macs[len(self.macs)-int(round(tick))-1]
+                if m != 'LAA' and is_local_bit_set(m):
+                    m = '%s (LAA)' % m
+                return m
+            except IndexError:
+                pass
+
+        ## customize the appearence of our figure/plot
+        ax.xaxis.set_remove_overlapping_locs(False)
+        # customize label of major/minor ticks
+        ax.xaxis.set_major_formatter(ticker.FuncFormatter(showdate))
+        if args.span == 'd':
+            # show minor tick every hour
+            ax.xaxis.set_minor_formatter(ticker.FuncFormatter(showhour))
+            ax.xaxis.set_minor_locator(ticker.MultipleLocator(60*60))
+        elif args.span == 'h':
+            # show minor tick every x minutes
+            ax.xaxis.set_minor_formatter(ticker.FuncFormatter(showhourminute))
+            h = args.span_time//3600
+            sm = 10*60
+            if h > 2:
+                sm = 15*60
+            if h > 6:
+                sm = 30*60
+            if h > 12:
+                sm = 60*60
+            ax.xaxis.set_minor_locator(ticker.MultipleLocator(sm))
+        elif args.span == 'm':
+            # show minor tick every 5 minutes
+            ax.xaxis.set_minor_formatter(ticker.FuncFormatter(showhourminute))
+            ax.xaxis.set_minor_locator(ticker.MultipleLocator(5*60))
+
+        # show only integer evenly spaced on y axis
+        #ax.yaxis.set_major_locator(ticker.MaxNLocator(integer=True, steps=[1,2,4,5,10]))
+        # don't draw y axis
+        ax.yaxis.set_visible(False)
+        # move down major tick labels not to overwrite minor tick labels and do not show major ticks
+        ax.xaxis.set_tick_params(which='major', pad=15, length=0)
+        # customize the label shown on mouse over
+        ax.format_xdata = ticker.FuncFormatter(showtime)
+        ax.format_ydata = ticker.FuncFormatter(showmac)
+        # show vertical bars matching minor ticks
+        ax.grid(True, axis='x', which='minor')
+        # add a title to the image
+        self.title = None
+        if args.title is not None:
+            self.title = fig.text(0.49, 0.97, args.title, fontsize=8, alpha=0.2)
+
+    def update(self, macs, dates, rows):
+        '''plot the probe requests at dates, in the rows of index in macs'''
+        args = self.args
+        fig, ax = self.fig, self.ax
+        space = 5*60 # 5 minutes
+        xmin, xmax = args.start_time-space, args.end_time+space
+
+        # the color and label of each mac, the most frequent at top
+        n = len(macs)
+        row = np.arange(n-1, -1, -1)
+        colors = []
+        labels = []
+        k = 0
+        for m in macs:
+            label = m
+            if m in args.knownmac:
+                color = 'tab:red'
+            elif m == 'LAA' or is_local_bit_set(m):
+                if m != 'LAA':
+                    label = '%s (LAA)' % m
+                color = 'tab:gray'
+            else:
+                # the color cycle only goes on for the other mac
+                color = COLORS[k % len(COLORS)]
+                k += 1
+            colors.append(color)
+            labels.append(label)
+        colors = np.array(colors, dtype=object)
+
+        # the probe requests of a mac are binned to the pixels of the axes: a single
+        # tick is drawn per mac and pixel, whatever the number of probe requests. The
+        # bins are aligned on multiples of their width, so that the ticks do not move
+        # when the window slides in continuous mode
+        pixels = max(int(fig.get_figwidth()*fig.dpi*(fig.subplotpars.right-fig.subplotpars.left)), 1)
+        width = (xmax-xmin)/pixels
+        bins = np.floor_divide(dates, width).astype(np.int64)
+        low = bins.min() if len(bins) else 0
+        span = bins.max() - low + 1 if len(bins) else 1
+        codes, bins = np.divmod(np.unique(rows*span + bins - low), span)
+        x = (bins + low + 0.5)*width
+        # the ticks of a color are drawn as a single line broken by NaN values, which
+        # is much cheaper than a collection of segments
+        palette = list(self.ticks)
+        index = np.array([palette.index(c) for c in colors.tolist()], dtype=np.int64)[codes]
+        nan = np.full(len(x), np.nan)
+        for i, line in enumerate(self.ticks.values()):
+            mask = index == i
+            line.set_data(np.column_stack((x[mask], x[mask], nan[mask])).ravel(),
+                np.column_stack((row[codes[mask]]-0.5, row[codes[mask]]+0.5, nan[mask])).ravel())
+        first = np.full(n, np.inf)
+        last = np.full(n, -np.inf)
+        np.minimum.at(first, rows, dates)
+        np.maximum.at(last, rows, dates)
+        self.spans.set_segments(np.stack((np.column_stack((first, row)), np.column_stack((last, row))), axis=1))
+        self.spans.set_color(colors.tolist())
+
+        # the periods greater than 15 minutes without data, as rectangles spanning
+        # the height of the axes
+        alltimes = np.sort(dates)
+        gaps = np.flatnonzero(np.diff(alltimes) > 60*15)
+        x0, x1 = alltimes[gaps], alltimes[gaps+1]
+        self.gaps.set_verts(np.stack((np.column_stack((x0, np.zeros(len(gaps)))), np.column_stack((x0, np.ones(len(gaps)))),
+            np.column_stack((x1, np.ones(len(gaps)))), np.column_stack((x1, np.zeros(len(gaps))))), axis=1))
+
+        # the labels and legend only change with the list of mac
+        if macs != self.macs:
+            self.macs = macs
+            for text in self.labels:
+                text.remove()
+            self.labels = []
+            if args.label:
+                for label, r in zip(labels, row.tolist()):
+                    self.labels.append(ax.text(args.end_time, r, label, fontsize=8, color='black',
+                        horizontalalignment='right', verticalalignment='center', family='monospace'))
+            if self.legend is not None:
+                self.legend.remove()
+                self.legend = None
+            # add a legend
+            if args.legend:
+                # add a custom label handler to draw rectangle instead of default line style
+                lines = [matplotlib.lines.Line2D([], [], color=c) for c in colors.tolist()]
+                self.legend = ax.legend(lines, macs, loc='lower left', ncol=len(macs)//30+1,
+                    handler_map={matplotlib.lines.Line2D: MyLine2DHandler()}, prop={'family':'monospace', 'size':8})
         else:
-            line, = ax.plot(p, q, label=label)
-        if args.label:
-            ax.text(args.end_time, q[-1], label, fontsize=8, color='black', horizontalalignment='right', verticalalignment='center', family='monospace')
-        lines.append(line)
-
-    # add a grey background on period greater than 15 minutes without data
-    alltimes = []
-    for t in times:
-       alltimes.extend(t)
-    alltimes.sort()
-    diff = [i for i,j in enumerate(zip(alltimes[:-1], alltimes[1:])) if (j[1]-j[0])>60*15]
-    for i in diff:
-        ax.axvspan(alltimes[i], alltimes[i+1], facecolor='#bbbbbb', alpha=0.5)
-
-    # define helper function for labels and ticks
-    def showdate(tick, pos):
-        return time.strftime('%Y-%m-%d', time.localtime(tick))
-    def showtime(tick, pos):
-        return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(tick))
-    def showhourminute(tick, pos):
-        return time.strftime('%H:%M', time.localtime(tick))
-    def showhour(tick, pos):
-        return time.strftime('%Hh', time.localtime(tick))
-    def showmac(tick, pos):
-        try:
-            m = macs[len(times)-int(round(tick))-1]
-            if m != 'LAA' and is_local_bit_set(m):
-                m = '%s (LAA)' % m
-            return m
-        except IndexError:
-            pass
-
-    ## customize the appearence of our figure/plot
-    ax.xaxis.set_remove_overlapping_locs(False)
-    # customize label of major/minor ticks
-    ax.xaxis.set_major_formatter(ticker.FuncFormatter(showdate))
-    if args.span == 'd':
-        # show minor tick every hour
-        ax.xaxis.set_minor_formatter(ticker.FuncFormatter(showhour))
-        ax.xaxis.set_minor_locator(ticker.MultipleLocator(60*60))
-    elif args.span == 'h':
-        # show minor tick every x minutes
-        ax.xaxis.set_minor_formatter(ticker.FuncFormatter(showhourminute))
-        h = args.span_time//3600
-        sm = 10*60
-        if h > 2:
-            sm = 15*60
-        if h > 6:
-            sm = 30*60
-        if h > 12:
-            sm = 60*60
-        ax.xaxis.set_minor_locator(ticker.MultipleLocator(sm))
-    elif args.span == 'm':
-        # show minor tick every 5 minutes
-        ax.xaxis.set_minor_formatter(ticker.FuncFormatter(showhourminute))
-        ax.xaxis.set_minor_locator(ticker.MultipleLocator(5*60))
-
-    # show only integer evenly spaced on y axis
-    #ax.yaxis.set_major_locator(ticker.MaxNLocator(integer=True, steps=[1,2,4,5,10]))
-    # don't draw y axis
-    ax.yaxis.set_visible(False)
-    # move down major tick labels not to overwrite minor tick labels and do not show major ticks
-    ax.xaxis.set_tick_params(which='major', pad=15, length=0)
-    # customize the label shown on mouse over
-    ax.format_xdata = ticker.FuncFormatter(showtime)
-    ax.format_ydata = ticker.FuncFormatter(showmac)
-    # show vertical bars matching minor ticks
-    ax.grid(True, axis='x', which='minor')
-    # add a legend
-    if args.legend:
-        # add a custom label handler to draw rectangle instead of default line style
-        ax.legend(lines, macs, loc='lower left', ncol=len(macs)//30+1,
-            handler_map={matplotlib.lines.Line2D: MyLine2DHandler()}, prop={'family':'monospace', 'size':8})
-    # avoid too much space around our data by defining set
-    space = 5*60 # 5 minutes
-    ax.set_xlim(args.start_time-space, args.end_time+space)
-    ax.set_ylim(-1, len(macs))
-    # add a title to the image
-    if args.title is not None:
-        if args.title == '':
+            for text in self.labels:
+                text.set_x(args.end_time)
+        # avoid too much space around our data by defining set
+        ax.set_xlim(xmin, xmax)
+        ax.set_ylim(-1, len(macs))
+        # if none specified, the title is the time of the last change of the db
+        if self.title is not None and args.title == '':
             ts = time.localtime(os.stat(args.db).st_mtime)
-            title = time.strftime('%Y-%m-%d %H:%M:%S', ts)
-        else:
-            title = args.title
-        fig.text(0.49, 0.97, title, fontsize=8, alpha=0.2)
+            self.title.set_text(time.strftime('%Y-%m-%d %H:%M:%S', ts))
+
+    def save(self, metadata=None):
+        self.fig.savefig(self.args.image, dpi=config.DPI, metadata=metadata)
+        #fig.savefig('test.svg', format='svg')
 
+def plot_data(macs, dates, rows, args):
+    '''plot the probe requests at dates, in the rows of index in macs'''
+    timeline = Timeline(args)
+    timeline.update(macs, dates, rows)
     # and tada !
     if args.image:
-        fig.set_size_inches(config.HEIGHT/config.DPI, config.WIDTH/config.DPI)
-        fig.savefig(args.image, dpi=config.DPI)
-        #fig.savefig('test.svg', format='svg')
+        timeline.save()
     else:
-        if IS_WINDOW_OPENED:
-            fig.canvas.draw_idle()
-        else:
-            plt.show()
-            IS_WINDOW_OPENED = True
+        plt.show()
+
+def read_jobs(args):
+    '''returns the args of each job of the batch file: a line of db, start, span of
+    time and image, the other options are the ones of the command line'''
+    jobs = []
+    with open(args.batch) as f:
+        for n, line in enumerate(f, 1):
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith('#'):
+                continue
+            if len(fields) != 4:
+                print(f'Error: {args.batch}:{n}: expected db, start, span of time and image', file=sys.stderr)
+                sys.exit(-1)
+            job = argparse.Namespace(**vars(args))
+            job.db, job.start, span, job.image = fields
+            if not os.path.exists(job.db):
+                print(f'Error: {args.batch}:{n}: file not found {job.db}', file=sys.stderr)
+                sys.exit(-1)
+            try:
+                job.span_time, job.span = parse_span(span)
+                job.start_time = parse_start(job.start)
+            except ValueError as e:
+                print(f'Error: {args.batch}:{n}: {e}', file=sys.stderr)
+                sys.exit(-1)
+            job.end_time = job.start_time + job.span_time
+            jobs.append(job)
+    return jobs
+
+def batch_key(c, args):
+    '''returns the key of the image of a job: the last date and the number of the rows
+    in its span of time, the range and number of rows of its archived blocks, and the
+    options of the plot'''
+    c.execute('select max(date), count(*) from probemon where date>? and date<?', (args.start_time, args.end_time))
+    rows = c.fetchone()
+    blocks = archive.block_ranges(c, args.start_time, args.end_time)
+    options = sorted((k, v) for k, v in vars(args).items() if k not in ('batch', 'jobs', 'verbose'))
+    return repr((rows, blocks, options, config.MERGED, config.IGNORED))
+
+def image_key(path):
+    '''returns the key an image was rendered with, None if there is no such image'''
+    from PIL import Image
+    try:
+        with Image.open(path) as image:
+            return image.info.get('Comment')
+    except OSError:
+        return None
+
+def render(args):
+    '''render the image of a job, unless it was already rendered from the same rows.
+    Returns the image, whether it was rendered, an error and the time spent. It
+    runs in the processes of the pool, which keep their connections to the dbs'''
+    start = time.monotonic()
+    try:
+        try:
+            conn, c = CONNECTIONS[args.db]
+        except KeyError:
+            conn, c = CONNECTIONS[args.db] = open_db(args.db)
+        key = batch_key(c, args)
+        if image_key(args.image) == key:
+            return args.image, False, None, time.monotonic() - start
+        probes = load_probes(c, args.start_time, args.end_time, args.mac, args.rssi, False)
+    except (sqlite3.Error, VersionError) as e:
+        return args.image, False, str(e), time.monotonic() - start
+    macs, dates, rows = select_data(probes, args)
+    if len(dates) == 0 or len(macs) == 0:
+        return args.image, False, 'nothing to plot', time.monotonic() - start
+    # already imported unless the processes of the pool are not forked
+    import_matplotlib('Agg')
+    timeline = Timeline(args)
+    timeline.update(macs, dates, rows)
+    timeline.save({'Comment': key})
+    plt.close(timeline.fig)
+    return args.image, True, None, time.monotonic() - start
+
+def batch(args):
+    '''render the images of the jobs of the batch file with a pool of processes'''
+    jobs = read_jobs(args)
+    if len(jobs) == 0:
+        return
+    # the processes of the pool are forked with matplotlib already imported
+    import_matplotlib('Agg')
+    start = time.monotonic()
+    count = 0
+    pool = multiprocessing.Pool(min(args.jobs, len(jobs))) if args.jobs > 1 else None
+    try:
+        # the images are reported as soon as they are rendered, in any order
+        results = pool.imap_unordered(render, jobs) if pool is not None else map(render, jobs)
+        for n, (image, rendered, error, elapsed) in enumerate(results, 1):
+            if error is not None:
+                print(f'Error: [{n}/{len(jobs)}] {image}: {error}', file=sys.stderr)
+            elif rendered:
+                count += 1
+                print(f':: [{n}/{len(jobs)}] {image}: rendered in {elapsed:.2f}s')
+            elif args.verbose:
+                print(f':: [{n}/{len(jobs)}] {image}: unchanged')
+    finally:
+        if pool is not None:
+            pool.terminate()
+    print(f':: Rendered {count} of {len(jobs)} images in {time.monotonic()-start:.2f}s')
+
+def parse_span(text):
+    '''returns the number of seconds of a span of time of the form #d, ##h or ###m,
+    and its unit'''
+    span = text[-1:]
+    try:
+        sp = int(text[:-1])
+    except ValueError:
+        raise ValueError('--span-time argument should be of the form [digit]...[d|h|m]')
+    if span == 'd':
+        return sp*NUMOFSECSINADAY, span
+    elif span == 'h':
+        return sp*60*60, span
+    elif span == 'm':
+        return sp*60, span
+    raise ValueError('--span-time postfix could only be d or h or m')
+
+def parse_start(text):
+    '''returns the timestamp of a date (at noon) or of a timestamp without seconds'''
+    try:
+        return time.mktime(time.strptime(text, '%Y-%m-%dT%H:%M'))
+    except ValueError:
+        try:
+            date = time.strptime(text, '%Y-%m-%d')
+            date = time.strptime('%sT12:00' % text, '%Y-%m-%dT%H:%M')
+            return time.mktime(date)
+        except ValueError:
+            raise ValueError("can't parse date timestamp")
 
 def main():
     parser = argparse.ArgumentParser(description='Plot MAC presence from probe requests in the database')
     parser.add_argument('-b', '--db', default='probemon.db', help='file name of the db')
+    parser.add_argument('--batch', help='file of jobs to render, a line of db, start, span of time and image')
     parser.add_argument('-c', '--continuous', action='store_true', default=False, help='continously update the plot/image (every minute)')
     parser.add_argument('-i', '--image', default=None, const='plot.png', nargs='?', help='output an image')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of processes rendering the images of --batch')
     parser.add_argument('-l', '--legend', action='store_true', default=False, help='add a legend')
     parser.add_argument('--label', action='store_true', default=False, help='add a mac label for each plot')
     parser.add_argument('-k', '--knownmac', action='append', help='known mac to highlight in red')
@@ -342,53 +601,48 @@ def main():
     # RESERVED: span, start_time, end_time
     args = parser.parse_args()
 
-    # TODO: fix that
-    if args.continuous:
-        if not args.image:
-            print('Error: --continuous does not currently work without using an image. Please use -i/--image')
-            sys.exit(-1)
-        if args.pcap:
-            print('Error: --continuous does not work with --pcap')
-            sys.exit(-1)
+    if args.continuous and args.pcap:
+        print('Error: --continuous does not work with --pcap')
+        sys.exit(-1)
 
-    # parse span_time
-    args.span = args.span_time[-1:]
     try:
-        sp = int(args.span_time[:-1])
-    except ValueError:
-        print('Error: --span-time argument should be of the form [digit]...[d|h|m]')
-        sys.exit(-1)
-    if args.span == 'd':
-        args.span_time = sp*NUMOFSECSINADAY
-    elif args.span == 'h':
-        args.span_time = sp*60*60
-    elif args.span == 'm':
-        args.span_time = sp*60
-    else:
-        print('Error: --span-time postfix could only be d or h or m')
+        args.span_time, args.span = parse_span(args.span_time)
+    except ValueError as e:
+        print(f'Error: {e}', file=sys.stderr)
         sys.exit(-1)
 
     if args.knownmac is None:
         args.knownmac = config.KNOWNMAC
 
+    if args.batch:
+        if args.continuous or args.pcap or args.kismet:
+            print('Error: --batch does not work with --continuous, --pcap or --kismet', file=sys.stderr)
+            sys.exit(-1)
+        if args.jobs < 1:
+            print('Error: --jobs must be at least 1', file=sys.stderr)
+            sys.exit(-1)
+        if not os.path.exists(args.batch):
+            print(f'Error: batch file not found {args.batch}', file=sys.stderr)
+            sys.exit(-1)
+        batch(args)
+        return
+
     if args.pcap and not os.path.exists(args.pcap):
         print(f'Error: pcap file not found {args.pcap}', file=sys.stderr)
         sys.exit(-1)
+    if args.kismet and not os.path.exists(args.kismet):
+        print(f'Error: kismet file not found {args.kismet}', file=sys.stderr)
+        sys.exit(-1)
     if not os.path.exists(args.db):
         print(f'Error: file not found {args.db}', file=sys.stderr)
         sys.exit(-1)
 
     if args.start:
         try:
-            start_time = time.mktime(time.strptime(args.start, '%Y-%m-%dT%H:%M'))
-        except  ValueError:
-            try:
-                date = time.strptime(args.start, '%Y-%m-%d')
-                date = time.strptime('%sT12:00' % args.start, '%Y-%m-%dT%H:%M')
-                start_time = time.mktime(date)
-            except ValueError:
-                print(f"Error: can't parse date timestamp", file=sys.stderr)
-                sys.exit(-1)
+            start_time = parse_start(args.start)
+        except ValueError as e:
+            print(f'Error: {e}', file=sys.stderr)
+            sys.exit(-1)
         end_time = start_time + args.span_time
     else:
         end_time = time.time()
@@ -396,23 +650,56 @@ def main():
     args.start_time = start_time
     args.end_time = end_time
 
-    fig = None
-    while True:
-        if args.verbose:
-            print(':: Gathering data')
-        macs, times = get_data(args)
-        if len(times) == 0 or len(macs) == 0 and not args.continuous:
-            print(f'Error: nothing to plot', file=sys.stderr)
+    if args.verbose:
+        print(':: Gathering data')
+    live = None
+    if args.continuous and not args.kismet:
+        # the probe requests of the db are kept in memory, and only the new ones
+        # are read at each refresh. Without --start, the window ends now
+        try:
+            conn, c = open_db(args.db)
+        except VersionError as v:
+            print(f'Error: {v}', file=sys.stderr)
             sys.exit(-1)
+        live = LiveProbes(c, args.start_time, args.end_time if args.start else None, args.mac, args.rssi)
+        macs, dates, rows = select_data(live.probes(), args)
+    else:
+        macs, dates, rows = get_data(args)
+    if (len(dates) == 0 or len(macs) == 0) and not args.continuous:
+        print(f'Error: nothing to plot', file=sys.stderr)
+        sys.exit(-1)
 
-        if args.verbose:
-            print(':: Plotting data')
-        plot_data(macs, times, args)
+    if args.verbose:
+        print(':: Plotting data')
+    import_matplotlib('Agg' if args.image else None)
+    if not args.continuous:
+        plot_data(macs, dates, rows, args)
+        return
 
-        if not args.continuous:
-            # don't continue the loop if not asked to continue
-            break
-        time.sleep(REFRESH_TIME)
+    # the figure is drawn once, then its artists are updated every REFRESH_TIME
+    timeline = Timeline(args)
+    timeline.update(macs, dates, rows)
+    while True:
+        if args.image:
+            timeline.save()
+            time.sleep(REFRESH_TIME)
+        else:
+            # the window is redrawn and handles events while waiting
+            plt.pause(REFRESH_TIME)
+            if not plt.fignum_exists(timeline.fig.number):
+                # the window was closed
+                break
+        if not args.start:
+            args.end_time = time.time()
+            args.start_time = args.end_time - args.span_time
+        if live is not None:
+            new = live.poll(args.start_time)
+            if args.verbose:
+                print(f':: {new} new probe requests')
+            macs, dates, rows = select_data(live.probes(), args)
+        else:
+            macs, dates, rows = get_data(args)
+        timeline.update(macs, dates, rows)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,139 @@
+# -*- encoding: utf-8 -*-
+# presence index of the mac addresses: the minutes of each (UTC) day in which a mac
+# was seen, maintained at ingest in the presence table. The minutes of a mac and day
+# are stored like a container of a roaring bitmap: the sorted minutes when there
+# are few of them, else a bitmap of the minutes of the day. Adding a minute twice
+# changes nothing, so rows can be added again
+
+import time
+import numpy as np
+
+MINUTE = 60
+DAY = 24*60*60
+MINUTES = DAY//MINUTE
+# size of a bitmap of the minutes of a day, in bytes: an array of less minutes of
+# 2 bytes each is smaller
+BITMAP_SIZE = MINUTES//8
+# granularity of timezone offsets, see local_hours
+QUARTER = 15*60
+# number of groups of (mac, day) turned into bitmaps at once
+CHUNK_SIZE = 10000
+# store the minutes of a mac and day, merged with the ones already stored
+PRESENCE_UPSERT = '''insert or replace into presence (day, mac, minutes) values (?, ?, ?)'''
+
+def encode(bitmaps):
+    '''returns the blob of each row of a 2d array of bitmaps (see BITMAP_SIZE)'''
+    bits = np.unpackbits(bitmaps, axis=1, bitorder='little')
+    counts = bits.sum(axis=1)
+    rows, minutes = np.nonzero(bits)
+    minutes = np.split(minutes.astype('<u2'), np.cumsum(counts)[:-1])
+    return [bitmap.tobytes() if 2*count >= BITMAP_SIZE else m.tobytes()
+        for bitmap, count, m in zip(bitmaps, counts.tolist(), minutes)]
+
+def minutes(blobs):
+    '''returns the index of the blob and the minute of the day of each minute of the
+    blobs, without going through bitmaps for the sorted minutes'''
+    lengths = np.fromiter(map(len, blobs), dtype=np.int64, count=len(blobs))
+    dense = lengths == BITMAP_SIZE
+    rows = [np.repeat(np.flatnonzero(~dense), lengths[~dense]//2)]
+    minutes = [np.frombuffer(b''.join(b for b, d in zip(blobs, dense.tolist()) if not d), dtype='<u2')]
+    if dense.any():
+        data = np.frombuffer(b''.join(b for b, d in zip(blobs, dense.tolist()) if d), dtype=np.uint8)
+        r, m = np.nonzero(np.unpackbits(data.reshape(-1, BITMAP_SIZE), axis=1, bitorder='little'))
+        rows.append(np.flatnonzero(dense)[r])
+        minutes.append(m)
+    return np.concatenate(rows), np.concatenate(minutes).astype(np.int64)
+
+def decode(blobs):
+    '''returns the minutes of each blob as a 2d array of bits'''
+    bits = np.zeros((len(blobs), MINUTES), dtype=bool)
+    bits[minutes(blobs)] = True
+    return bits
+
+def to_bitmap(blob):
+    '''returns the bitmap of the minutes of a blob'''
+    return np.packbits(decode([blob])[0], bitorder='little')
+
+def day_range(after, before):
+    '''returns the first and last day overlapping ]after, before['''
+    first = None if after is None else int(after//DAY)
+    last = None if before is None else int(np.nextafter(before, -np.inf)//DAY)
+    return first, last
+
+def window(minutes, after, before):
+    '''returns the mask of the minutes (since the epoch) overlapping ]after, before['''
+    mask = np.ones(len(minutes), dtype=bool)
+    if after is not None:
+        mask &= (minutes+1)*MINUTE > after
+    if before is not None:
+        mask &= minutes*MINUTE < before
+    return mask
+
+def local_hours(days):
+    '''returns the local weekday*24 + hour of each quarter of an hour of each day, as
+    timezone offsets are multiples of it'''
+    cells = np.zeros((len(days), DAY//QUARTER), dtype=np.int64)
+    for i, day in enumerate(days):
+        for q in range(DAY//QUARTER):
+            t = time.localtime(day*DAY + q*QUARTER)
+            cells[i, q] = t.tm_wday*24 + t.tm_hour
+    return cells
+
+class Presence:
+    '''bitmaps of the (mac, day) updated since the last flush into the db'''
+    def __init__(self):
+        self.pending = {}
+
+    def add(self, date, mac_id):
+        day, second = divmod(int(date), DAY)
+        minute = second//MINUTE
+        try:
+            bitmap = self.pending[(day, mac_id)]
+        except KeyError:
+            bitmap = self.pending[(day, mac_id)] = bytearray(BITMAP_SIZE)
+        bitmap[minute >> 3] |= 1 << (minute & 7)
+
+    def add_many(self, dates, mac_ids):
+        '''add the rows of arrays of dates and mac ids'''
+        if len(dates) == 0:
+            return
+        days, minutes = np.divmod(np.floor_divide(dates, MINUTE).astype(np.int64), MINUTES)
+        low = days.min()
+        span = days.max() - low + 1
+        keys, inv = np.unique(mac_ids*span + days - low, return_inverse=True)
+        order = np.argsort(inv, kind='stable')
+        bounds = np.searchsorted(inv[order], np.arange(0, len(keys)+CHUNK_SIZE, CHUNK_SIZE))
+        for n, (start, end) in enumerate(zip(bounds[:-1].tolist(), bounds[1:].tolist())):
+            if start == end:
+                continue
+            # the bitmaps of a chunk of groups at once
+            base = n*CHUNK_SIZE
+            group = keys[base:base+CHUNK_SIZE]
+            bits = np.zeros((len(group), MINUTES), dtype=bool)
+            bits[inv[order[start:end]] - base, minutes[order[start:end]]] = True
+            bitmaps = np.packbits(bits, axis=1, bitorder='little')
+            macs, days = np.divmod(group, span)
+            for mac, day, bitmap in zip(macs.tolist(), (days + low).tolist(), bitmaps):
+                self.merge(mac, day, bitmap)
+
+    def merge(self, mac_id, day, bitmap):
+        '''merge a bitmap of the minutes of a mac and day'''
+        try:
+            pending = self.pending[(day, mac_id)]
+            pending[:] = (np.frombuffer(pending, dtype=np.uint8) | bitmap).tobytes()
+        except KeyError:
+            self.pending[(day, mac_id)] = bytearray(bitmap)
+
+    def flush(self, c):
+        '''merge the pending bitmaps into the ones of the presence table'''
+        if len(self.pending) == 0:
+            return
+        keys = list(self.pending)
+        bitmaps = np.frombuffer(b''.join(self.pending.values()), dtype=np.uint8).reshape(-1, BITMAP_SIZE).copy()
+        for i, (day, mac) in enumerate(keys):
+            c.execute('select minutes from presence where day=? and mac=?', (day, mac))
+            row = c.fetchone()
+            if row is not None:
+                bitmaps[i] |= to_bitmap(row[0])
+        c.executemany(PRESENCE_UPSERT, ((day, mac, blob) for (day, mac), blob in zip(keys, encode(bitmaps))))
+        self.pending.clear()
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+# append-only binary log of probe requests, an alternative to inserting each probe
+# request in the probemon table. Records are appended to segment files, and closed
+# segments are later loaded into the db by a compactor. The mac, ssid and vendor
+# dimension tables stay in the db.
+
+import sqlite3
+import argparse
+import struct
+import threading
+import mmap
+import time
+import sys
+import os
+import os.path
+import numpy as np
+
+from db import migrate, MAC_SSID_UPSERT, VersionError
+
+# date, mac id, ssid id, rssi, channel
+RECORD = struct.Struct('<dIIbB')
+DTYPE = np.dtype([('date', '<f8'), ('mac', '<u4'), ('ssid', '<u4'), ('rssi', 'i1'), ('channel', 'u1')])
+SEGMENT_SUFFIX = '.seg'
+
+def list_segments(directory):
+    '''returns the paths of the segments in directory, oldest first'''
+    try:
+        names = sorted(n for n in os.listdir(directory) if n.endswith(SEGMENT_SUFFIX))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, n) for n in names]
+
+def read_segment(path):
+    '''returns a structured array of the records of a segment, mapped in memory'''
+    with open(path, 'rb') as f:
+        # ignore a record partially written
+        size = os.fstat(f.fileno()).st_size // RECORD.size * RECORD.size
+        if size == 0:
+            return np.empty(0, dtype=DTYPE)
+        mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    return np.frombuffer(mm, dtype=DTYPE)
+
+class ProbeLog:
+    def __init__(self, directory, channel):
+        self.directory = directory
+        self.channel = channel
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.open()
+
+    def open(self):
+        # segments are named after their creation time so that names are never reused
+        name = '%020d%s' % (time.time_ns(), SEGMENT_SUFFIX)
+        self.current = os.path.join(self.directory, name)
+        self.file = open(self.current, 'ab')
+
+    def append(self, date, mac_id, ssid_id, rssi):
+        self.file.write(RECORD.pack(date, mac_id, ssid_id, rssi, self.channel))
+
+    def rotate(self):
+        '''close the current segment and start a new one'''
+        with self.lock:
+            if self.file.tell() == 0:
+                return
+            self.file.close()
+            self.open()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.current = None
+
+    def closed_segments(self):
+        with self.lock:
+            return [s for s in list_segments(self.directory) if s != self.current]
+
+def mac_ssid_groups(records):
+    '''returns the (mac, ssid, first, last, count) of each pair of mac and ssid of the records'''
+    if len(records) == 0:
+        return []
+    pairs = (records['mac'].astype(np.int64) << 32) | records['ssid']
+    keys, inv, count = np.unique(pairs, return_inverse=True, return_counts=True)
+    first = np.full(len(keys), np.inf)
+    last = np.full(len(keys), -np.inf)
+    np.minimum.at(first, inv, records['date'])
+    np.maximum.at(last, inv, records['date'])
+    return zip((keys >> 32).tolist(), (keys & 0xffffffff).tolist(), first.tolist(), last.tolist(), count.tolist())
+
+def insert_records(c, records):
+    '''insert records (of DTYPE) into the probemon and mac_ssid tables'''
+    c.executemany('insert into probemon values(?, ?, ?, ?)', zip(records['date'].tolist(),
+        records['mac'].tolist(), records['ssid'].tolist(), records['rssi'].tolist()))
+    c.executemany(MAC_SSID_UPSERT, mac_ssid_groups(records))
+
+def compact(conn, c, segments):
+    '''load the segments into the probemon table and remove them. The name of the
+    loaded segments is recorded in the same transaction so that none is loaded twice'''
+    total = 0
+    for path in segments:
+        name = os.path.basename(path)
+        c.execute('select 1 from segment where name=?', (name,))
+        if c.fetchone() is None:
+            records = read_segment(path)
+            insert_records(c, records)
+            c.execute('insert into segment (name) values(?)', (name,))
+            conn.commit()
+            total += len(records)
+            del records
+        os.remove(path)
+        c.execute('delete from segment where name=?', (name,))
+        conn.commit()
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description='Load the segments of a probe log into the db')
+    parser.add_argument('-d', '--db', default='probemon.db', help='file name of the db')
+    parser.add_argument('-l', '--log-dir', help='directory of the probe log (default to the db name with .log appended)')
+    args = parser.parse_args()
+
+    if args.log_dir is None:
+        args.log_dir = f'{args.db}.log'
+    if not os.path.isdir(args.log_dir):
+        print(f'Error: directory not found {args.log_dir}', file=sys.stderr)
+        sys.exit(-1)
+
+    conn = sqlite3.connect(args.db)
+    c = conn.cursor()
+    try:
+        migrate(conn, c)
+    except VersionError as v:
+        print(f'Error: {v}', file=sys.stderr)
+        sys.exit(-1)
+    total = compact(conn, c, list_segments(args.log_dir))
+    print(f':: Loaded {total} probe requests')
+    conn.close()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -6,16 +6,13 @@ import time
 import argparse
 import subprocess
 import sys
+import os
 import sqlite3
-from manuf import manuf
 import base64
 from lru import LRU
 import signal
 import struct
 import threading
-import grpc
-import datagram_pb2
-import datagram_pb2_grpc
 
 NAME = 'probemon'
 DESCRIPTION = "a command line tool for logging 802.11 probe requests"
@@ -24,6 +21,8 @@ VERSION = '0.7.1'
 MANUF_FILE = './manuf'
 MAX_QUEUE_LENGTH = 50
 MAX_ELAPSED_TIME = 60 # seconds
+COMPACT_TIME = 5*60 # seconds
+OPTIMIZE_TIME = 60*60 # seconds
 MAX_VENDOR_LENGTH = 25
 MAX_SSID_LENGTH = 15
 arr = []
@@ -31,6 +30,8 @@ Count = 0
 
 # read config variable from config.py file
 import config
+from db import init_db, optimize_db, MAC_SSID_UPSERT, TILE_BATCH, VersionError
+from db import get_vendor_id, get_mac_id, get_ssid_id
 
 class Colors:
     red = '\033[31m'
@@ -106,6 +107,10 @@ class MyQueue:
             insert_into_db(fields, conn, c)
             if stdout:
                 print_fields(fields)
+        # one update of the sketches of the current hour and day, and of the presence
+        # of the mac seen, per commit
+        sketches.flush(c)
+        presence_index.flush(c)
 
         self.clear()
 
@@ -115,7 +120,11 @@ class MyQueue:
 # globals
 cache = MyCache(128)
 queue = MyQueue()
+# created after parsing the arguments, as they import numpy
+sketches = None
+presence_index = None
 vendor_db = None
+probe_log = None
 start_ts = time.monotonic()
 lock = threading.Lock()
 event = threading.Event()
@@ -128,11 +137,21 @@ def process_queue(queue, args):
 
     conn = sqlite3.connect(args.db)
     c = conn.cursor()
-    init_db(conn, c)
+    try:
+        init_db(conn, c)
+    except VersionError as v:
+        print(f'Error: {v}', file=sys.stderr)
+        event.set()
+        return
+    optimize_ts = time.monotonic()
 
     while True:
         with lock:
             queue.commit(args.stdout, conn, c)
+        if probe_log is not None:
+            # only new vendor/mac/ssid are written to the db: commit them right away
+            # not to lock the db while the compactor loads segments
+            conn.commit()
         now = time.monotonic()
         if now - start_ts > MAX_ELAPSED_TIME or event.is_set():
             start_ts = now
@@ -143,9 +162,35 @@ def process_queue(queue, args):
                 # db is locked ? Retry again
                 time.sleep(10)
                 conn.commit()
+            if probe_log is not None:
+                # the closed segment only refers to committed vendor/mac/ssid
+                probe_log.rotate()
+            if now - optimize_ts > OPTIMIZE_TIME or event.is_set():
+                optimize_ts = now
+                try:
+                    # the tiles of the timeline closed since the last time, a few at a
+                    # time not to hold the queue: a backlog is built over several passes
+                    tiles.build(c, limit=TILE_BATCH)
+                    conn.commit()
+                    optimize_db(conn, c)
+                except sqlite3.OperationalError as e:
+                    print(f'Error: {e}')
             if event.is_set():
                 break
         time.sleep(1)
+    if probe_log is not None:
+        probe_log.close()
+
+def compact_log(args):
+    # load the closed segments of the probe log into the db in the background
+    conn = sqlite3.connect(args.db, timeout=30)
+    c = conn.cursor()
+    while not event.wait(COMPACT_TIME):
+        try:
+            probelog.compact(conn, c, probe_log.closed_segments())
+        except sqlite3.OperationalError as e:
+            print(f'Error: {e}')
+    conn.close()
 
 def parse_rssi(packet):
     # parse dbm_antsignal from radiotap header
@@ -186,40 +231,26 @@ def insert_into_db(fields, conn, c):
     try:
         vendor_id = cache.vendor[vendor]
     except KeyError as k:
-        c.execute('select id from vendor where name=?', (vendor,))
-        row = c.fetchone()
-        if row is None:
-            c.execute('insert into vendor (name) values(?)', (vendor,))
-            c.execute('select id from vendor where name=?', (vendor,))
-            row = c.fetchone()
-        vendor_id = row[0]
-        cache.vendor[vendor] = vendor_id
+        vendor_id = cache.vendor[vendor] = get_vendor_id(c, vendor)
 
     try:
         mac_id = cache.mac[mac]
     except KeyError as k:
-        c.execute('select id from mac where address=?', (mac,))
-        row = c.fetchone()
-        if row is None:
-            c.execute('insert into mac (address,vendor) values(?, ?)', (mac, vendor_id))
-            c.execute('select id from mac where address=?', (mac,))
-            row = c.fetchone()
-        mac_id = row[0]
-        cache.mac[mac] = mac_id
+        mac_id = cache.mac[mac] = get_mac_id(c, mac, vendor_id)
 
     try:
         ssid_id = cache.ssid[ssid]
     except KeyError as k:
-        c.execute('select id from ssid where name=?', (ssid,))
-        row = c.fetchone()
-        if row is None:
-            c.execute('insert into ssid (name) values(?)', (ssid,))
-            c.execute('select id from ssid where name=?', (ssid,))
-            row = c.fetchone()
-        ssid_id = row[0]
-        cache.ssid[ssid] = ssid_id
+        ssid_id = cache.ssid[ssid] = get_ssid_id(c, ssid)
 
-    c.execute('insert into probemon values(?, ?, ?, ?)', (date, mac_id, ssid_id, rssi))
+    # the sketches and the presence index are updated with both backends, at ingest
+    sketches.add(date, mac)
+    presence_index.add(date, mac_id)
+    if probe_log is not None:
+        probe_log.append(date, mac_id, ssid_id, rssi)
+    else:
+        c.execute('insert into probemon values(?, ?, ?, ?)', (date, mac_id, ssid_id, rssi))
+        c.execute(MAC_SSID_UPSERT, (mac_id, ssid_id, date, date, 1))
 
 def build_packet_cb(ignored):
     def packet_callback(packet):
@@ -246,37 +277,6 @@ def build_packet_cb(ignored):
 
     return packet_callback
 
-def init_db(conn, c):
-    # create tables if they do not exist
-    sql = 'create table if not exists vendor(id integer not null primary key, name text);'
-    c.execute(sql)
-    sql = '''create table if not exists mac(id integer not null primary key, address text,
-        vendor integer,
-        foreign key(vendor) references vendor(id)
-        );'''
-    c.execute(sql)
-    sql = 'create table if not exists ssid(id integer not null primary key, name text);'
-    c.execute(sql)
-    sql = '''create table if not exists probemon(date float,
-        mac integer,
-        ssid integer,
-        rssi integer,
-        foreign key(mac) references mac(id),
-        foreign key(ssid) references ssid(id)
-        );'''
-    c.execute(sql)
-    sql = 'create index if not exists idx_probemon_date on probemon(date);'
-    c.execute(sql)
-    conn.commit()
-
-    sql = 'pragma synchronous = normal;'
-    c.execute(sql)
-    sql = 'pragma temp_store = 2;' # to store temp table and indices in memory
-    c.execute(sql)
-    sql = 'pragma journal_mode = off;' # disable journal for rollback (we don't use this)
-    c.execute(sql)
-    conn.commit()
-
 def check_event(packet):
     return event.is_set()
 
@@ -299,6 +299,13 @@ def main():
         print('Loading manuf file')
     vendor_db = manuf.MacParser(manuf_name='./manuf', update=update_vdb)
 
+    global probe_log
+    cq = None
+    if args.backend == 'log':
+        probe_log = probelog.ProbeLog(f'{args.db}.log', args.channel)
+        cq = threading.Thread(target=compact_log, args=(args,))
+        cq.start()
+
     # use a detached thread to process the queue and exit faster packet callback
     pq = threading.Thread(target=process_queue, args=(queue, args))
     pq.start()
@@ -317,10 +324,21 @@ def main():
     finally:
         event.set()
         pq.join()
+        if cq is not None:
+            cq.join()
+            # load what's left of the probe log
+            conn = sqlite3.connect(args.db, timeout=30)
+            try:
+                probelog.compact(conn, conn.cursor(), probelog.list_segments(probe_log.directory))
+            except sqlite3.OperationalError as e:
+                print(f'Error: {e}', file=sys.stderr)
+            conn.close()
 
 if __name__ == '__main__':
     try:
         parser = argparse.ArgumentParser(description=DESCRIPTION)
+        parser.add_argument('-b', '--backend', choices=['sqlite', 'log'], default='sqlite',
+            help="write probe requests directly to the db or to a binary log loaded later in the db")
         parser.add_argument('-c', '--channel', default=1, type=int, help="the channel to listen on")
         parser.add_argument('-d', '--db', default='probemon.db', help="database file name to use")
         parser.add_argument('-i', '--interface', help="the capture interface to use")
@@ -340,7 +358,22 @@ if __name__ == '__main__':
         if args.ignore is not None:
             config.IGNORED = args.ignore
 
-        # only import scapy here to avoid delay if error in argument parsing
+        # only import numpy here too, for the sketches, the presence index and the tiles
+        import presence
+        import sketch
+        import tiles
+        sketches = sketch.Sketches()
+        presence_index = presence.Presence()
+        if args.backend == 'log':
+            import probelog
+        if args.stdout:
+            # only used to push the count of mac printed
+            import grpc
+            import datagram_pb2
+            import datagram_pb2_grpc
+
+        # only import manuf and scapy here to avoid delay if error in argument parsing
+        from manuf import manuf
         print('Loading scapy...')
         from scapy.all import sniff
         from scapy.error import Scapy_Exception
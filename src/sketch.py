@@ -0,0 +1,90 @@
+# -*- encoding: utf-8 -*-
+# HyperLogLog sketches of the distinct mac addresses seen in each hour and each
+# (local) day, maintained at ingest in the sketch table. The sketches of several
+# buckets, or of the db of several sensors, merge by taking the max of their
+# registers: adding a mac twice changes nothing, so rows can be added again
+
+import hashlib
+import time
+import math
+import zlib
+
+# 2**PRECISION registers of one byte per sketch
+PRECISION = 12
+REGISTERS = 1 << PRECISION
+# relative standard error of the estimates
+ERROR = 1.04/math.sqrt(REGISTERS)
+LEVELS = ('hour', 'day')
+HOUR = 60*60
+# granularity of timezone offsets: all the timestamps of a quarter of an hour
+# fall into the same buckets
+QUARTER = 15*60
+# store the registers of a bucket, merged with the ones already stored
+SKETCH_UPSERT = '''insert or replace into sketch (level, start, end, registers) values (?, ?, ?, ?)'''
+
+def mac_hash(address):
+    '''64-bit hash of a mac address: it does not depend on the ids of the db'''
+    return int.from_bytes(hashlib.blake2b(address.encode(), digest_size=8).digest(), 'little')
+
+def buckets(date):
+    '''returns the (level, start, end) of the buckets of a timestamp'''
+    hour = date - date % HOUR
+    t = time.localtime(date)
+    day = time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, 0, 0, -1))
+    # mktime normalizes the day after the last one of a month
+    end = time.mktime((t.tm_year, t.tm_mon, t.tm_mday+1, 0, 0, 0, 0, 0, -1))
+    return ('hour', hour, hour + HOUR), ('day', day, end)
+
+def encode(registers):
+    return zlib.compress(bytes(registers))
+
+def decode(data):
+    return bytearray(zlib.decompress(data))
+
+class Sketches:
+    '''sketches of the buckets updated since the last flush into the db'''
+    def __init__(self):
+        self.pending = {}
+        # buckets of each quarter of an hour seen since the last flush
+        self.quarters = {}
+
+    def add(self, date, address):
+        self.add_hash(date, mac_hash(address))
+
+    def add_hash(self, date, h):
+        '''add the mac of hash h (see mac_hash) to the buckets of date'''
+        start = date - date % QUARTER
+        try:
+            quarter = self.quarters[start]
+        except KeyError:
+            quarter = self.quarters[start] = buckets(date)
+        # the first bits give the register, the rank of the first 1 bit of the others its value
+        index = h >> (64 - PRECISION)
+        rank = 64 - PRECISION - (h & ((1 << (64 - PRECISION)) - 1)).bit_length() + 1
+        for level, start, end in quarter:
+            try:
+                registers = self.pending[(level, start)][1]
+            except KeyError:
+                registers = bytearray(REGISTERS)
+                self.pending[(level, start)] = (end, registers)
+            if registers[index] < rank:
+                registers[index] = rank
+
+    def merge(self, level, start, end, registers):
+        '''merge the registers of a bucket, like the ones of the db of another sensor'''
+        try:
+            pending = self.pending[(level, start)][1]
+            pending[:] = map(max, pending, registers)
+        except KeyError:
+            self.pending[(level, start)] = (end, bytearray(registers))
+
+    def flush(self, c):
+        '''merge the pending sketches into the ones of the sketch table'''
+        for (level, start), (end, registers) in self.pending.items():
+            c.execute('select registers from sketch where level=? and start=?', (level, start))
+            row = c.fetchone()
+            if row is not None:
+                registers = bytearray(map(max, registers, decode(row[0])))
+            c.execute(SKETCH_UPSERT, (level, start, end, encode(registers)))
+        self.pending.clear()
+        self.quarters.clear()
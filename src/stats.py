@@ -5,6 +5,12 @@ import argparse
 import time
 import sys
 import os.path
+import itertools
+import shutil
+import multiprocessing
+import re
+import math
+import numpy as np
 
 # avoid IOError when quitting less
 from signal import signal, SIGPIPE, SIG_DFL
@@ -13,26 +19,28 @@ signal(SIGPIPE, SIG_DFL)
 NUMOFSECSINADAY = 60*60*24
 MAX_VENDOR_LENGTH = 25
 MAX_SSID_LENGTH = 15
+CHUNK_SIZE = 10000 # number of rows fetched at once
+WATCH_INTERVAL = 5 # in seconds
+# aggregates and group by clause of load_groups, in the order of idx_probemon_mac_cover
+# when possible, and the same group by on the columns of the archived rows (see
+# group_records)
+GROUP_BY_MAC = ('min(rssi),count(*),min(date),max(date)', 'mac,ssid,rssi', ('mac', 'ssid', 'rssi'))
+GROUP_BY_DAY = ('min(rssi),count(*),min(date),max(date)', "mac,date(date,'unixepoch','localtime'),ssid,rssi",
+    ('mac', 'day', 'ssid', 'rssi'))
+# only the pairs of mac and ssid: the rssi and time of the groups are left to 0
+GROUP_BY_SSID = ('0,count(*),0,0', 'mac,ssid', ('mac', 'ssid'))
 
 # read config variable from config.py file
 import config
+import archive
+import analytics
+import presence
+import sketch
+from db import mac_to_int, mac_prefix_range, check_version, has_ssid_fts, ssid_text, VersionError
 
-def is_local_bit_set(mac):
-    byte = mac.split(':')
-    try:
-        bi = int(byte[0], 16)
-        return  bi & 0b00000010 == 0b00000010
-    except ValueError as e:
-        return False
-
-def median(lst):
-    n = len(lst)
-    if n < 1:
-        return None
-    if n % 2 == 1:
-        return sorted(lst)[n//2]
-    else:
-        return sum(sorted(lst)[n//2-1:n//2+1])//2
+# single probe requests or groups of them, see analytics.Probes
+ROW_DTYPE = np.dtype([('mac', '<i8'), ('ssid', '<i8'), ('rssi', '<i8'), ('count', '<i8'),
+    ('first', '<f8'), ('last', '<f8')])
 
 def parse_ts(ts):
     try:
@@ -47,39 +55,109 @@ def parse_ts(ts):
     t = time.mktime(date)
     return t
 
-def build_sql_query(after, before, macs, rssi, zero, day):
-    sql_head = '''select date,mac.address,vendor.name,ssid.name,rssi from probemon
-    inner join mac on mac.id=probemon.mac
-    inner join vendor on vendor.id=mac.vendor
-    inner join ssid on ssid.id=probemon.ssid'''
-    sql_tail = 'order by date'
+def add_arg(clause, op, new_arg):
+    if clause == '':
+        clause = '%s' % new_arg
+    else:
+        clause = '%s %s %s' % (clause, op, new_arg)
+    return clause
 
+def mac_search(mac):
+    '''returns the where clause and its arguments on the mac table matching a (partial)
+    mac address, where % and _ are wild-cards like in SQL syntax. The part before
+    the first wild-card is looked up as a range of the integer values of mac
+    addresses, so that the idx_mac_value index is used'''
+    mac = mac.lower()
+    value = mac_to_int(mac)
+    if value is not None:
+        return 'mac.value=?', [value]
+    head = re.split('[%_]', mac, maxsplit=1)[0]
+    prefix = mac_prefix_range(head)
+    if head == mac and prefix is not None:
+        return '(mac.value>=? and mac.value<?)', list(prefix)
+    # the pattern is matched against the address without its ':', like the prefix
+    pattern = '%s%%' % mac.replace(':', '')
+    if prefix is not None:
+        # only the mac in the range are matched against the pattern
+        return "(mac.value>=? and mac.value<? and replace(mac.address, ':', '') like ?)", list(prefix) + [pattern]
+    return "replace(mac.address, ':', '') like ?", [pattern]
+
+def build_mac_clause(macs):
+    '''returns the where clause and its arguments to filter on the mac table
+    for the given (partial) mac addresses'''
     sql_where_clause = ''
     sql_args = []
+    for mac in macs:
+        clause, args = mac_search(mac)
+        sql_where_clause = add_arg(sql_where_clause, 'or', clause)
+        sql_args.extend(args)
+    if len(macs) > 1:
+        sql_where_clause = '(%s)' % sql_where_clause
+    return sql_where_clause, sql_args
 
-    def add_arg(clause, op, new_arg):
-        if clause == '':
-            clause = '%s' % new_arg
-        else:
-            clause = '%s %s %s' % (clause, op, new_arg)
-        return clause
+def mac_regex(macs):
+    '''returns a compiled regex matching the start of the mac addresses like mac_search,
+    to filter mac addresses that are not in the db: the ':' of macs are ignored, and
+    optional between the digits of the addresses'''
+    wildcards = {'%': '.*', '_': '[0-9a-f]'}
+    patterns = [':?'.join(wildcards.get(char, re.escape(char)) for char in mac.lower().replace(':', ''))
+        for mac in macs]
+    return re.compile('|'.join(patterns))
 
+def build_mac_filter(macs):
+    '''returns the where clause on the mac table selecting the mac matching macs,
+    that are not ignored'''
+    sql_where_clause, sql_args = '', []
     if macs:
-        for mac in macs:
-            if len(mac) != 17:
-                mac = '%s%%' % mac
-            sql_where_clause = add_arg(sql_where_clause, 'or', 'mac.address like ?')
-            sql_args.append(mac)
-        if len(macs) > 1:
-            sql_where_clause = '(%s)' % sql_where_clause
+        sql_where_clause, sql_args = build_mac_clause(macs)
+    if len(config.IGNORED) > 0:
+        arg_list = ','.join(['?']*len(config.IGNORED))
+        sql_where_clause = add_arg(sql_where_clause, 'and', 'mac.address not in (%s)' % (arg_list,))
+        sql_args.extend(config.IGNORED)
+    return sql_where_clause, sql_args
+
+def find_macs(c, macs):
+    '''returns the sorted ids of the mac matching macs, that are not ignored'''
+    sql = 'select id from mac'
+    sql_where_clause, sql_args = build_mac_filter(macs)
+    if sql_where_clause != '':
+        sql = '%s where %s' % (sql, sql_where_clause)
+    c.execute(sql + ' order by id', sql_args)
+    return [row[0] for row in c.fetchall()]
+
+def build_sql_where(after, before, mac_ids, rssi, zero, ordered=False, mac_range=None):
+    '''returns the where clause of the filters, only on the columns of the probemon table.
+    mac_ids are the ids of the mac to keep (see find_macs), None to keep all the mac
+    that are not ignored. ordered is set when the rows are read by date. mac_range
+    is the [low, high) range of mac id of a slice, see mac_slices'''
+    sql_where_clause, sql_args = '', []
+    if mac_ids is not None:
+        # ids are integers, they are inlined not to hit the limit on the number of arguments
+        sql_where_clause = 'probemon.mac in (%s)' % ','.join(str(i) for i in mac_ids)
+    elif len(config.IGNORED) > 0:
+        # the subquery is evaluated once, before scanning the probemon table
+        arg_list = ','.join(['?']*len(config.IGNORED))
+        if ordered:
+            # excluding the ignored mac lets the planner read the rows in the order
+            # of idx_probemon_date_cover, instead of sorting them
+            sql_where_clause = 'probemon.mac not in (select mac.id from mac where mac.address in (%s))' % arg_list
+        else:
+            sql_where_clause = 'probemon.mac in (select mac.id from mac where mac.address not in (%s))' % arg_list
+        sql_args.extend(config.IGNORED)
+
+    if mac_range is not None:
+        low, high = mac_range
+        if low is not None:
+            sql_where_clause = add_arg(sql_where_clause, 'and', 'probemon.mac>=?')
+            sql_args.append(low)
+        if high is not None:
+            sql_where_clause = add_arg(sql_where_clause, 'and', 'probemon.mac<?')
+            sql_args.append(high)
+
     if rssi:
         sql_where_clause = add_arg(sql_where_clause, 'and', 'rssi>?')
         sql_args.append(rssi)
 
-    if day:
-        before = time.time() # now
-        after = before - NUMOFSECSINADAY # since one day in the past
-
     if after is not None:
         sql_where_clause = add_arg(sql_where_clause, 'and', 'date>?')
         sql_args.append(after)
@@ -90,27 +168,750 @@ def build_sql_query(after, before, macs, rssi, zero, day):
     if zero:
         sql_where_clause = add_arg(sql_where_clause, 'and', 'rssi != 0')
 
-    if len(config.IGNORED) > 0:
-        arg_list = ','.join(['?']*len(config.IGNORED))
-        sql_where_clause = add_arg(sql_where_clause, 'and', 'mac.address not in (%s)' % (arg_list,))
-        sql_args.extend(config.IGNORED)
+    if sql_where_clause == '':
+        return '', sql_args
+    return 'where %s' % sql_where_clause, sql_args
+
+def last_rowid(c):
+    '''returns the rowid of the last row of the probemon table: the rows inserted later
+    have a greater one, whatever their date'''
+    c.execute('select max(rowid) from probemon')
+    return c.fetchone()[0] or 0
 
-    sql = '%s where %s %s' % (sql_head, sql_where_clause, sql_tail)
+def build_sql_query(after, before, mac_ids, rssi, zero, day, privacy=False, ordered=True):
+    if day:
+        before = time.time() # now
+        after = before - NUMOFSECSINADAY # since one day in the past
+
+    if privacy:
+        # merge all LAA mac into a virtual mac called 'LAA'
+        mac_column = "case when mac.laa then 'LAA' else mac.address end"
+    else:
+        mac_column = 'mac.address'
+    sql_head = f'''select date,{mac_column},vendor.name,ssid.name,rssi,mac.laa from probemon
+    inner join mac on mac.id=probemon.mac
+    inner join vendor on vendor.id=mac.vendor
+    inner join ssid on ssid.id=probemon.ssid'''
+    # sorting is only needed when rows are output as is, it costs a temp b-tree otherwise
+    sql_tail = 'order by date' if ordered else ''
+
+    sql_where, sql_args = build_sql_where(after, before, mac_ids, rssi, zero, ordered)
+    sql = '%s %s %s' % (sql_head, sql_where, sql_tail)
     return sql, sql_args
 
+def load_macs(c, macs):
+    '''returns the table of the mac, by id, and the mask of the mac matching the filters.
+    When filtering on macs, only the matching mac are read in the table'''
+    c.execute('select max(id) from mac')
+    size = (c.fetchone()[0] or 0) + 1
+    names = [''] * size
+    vendors = [''] * size
+    laa = np.zeros(size, dtype=bool)
+    mac_ids = find_macs(c, macs)
+    sql = 'select mac.id,mac.address,vendor.name,mac.laa from mac inner join vendor on vendor.id=mac.vendor'
+    if macs:
+        sql = '%s where mac.id in (%s)' % (sql, ','.join(str(i) for i in mac_ids))
+    c.execute(sql)
+    for mac_id, address, vendor, flag in c.fetchall():
+        names[mac_id] = address
+        vendors[mac_id] = vendor
+        laa[mac_id] = flag
+    selected = np.zeros(size, dtype=bool)
+    selected[mac_ids] = True
+    return analytics.MacTable(names, vendors, laa), selected
+
+def load_ssids(c):
+    '''returns the names of all the ssid, by id'''
+    c.execute('select max(id) from ssid')
+    names = [''] * ((c.fetchone()[0] or 0) + 1)
+    c.execute('select id,name from ssid')
+    for ssid_id, name in c.fetchall():
+        names[ssid_id] = name
+    return names
+
+def archived_rows(c, after, before, mac_ids, rssi, zero, privacy):
+    '''yield the rows matching the filters of build_sql_query from the archive'''
+    cur = c.connection.cursor()
+    if not archive.has_blocks(cur, after, before):
+        return
+
+    table, selected = load_macs(cur, None)
+    if mac_ids is not None:
+        selected = np.zeros(len(table), dtype=bool)
+        selected[mac_ids] = True
+        mac_ids = set(mac_ids)
+    ssid_table = load_ssids(cur)
+    for date, mac_id, ssid_id, r in archive.iter_rows(cur, after, before, mac_ids):
+        if not selected[mac_id] or (rssi and r <= rssi) or (zero and r == 0):
+            continue
+        laa = table.laa[mac_id]
+        address = 'LAA' if privacy and laa else table.names[mac_id]
+        yield (date, address, table.vendors[mac_id], ssid_table[ssid_id], r, int(laa))
+
+def group_records(rec, keys):
+    '''returns rows of ROW_DTYPE grouped by the columns keys like the group by of
+    load_groups, 'day' being the local day of first: the counts are summed, the
+    rssi and first are the min and last is the max of each group'''
+    if len(rec) == 0:
+        return rec
+    columns = [analytics.day_codes(rec['first'])[0] if key == 'day' else rec[key] for key in keys]
+    # the columns are packed into one integer key when it fits in 63 bits
+    spans = [int(column.max()) - int(column.min()) + 1 for column in columns]
+    if math.prod(spans) < 1 << 63:
+        packed = np.zeros(len(rec), dtype=np.int64)
+        for column, span in zip(columns, spans):
+            packed = packed*span + (column - column.min())
+        order = np.argsort(packed, kind='stable')
+        packed = packed[order]
+        starts = np.flatnonzero(np.concatenate(([True], packed[1:] != packed[:-1])))
+    else:
+        order = np.lexsort(columns[::-1])
+        change = np.zeros(len(rec), dtype=bool)
+        change[0] = True
+        for column in columns:
+            column = column[order]
+            change[1:] |= column[1:] != column[:-1]
+        starts = np.flatnonzero(change)
+    groups = rec[order[starts]]
+    groups['count'] = np.add.reduceat(rec['count'][order], starts)
+    groups['rssi'] = np.minimum.reduceat(rec['rssi'][order], starts)
+    groups['first'] = np.minimum.reduceat(rec['first'][order], starts)
+    groups['last'] = np.maximum.reduceat(rec['last'][order], starts)
+    return groups
+
+def archived_records(c, after, before, mac_ids, rssi, zero, selected, keys=None):
+    '''returns the rows matching the filters from the archive, as arrays of ROW_DTYPE.
+    With keys, the rows are grouped by these columns (see group_records) as the
+    blocks are read, so that only the groups are kept in memory'''
+    cur = c.connection.cursor()
+    if not archive.has_blocks(cur, after, before):
+        return []
+    if mac_ids is not None:
+        mac_ids = set(mac_ids)
+    chunks = []
+    # number of rows in the chunks after the first one, the groups merged so far
+    pending = 0
+    for dates, mac, ssid, r in archive.iter_blocks(cur, after, before, mac_ids):
+        dates = np.asarray(dates)
+        mac = np.asarray(mac, dtype=np.int64)
+        r = np.asarray(r, dtype=np.int64)
+        mask = selected[mac]
+        if after is not None:
+            mask &= dates > after
+        if before is not None:
+            mask &= dates < before
+        if rssi:
+            mask &= r > rssi
+        if zero:
+            mask &= r != 0
+        rec = np.zeros(np.count_nonzero(mask), dtype=ROW_DTYPE)
+        rec['mac'] = mac[mask]
+        rec['ssid'] = np.asarray(ssid, dtype=np.int64)[mask]
+        rec['rssi'] = r[mask]
+        rec['count'] = 1
+        rec['first'] = rec['last'] = dates[mask]
+        if keys is None:
+            chunks.append(rec)
+            continue
+        chunks.append(group_records(rec, keys))
+        pending += len(chunks[-1])
+        # the groups of the blocks are merged once they outnumber the merged ones,
+        # each group being merged a few times
+        if len(chunks) > 1 and pending > max(len(chunks[0]), CHUNK_SIZE):
+            chunks = [group_records(np.concatenate(chunks), keys)]
+            pending = 0
+    if keys is not None and len(chunks) > 1:
+        chunks = [group_records(np.concatenate(chunks), keys)]
+    return chunks
+
+def fetch_rows(c):
+    while True:
+        rows = c.fetchmany(CHUNK_SIZE)
+        if len(rows) == 0:
+            break
+        yield from rows
+
+def run_query(c, sql, sql_args):
+    try:
+        c.execute(sql, sql_args)
+    except sqlite3.OperationalError as e:
+        time.sleep(2)
+        c.execute(sql, sql_args)
+
+def query_rows(c, after, before, macs, rssi, zero, day, privacy=False, ordered=True):
+    '''returns an iterator on the rows of build_sql_query, read from the archive blocks
+    then from the probemon table'''
+    if day:
+        before = time.time() # now
+        after = before - NUMOFSECSINADAY # since one day in the past
+    # look up the mac matching the filters once for the archive and the probemon table
+    mac_ids = find_macs(c, macs) if macs else None
+    sql, sql_args = build_sql_query(after, before, mac_ids, rssi, zero, False, privacy, ordered)
+    run_query(c, sql, sql_args)
+    # archived rows are older than the ones in the probemon table
+    return itertools.chain(archived_rows(c, after, before, mac_ids, rssi, zero, privacy), fetch_rows(c))
+
+def fetch_records(c, sql, sql_args):
+    '''yield the rows of a query by chunks, as arrays of ROW_DTYPE'''
+    run_query(c, sql, sql_args)
+    while True:
+        rows = c.fetchmany(CHUNK_SIZE)
+        if len(rows) == 0:
+            break
+        yield np.array(rows, dtype=ROW_DTYPE)
+
+def iter_records(c, select, tail, after, before, mac_ids, rssi, zero, selected, ordered=False, keys=None):
+    '''yield the rows matching the filters by chunks, as arrays of ROW_DTYPE. select
+    must return the columns of ROW_DTYPE, ordered is set when tail orders by date.
+    keys are the columns of the group by of tail, if any, see archived_records'''
+    # archived rows are older than the ones in the probemon table
+    yield from archived_records(c, after, before, mac_ids, rssi, zero, selected, keys)
+    sql_where, sql_args = build_sql_where(after, before, mac_ids, rssi, zero, ordered)
+    yield from fetch_records(c, f'{select} from probemon {sql_where} {tail}', sql_args)
+
+def mac_slices(c, jobs):
+    '''split the rows of the probemon table into slices of about the same number of
+    rows, by ranges of mac id. Returns the [low, high) bounds of each slice'''
+    c.execute('select count(*) from probemon')
+    total = c.fetchone()[0]
+    bounds = []
+    for k in range(1, jobs):
+        # the offset is counted on idx_probemon_mac_date, without reading the table
+        c.execute('select mac from probemon order by mac limit 1 offset ?', (total*k//jobs,))
+        row = c.fetchone()
+        if row is not None and (len(bounds) == 0 or row[0] > bounds[-1]):
+            bounds.append(row[0])
+    return list(zip([None] + bounds, bounds + [None]))
+
+def time_slices(c, after, before, jobs):
+    '''split ]after, before[ into slices of the same span, bounded by the time range of
+    the archived blocks. Returns the ]after, before[ bounds of each slice'''
+    c.execute('select min(start), max(end) from archive')
+    first, last = c.fetchone()
+    if first is None:
+        return []
+    if after is not None:
+        first = max(first, after)
+    if before is not None:
+        last = min(last, before)
+    if first >= last:
+        return []
+    slices = []
+    start = after
+    for end in np.linspace(first, last, jobs+1)[1:-1].tolist():
+        slices.append((start, end))
+        # bounds are exclusive: the next slice starts just before end to keep
+        # the rows at end
+        start = float(np.nextafter(end, -np.inf))
+    slices.append((start, before))
+    return slices
+
+def load_slice(path, select, tail, after, before, mac_ids, rssi, zero, selected, keys, mac_range, time_range):
+    '''returns as a single array the rows of the probemon table of the mac with an id
+    in mac_range, and the archived rows in time_range, a slice of ]after, before[.
+    Either one can be None. It runs in the processes of parallel_records, with a
+    connection of its own'''
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    c = conn.cursor()
+    sql = 'pragma query_only = on;'
+    c.execute(sql)
+    sql = 'pragma temp_store = 2;' # to store temp table and indices in memory
+    c.execute(sql)
+    chunks = []
+    if time_range is not None:
+        chunks.extend(archived_records(c, time_range[0], time_range[1], mac_ids, rssi, zero, selected, keys))
+    if mac_range is not None:
+        sql_where, sql_args = build_sql_where(after, before, mac_ids, rssi, zero, mac_range=mac_range)
+        chunks.extend(fetch_records(c, f'{select} from probemon {sql_where} {tail}', sql_args))
+    conn.close()
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=ROW_DTYPE)
+
+def parallel_records(c, select, tail, after, before, mac_ids, rssi, zero, selected, keys, jobs):
+    '''returns the rows of iter_records by chunks, read by jobs processes: the
+    probemon table is split by ranges of mac id, as the group by queries read it in
+    the order of idx_probemon_mac_cover, and the archive by time. The rows of a
+    group by are partial aggregates, that analytics merges like the rows of a
+    single query. The order of the rows is not kept'''
+    c.execute('pragma database_list')
+    path = [row[2] for row in c.fetchall() if row[1] == 'main'][0]
+    if path == '':
+        # an in-memory db can't be shared
+        return list(iter_records(c, select, tail, after, before, mac_ids, rssi, zero, selected, keys=keys))
+    macs = mac_slices(c, jobs)
+    times = time_slices(c, after, before, jobs)
+    n = max(len(macs), len(times))
+    macs += [None]*(n-len(macs))
+    times += [None]*(n-len(times))
+    args = [(path, select, tail, after, before, mac_ids, rssi, zero, selected, keys, m, t) for m, t in zip(macs, times)]
+    with multiprocessing.Pool(n) as pool:
+        return pool.starmap(load_slice, args)
+
+def load(c, select, tail, after, before, macs, rssi, zero, ordered=False, keys=None, jobs=1):
+    table, selected = load_macs(c, macs)
+    ssids = load_ssids(c)
+    # the mac matching the filters are looked up once, then filtered by id
+    mac_ids = np.flatnonzero(selected).tolist() if macs else None
+    if jobs > 1 and not ordered:
+        chunks = parallel_records(c, select, tail, after, before, mac_ids, rssi, zero, selected, keys, jobs)
+    else:
+        chunks = list(iter_records(c, select, tail, after, before, mac_ids, rssi, zero, selected, ordered, keys))
+    rec = np.concatenate(chunks) if chunks else np.zeros(0, dtype=ROW_DTYPE)
+    return analytics.Probes(rec['first'], rec['mac'], rec['ssid'], rec['rssi'], table, ssids,
+        rec['last'], rec['count'])
+
+def load_probes(c, after, before, macs, rssi, zero):
+    '''returns the probe requests matching the filters, sorted by time, as analytics.Probes'''
+    return load(c, 'select mac,ssid,rssi,1,date,date', 'order by date', after, before, macs, rssi, zero, True)
+
+def load_groups(c, after, before, macs, rssi, zero, group_by=GROUP_BY_MAC, jobs=1):
+    '''returns the probe requests matching the filters as analytics.Probes, grouped
+    by the db, and the archived rows grouped the same way as they are read. With
+    jobs > 1, slices of the db are grouped in parallel, see parallel_records'''
+    columns, group, keys = group_by
+    return load(c, f'select mac,ssid,{columns}', f'group by {group}', after, before, macs, rssi, zero,
+        keys=keys, jobs=jobs)
+
+# look ups in the mac_ssid table: it covers the whole history, without the filters
+# on time or rssi
+
+def macs_of_ssid(c, ssid_id, privacy=False):
+    '''returns the address of the mac that probed a ssid'''
+    sql = 'select mac.address from mac_ssid inner join mac on mac.id=mac_ssid.mac where mac_ssid.ssid=?'
+    if privacy:
+        sql += ' and mac.laa=0'
+    c.execute(sql + ' order by mac.id', (ssid_id,))
+    return [row[0] for row in c.fetchall()]
+
+def ssids_of_mac(c, mac_id):
+    '''returns the (ssid, first, last, count) of the ssids probed by a mac'''
+    sql = '''select ssid.name,first,last,count from mac_ssid inner join ssid on ssid.id=mac_ssid.ssid
+    where mac_ssid.mac=? and ssid.name != '' order by first'''
+    c.execute(sql, (mac_id,))
+    return c.fetchall()
+
+def shared_ssids(c, mac_id, k):
+    '''returns the (address, laa, ssids) of the mac that probed at least k of the ssids
+    probed by a mac, the ones sharing the most first'''
+    sql_where_clause, sql_args = build_mac_filter(None)
+    if sql_where_clause != '':
+        sql_where_clause = 'and %s' % sql_where_clause
+    sql = f'''select mac.address,mac.laa,group_concat(ssid.name, ','),count(*) as n from mac_ssid as a
+    inner join mac_ssid as b on b.ssid=a.ssid and b.mac!=a.mac
+    inner join mac on mac.id=b.mac
+    inner join ssid on ssid.id=b.ssid
+    where a.mac=? and ssid.name != '' {sql_where_clause}
+    group by b.mac having n >= ? order by n desc, mac.address'''
+    c.execute(sql, [mac_id] + sql_args + [k])
+    return [(address, laa, ssids.split(',')) for address, laa, ssids, _ in c.fetchall()]
+
+def list_ssid_macs(c):
+    '''returns the UAA mac that probed each ssid, for the ssids probed by more than
+    one, the most probed first'''
+    sql_where_clause, sql_args = build_mac_filter(None)
+    if sql_where_clause != '':
+        sql_where_clause = 'and %s' % sql_where_clause
+    sql = f'''select ssid.name,group_concat(mac.address, ', '),count(*) as n from mac_ssid
+    inner join mac on mac.id=mac_ssid.mac
+    inner join ssid on ssid.id=mac_ssid.ssid
+    where ssid.name != '' and mac.laa=0 {sql_where_clause}
+    group by mac_ssid.ssid having n > 1 order by n desc'''
+    c.execute(sql, sql_args)
+    return [(ssid, macs) for ssid, macs, _ in c.fetchall()]
+
+def search_ssids(c, text, privacy=False):
+    '''returns the (name, text, macs) of the ssids whose text contains each word of
+    text, case insensitive, with the mac that probed them, the most probed first.
+    In a word, _ matches any character and % any sequence of characters'''
+    words = text.split()
+    if len(words) == 0:
+        return []
+    if has_ssid_fts(c):
+        # the trigram index answers like patterns with at least 3 characters
+        source = 'ssid_fts inner join ssid on ssid.id=ssid_fts.rowid'
+        column, ssid_id = 'ssid_fts.name', 'ssid_fts.rowid'
+    else:
+        # without the index (sqlite older than 3.34), the text of each ssid is matched
+        c.connection.create_function('ssid_text', 1, ssid_text, deterministic=True)
+        source, column, ssid_id = 'ssid', 'ssid_text(ssid.name)', 'ssid.id'
+    sql_where_clause = ' and '.join([f'{column} like ?']*len(words))
+    sql_args = [f'%{w}%' for w in words]
+    mac_where_clause, mac_args = build_mac_filter(None)
+    if privacy:
+        mac_where_clause = add_arg(mac_where_clause, 'and', 'mac.laa=0')
+    if mac_where_clause != '':
+        sql_where_clause = '%s and %s' % (sql_where_clause, mac_where_clause)
+        sql_args.extend(mac_args)
+    sql = f'''select ssid.name,{column},group_concat(mac.address, ', ') from {source}
+    inner join mac_ssid on mac_ssid.ssid={ssid_id}
+    inner join mac on mac.id=mac_ssid.mac
+    where {sql_where_clause}
+    group by {ssid_id} order by count(*) desc, ssid.name'''
+    c.execute(sql, sql_args)
+    return [(name, text, macs.split(', ')) for name, text, macs in c.fetchall()]
+
+def unique_counts(c, level, after, before, exact=False):
+    '''returns the start of the buckets of level (hour or day) overlapping ]after, before[,
+    the number of distinct mac seen in each one, and in all of them. The counts are
+    estimated from the sketches of the buckets (see sketch.py), unless exact'''
+    if exact:
+        return exact_unique_counts(c, level, after, before)
+    sql = 'select start, registers from sketch where level=?'
+    sql_args = [level]
+    if after is not None:
+        sql += ' and end > ?'
+        sql_args.append(after)
+    if before is not None:
+        sql += ' and start < ?'
+        sql_args.append(before)
+    c.execute(sql + ' order by start', sql_args)
+    rows = c.fetchall()
+    if len(rows) == 0:
+        return [], np.zeros(0, dtype=np.int64), 0
+    registers = np.frombuffer(b''.join(sketch.decode(row[1]) for row in rows), dtype=np.uint8)
+    registers = registers.reshape(len(rows), sketch.REGISTERS)
+    # the sketch of all the buckets is the max of their registers
+    total = analytics.hll_estimates(registers.max(axis=0)[None, :])[0]
+    return [row[0] for row in rows], analytics.hll_estimates(registers), int(total)
+
+def exact_unique_counts(c, level, after, before):
+    '''same as unique_counts, counting the distinct mac of the rows of the buckets'''
+    # the rows of the whole buckets overlapping ]after, before[
+    n = sketch.LEVELS.index(level)
+    low = None if after is None else sketch.buckets(after)[n][1]
+    high = None if before is None else sketch.buckets(np.nextafter(before, -np.inf))[n][2]
+    # the pairs of mac and quarter of an hour, that falls into a single bucket
+    sql = f'select distinct mac, cast(date/{sketch.QUARTER} as integer) from probemon where 1'
+    sql_args = []
+    if low is not None:
+        sql += ' and date >= ?'
+        sql_args.append(low)
+    if high is not None:
+        sql += ' and date < ?'
+        sql_args.append(high)
+    c.execute(sql, sql_args)
+    pairs = np.array(c.fetchall(), dtype=np.int64).reshape(-1, 2)
+    macs, quarters = [pairs[:, 0]], [pairs[:, 1]]
+    for dates, mac_ids, ssids, rssi in archive.iter_blocks(c, None if low is None else np.nextafter(low, -np.inf), high):
+        dates = np.array(dates)
+        mask = np.ones(len(dates), dtype=bool)
+        if low is not None:
+            mask &= dates >= low
+        if high is not None:
+            mask &= dates < high
+        macs.append(np.array(mac_ids, dtype=np.int64)[mask])
+        quarters.append(np.floor_divide(dates[mask], sketch.QUARTER).astype(np.int64))
+    macs, quarters = np.concatenate(macs), np.concatenate(quarters)
+    # the bucket of each quarter is looked up once
+    keys, inv = np.unique(quarters, return_inverse=True)
+    starts, codes = np.unique([sketch.buckets(q*sketch.QUARTER)[n][1] for q in keys.tolist()], return_inverse=True)
+    size = macs.max(initial=0) + 1
+    pairs = np.unique(codes.astype(np.int64)[inv]*size + macs)
+    counts = np.bincount(pairs//size, minlength=len(starts))
+    return starts.tolist(), counts, len(np.unique(macs))
+
+def presence_rows(c, after, before, mac_ids=None, days=None):
+    '''yield the minutes of the presence index overlapping ]after, before[ by chunks, as
+    arrays of the mac id and the minute (since the epoch) of each minute a mac was
+    present. mac_ids are the ids of the mac to keep (see find_macs), None to keep all
+    the mac that are not ignored. days is the list of days to read, instead of all
+    of them. The index of the row of each minute in its chunk is yielded too, as a
+    row is a (mac, day)'''
+    first, last = presence.day_range(after, before)
+    sql, sql_args = 'select day, mac, minutes from presence where 1', []
+    if days is not None:
+        sql += ' and day in (%s)' % ','.join(str(d) for d in days)
+    if first is not None:
+        sql += ' and day >= ?'
+        sql_args.append(first)
+    if last is not None:
+        sql += ' and day <= ?'
+        sql_args.append(last)
+    if mac_ids is not None:
+        sql += ' and mac in (%s)' % ','.join(str(i) for i in mac_ids)
+    elif len(config.IGNORED) > 0:
+        sql += ' and mac not in (select id from mac where address in (%s))' % ','.join(['?']*len(config.IGNORED))
+        sql_args.extend(config.IGNORED)
+    c.execute(sql, sql_args)
+    while True:
+        rows = c.fetchmany(CHUNK_SIZE)
+        if len(rows) == 0:
+            break
+        days = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        macs = np.fromiter((r[1] for r in rows), dtype=np.int64, count=len(rows))
+        index, minutes = presence.minutes([r[2] for r in rows])
+        minutes += days[index]*presence.MINUTES
+        mask = presence.window(minutes, after, before)
+        yield index[mask], macs[index[mask]], minutes[mask]
+
+class LocalHours:
+    '''local weekday*24 + hour of minutes, looked up once per quarter of an hour of
+    each day'''
+    def __init__(self):
+        self.days = {}
+
+    def __call__(self, minutes):
+        days, inv = np.unique(minutes//presence.MINUTES, return_inverse=True)
+        new = [d for d in days.tolist() if d not in self.days]
+        for d, cells in zip(new, presence.local_hours(new)):
+            self.days[d] = cells
+        table = np.array([self.days[d] for d in days.tolist()]).reshape(len(days), -1)
+        return table[inv, minutes % presence.MINUTES*presence.MINUTE//presence.QUARTER]
+
+def present_macs(c, after, before, macs, hours=None):
+    '''returns the ids of the mac present in ]after, before[, the number of minutes
+    they were present, and their first and last minute (since the epoch). With
+    hours, only the minutes of the local hours in [low, high[ are counted'''
+    mac_ids = find_macs(c, macs) if macs else None
+    local = LocalHours()
+    ids, counts, firsts, lasts = [], [], [], []
+    for _, mac, minutes in presence_rows(c, after, before, mac_ids):
+        if hours is not None:
+            hour = local(minutes) % 24
+            keep = (hour >= hours[0]) & (hour < hours[1])
+            mac, minutes = mac[keep], minutes[keep]
+        # the aggregates of each chunk, then of all of them
+        keys, inv = np.unique(mac, return_inverse=True)
+        ids.append(keys)
+        counts.append(np.bincount(inv, minlength=len(keys)))
+        first = np.full(len(keys), np.iinfo(np.int64).max)
+        last = np.full(len(keys), -1)
+        np.minimum.at(first, inv, minutes)
+        np.maximum.at(last, inv, minutes)
+        firsts.append(first)
+        lasts.append(last)
+    if len(ids) == 0:
+        return [], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    keys, inv = np.unique(np.concatenate(ids), return_inverse=True)
+    count = np.bincount(inv, np.concatenate(counts), minlength=len(keys)).astype(np.int64)
+    first = np.full(len(keys), np.iinfo(np.int64).max)
+    last = np.full(len(keys), -1)
+    np.minimum.at(first, inv, np.concatenate(firsts))
+    np.maximum.at(last, inv, np.concatenate(lasts))
+    return keys.tolist(), count, first, last
+
+def co_present(c, mac_id, after, before):
+    '''returns the number of minutes a mac was present in ]after, before[, and the ids of
+    the mac present in the same minutes with the number of shared minutes, the ones
+    sharing the most first'''
+    own = [minutes for _, _, minutes in presence_rows(c, after, before, [mac_id])]
+    own = np.sort(np.concatenate(own)) if own else np.zeros(0, dtype=np.int64)
+    if len(own) == 0:
+        return 0, [], np.zeros(0, dtype=np.int64)
+    ids = []
+    # only the rows of the days the mac was present are read
+    days = np.unique(own//presence.MINUTES).tolist()
+    for _, mac, minutes in presence_rows(c, after, before, days=days):
+        i = np.minimum(np.searchsorted(own, minutes), len(own)-1)
+        ids.append(mac[(own[i] == minutes) & (mac != mac_id)])
+    keys, shared = np.unique(np.concatenate(ids), return_counts=True)
+    order = np.lexsort((keys, -shared))
+    return len(own), keys[order].tolist(), shared[order]
+
+def presence_heatmap(c, after, before, macs):
+    '''returns the number of (mac, day) present in each local hour of each weekday in
+    ]after, before[, as an array of 7 rows of 24 hours'''
+    mac_ids = find_macs(c, macs) if macs else None
+    local = LocalHours()
+    counts = np.zeros(7*24, dtype=np.int64)
+    for row, _, minutes in presence_rows(c, after, before, mac_ids):
+        # a (mac, day) is counted once in each of its hours
+        hit = np.zeros((CHUNK_SIZE, 7*24), dtype=bool)
+        hit[row, local(minutes)] = True
+        counts += hit.sum(axis=0)
+    return counts.reshape(7, 24)
+
+def mac_id(c, address):
+    '''returns the id of a mac address, None if it is not in the db'''
+    c.execute('select id from mac where address=?', (address.lower(),))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def latest_probes(c, count=100):
+    '''returns the last count probe requests as rows of date, mac address, vendor,
+    ssid, rssi and U/L bit, from the last one'''
+    sql = '''select date, mac.address, vendor.name, ssid.name, rssi, mac.laa from probemon
+    inner join mac on probemon.mac=mac.id
+    inner join ssid on probemon.ssid=ssid.id
+    inner join vendor on mac.vendor=vendor.id
+    order by date desc limit ?'''
+    c.execute(sql, (count,))
+    return c.fetchall()
+
+def mac_names(c, mac_ids):
+    '''returns the address, vendor and U/L bit of each mac id'''
+    sql = '''select mac.id,mac.address,vendor.name,mac.laa from mac
+    inner join vendor on vendor.id=mac.vendor where mac.id in (%s)''' % ','.join(str(i) for i in mac_ids)
+    c.execute(sql)
+    return {mac_id: (address, vendor, bool(laa)) for mac_id, address, vendor, laa in c.fetchall()}
+
+def fit(text, length):
+    '''strip text to length chars, or left pad it with spaces'''
+    if len(text) > length:
+        return text[:length-3]+ '...'
+    return text.ljust(length)
+
+class Watcher:
+    '''per-mac stats kept in memory, and updated with the rows added to the probemon
+    table since the last poll'''
+    def __init__(self, c, macs, rssi, zero, privacy):
+        self.c = c
+        self.rssi = rssi
+        self.zero = zero
+        self.privacy = privacy
+        self.regex = mac_regex(macs) if macs else None
+        # address, vendor and U/L bit of the mac seen so far, None if filtered out
+        self.macs = {}
+        self.stats = {}
+        self.after = None
+        self.last_seen = None
+        self.last_rowid = 0
+        # rowid and last date after the load, see poll
+        self.loaded = None
+        self.version = None
+        c.execute("select id from ssid where name=''")
+        row = c.fetchone()
+        self.empty_ssid = row[0] if row else None
+
+    def add(self, rows):
+        '''add the rows of (mac, ssid, rssi, count, first, last) to the stats, returns
+        the number of probe requests kept by the mac filter'''
+        total = 0
+        for m, s, r, n, f, l in rows:
+            mac = self.macs[m]
+            if mac is None:
+                continue
+            total += n
+            # all the LAA mac are merged into the virtual mac 'LAA' with privacy
+            key = 'LAA' if self.privacy and mac[2] else m
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = analytics.LiveAggregates()
+            stats.add(m, s, r, n, f, l)
+            if self.last_seen is None or l > self.last_seen:
+                self.last_seen = l
+        return total
+
+    def load(self, after, macs, jobs=1):
+        '''load the stats of the mac since after'''
+        self.after = after
+        self.last_rowid = last_rowid(self.c)
+        probes = load_groups(self.c, after, None, macs, self.rssi, self.zero, jobs=jobs)
+        table = probes.macs
+        for m in np.unique(probes.mac).tolist():
+            self.macs[m] = (table.names[m], table.vendors[m], bool(table.laa[m]))
+        self.add(zip(probes.mac.tolist(), probes.ssid.tolist(), probes.rssi.tolist(),
+            probes.count.tolist(), probes.first.tolist(), probes.last.tolist()))
+        if self.last_seen is not None:
+            self.loaded = (last_rowid(self.c), self.last_seen)
+
+    def lookup(self, mac_ids):
+        '''look up the mac not seen so far, and filter them'''
+        new = [m for m in set(mac_ids) if m not in self.macs]
+        if len(new) == 0:
+            return
+        sql = '''select mac.id,mac.address,vendor.name,mac.laa from mac
+        inner join vendor on vendor.id=mac.vendor where mac.id in (%s)''' % ','.join(str(i) for i in new)
+        self.c.execute(sql)
+        for mac_id, address, vendor, laa in self.c.fetchall():
+            if self.regex is not None and self.regex.match(address) is None:
+                self.macs[mac_id] = None
+            else:
+                self.macs[mac_id] = (address, vendor, bool(laa))
+
+    def poll(self):
+        '''add the rows inserted since the last poll, returns the number of probe requests
+        added. Nothing is read while the data version of the db is unchanged'''
+        self.c.execute('pragma data_version')
+        version = self.c.fetchone()[0]
+        if version == self.version:
+            return 0
+        self.version = version
+        # the new rows are read by rowid, not by date: the probe log, merge.py and
+        # ingest.py insert rows older than the last ones
+        sql_where, sql_args = build_sql_where(self.after, None, None, self.rssi, self.zero)
+        sql_where = add_arg(sql_where, 'and', 'probemon.rowid>?') if sql_where else 'where probemon.rowid>?'
+        self.c.execute(f'select rowid,mac,ssid,rssi,1,date,date from probemon not indexed {sql_where}', sql_args + [self.last_rowid])
+        rows = self.c.fetchall()
+        if len(rows) == 0:
+            return 0
+        self.last_rowid = max(row[0] for row in rows)
+        if self.loaded is not None:
+            # the rows inserted while loading may have been loaded: as before, the ones
+            # not later than the last row loaded are skipped
+            rowid, last = self.loaded
+            rows = [row for row in rows if row[0] > rowid or row[5] > last]
+            self.loaded = None
+        self.lookup(row[1] for row in rows)
+        return self.add(row[1:] for row in rows)
+
+    def table(self, size):
+        '''returns the lines of the table of the size most seen mac'''
+        lines = []
+        for key, stats in self.stats.items():
+            count, low, high, avg, median = stats.rssi_stats()
+            lines.append((count, stats.first, key, low, high, avg, median))
+        lines.sort(reverse=True)
+        header = '%s %s %6s %4s %4s %4s %4s %-19s %-19s %5s' % (fit('MAC', 23), fit('VENDOR', MAX_VENDOR_LENGTH),
+            '#', 'MIN', 'MAX', 'AVG', 'MED', 'FIRST', 'LAST', 'SSIDS')
+        table = [header]
+        for count, first, key, low, high, avg, median in lines[:size]:
+            stats = self.stats[key]
+            if key == 'LAA':
+                name = 'LAA'
+            else:
+                address, _, laa = self.macs[key]
+                name = f'{address} (LAA)' if laa else address
+            # a virtual mac takes the vendor of its first appearance
+            vendor = self.macs[stats.origin][1]
+            first = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(first))
+            last = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(stats.last))
+            ssids = len(stats.ssids - {self.empty_ssid})
+            table.append(f'{fit(name, 23)} {fit(vendor, MAX_VENDOR_LENGTH)} {count:6d} {low:4d} {high:4d} {avg:4d} {median:4d} {first} {last} {ssids:5d}')
+        return table
+
+def watch(c, after, macs, rssi, zero, privacy, interval, jobs=1):
+    '''print the stats of each mac, and refresh them in place every interval seconds.
+    Only the rows added since the previous refresh are read from the db'''
+    watcher = Watcher(c, macs, rssi, zero, privacy)
+    watcher.load(after, macs, jobs)
+    new = 0
+    while True:
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        # the table fits in the terminal, below the status line and header
+        size = shutil.get_terminal_size().lines - 3
+        lines = [f':: {now}: {len(watcher.stats)} mac, {new} new probe requests'] + watcher.table(size)
+        # move the cursor home and clear the screen before redrawing the table
+        sys.stdout.write('\x1b[H\x1b[J%s\n' % '\n'.join(lines))
+        sys.stdout.flush()
+        time.sleep(interval)
+        new = watcher.poll()
+
 def main():
     parser = argparse.ArgumentParser(description='Display various stats about mac addresses/probe requests in the database')
     parser.add_argument('-a', '--after', help='filter before this timestamp')
     parser.add_argument('-b', '--before', help='filter after this timestamp')
     parser.add_argument('-d', '--day', action='store_true', help='filter only for the past day')
+    parser.add_argument('--co-present', metavar='MAC', help='look up for mac present in the same minutes as that mac')
     parser.add_argument('--day-by-day', action='store_true', help='day by day stats for given mac')
     parser.add_argument('--db', default='probemon.db', help='file name of database')
+    parser.add_argument('--exact', action='store_true', help='count the distinct mac of --unique exactly instead of estimating it')
+    parser.add_argument('--heatmap', action='store_true', help='number of mac present in each hour of each weekday, a mac counted once a day')
+    parser.add_argument('--hours', metavar='LOW-HIGH', help='only count the local hours from LOW to HIGH (excluded) for --present')
     parser.add_argument('--list-mac-ssids', action='store_true', help='list ssid with mac that probed for it')
+    parser.add_argument('--interval', type=float, default=WATCH_INTERVAL, help='number of seconds between refreshes of --watch')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes querying slices of the db')
+    parser.add_argument('-k', '--min-shared', type=int, default=2, help='minimal number of shared ssids for --shared')
     parser.add_argument('-l', '--log', action='store_true', help='log all entries instead of showing stats')
     parser.add_argument('-m', '--mac', action='append', help='filter for that mac address')
+    parser.add_argument('--mac-ssids', metavar='MAC', help='list the ssids probed by that mac')
     parser.add_argument('-p', '--privacy', action='store_true', help='merge all LAA mac into one')
+    parser.add_argument('--present', action='store_true', help='list the mac present, with the number of minutes they were present')
     parser.add_argument('-r', '--rssi', type=int, help='filter for that minimal RSSI value')
     parser.add_argument('-s', '--ssid', help='look up for mac that have probed for that ssid')
+    parser.add_argument('--search', metavar='TEXT', help='look up for mac that have probed for the ssids containing the words of that text')
+    parser.add_argument('--shared', metavar='MAC', help='look up for mac that have probed the same ssids as that mac')
+    parser.add_argument('-u', '--unique', choices=sketch.LEVELS, help='number of distinct mac seen in each hour or day')
+    parser.add_argument('-w', '--watch', action='store_true', help='refresh the stats of each mac as new probe requests are added')
     parser.add_argument('-z', '--zero', action='store_true', help='filter rssi value of 0')
     args = parser.parse_args()
 
@@ -122,6 +923,21 @@ def main():
         print('Error: --day conflicts with --after or --before', file=sys.stderr)
         sys.exit(-1)
 
+    if args.watch and (args.before or args.log or args.day_by_day or args.list_mac_ssids or args.ssid
+            or args.search or args.mac_ssids or args.shared):
+        print('Error: --watch only applies to the stats of each mac, without --before', file=sys.stderr)
+        sys.exit(-1)
+
+    hours = None
+    if args.hours:
+        try:
+            hours = tuple(int(h) for h in args.hours.split('-'))
+        except ValueError:
+            hours = ()
+        if len(hours) != 2 or not 0 <= hours[0] < hours[1] <= 24:
+            print('Error: --hours should be of the form LOW-HIGH, with 0 <= LOW < HIGH <= 24', file=sys.stderr)
+            sys.exit(-1)
+
     if args.day_by_day and not args.mac:
         print('Error: --day-by-day needs a --mac switch', file=sys.stderr)
         sys.exit(-1)
@@ -137,7 +953,7 @@ def main():
         print(f'Error: file not found {args.db}', file=sys.stderr)
         sys.exit(-1)
 
-    if args.ssid and args.mac:
+    if (args.ssid or args.search) and args.mac:
         print(':: Ignoring --mac switch')
         args.mac = None
 
@@ -151,6 +967,13 @@ def main():
     c.execute(sql)
     conn.commit()
 
+    try:
+        check_version(c)
+    except VersionError as v:
+        print(f'Error: {v}', file=sys.stderr)
+        conn.close()
+        sys.exit(-1)
+
     if args.ssid:
         c.execute('select id from ssid where name=?', (args.ssid,))
         ssid = c.fetchone()
@@ -158,44 +981,117 @@ def main():
             print('Error: ssid not found', file=sys.stderr)
             conn.close()
             sys.exit(-1)
-        c.execute('select distinct mac from probemon where ssid=?', (ssid[0],))
-
-        macs = []
         # search for mac that have probed that ssid
-        for row in c.fetchall():
-            c.execute('select address from mac where id=?', (row[0],))
-            mac = c.fetchone()[0]
-            if args.privacy and is_local_bit_set(mac):
-                continue
-            macs.append(mac)
-
+        macs = macs_of_ssid(c, ssid[0], args.privacy)
         print(f'{args.ssid} : {", ".join(macs)}')
         conn.close()
         return
 
-    sql, sql_args = build_sql_query(after, before, args.mac, args.rssi, args.zero, args.day)
-    try:
-        c.execute(sql, sql_args)
-    except sqlite3.OperationalError as e:
-        time.sleep(2)
-        c.execute(sql, sql_args)
+    if args.search:
+        ssids = search_ssids(c, args.search, args.privacy)
+        if len(ssids) == 0:
+            print('Error: ssid not found', file=sys.stderr)
+            conn.close()
+            sys.exit(-1)
+        for name, text, macs in ssids:
+            # show the decoded text of the ssid stored in base64
+            if text != name:
+                name = f'{text} ({name})'
+            print(f'{name} : {", ".join(macs)}')
+        conn.close()
+        return
+
+    if args.mac_ssids or args.shared:
+        mac = (args.mac_ssids or args.shared).lower()
+        c.execute('select mac.id,vendor.name from mac inner join vendor on vendor.id=mac.vendor where address=?', (mac,))
+        row = c.fetchone()
+        if row is None:
+            print('Error: mac not found', file=sys.stderr)
+            conn.close()
+            sys.exit(-1)
+        print(f'MAC: {mac}, VENDOR: {row[1]}')
+        if args.mac_ssids:
+            for ssid, first, last, count in ssids_of_mac(c, row[0]):
+                first = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(first))
+                last = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(last))
+                print(f'  {ssid}: #: {count:4d}, first seen at {first} and last seen at {last}')
+        else:
+            for address, laa, ssids in shared_ssids(c, row[0], args.min_shared):
+                laa = ' (LAA)' if laa else ''
+                print(f'  {address}{laa}: {len(ssids)} shared SSIDs: {",".join(sorted(ssids))}')
+        conn.close()
+        return
+
+    if args.day:
+        before = time.time() # now
+        after = before - NUMOFSECSINADAY # since one day in the past
+
+    if args.unique:
+        # the sketches count all the mac of the db, other filters do not apply
+        starts, counts, total = unique_counts(c, args.unique, after, before, args.exact)
+        conn.close()
+        fmt = '%Y-%m-%dT%H:%M' if args.unique == 'hour' else '%Y-%m-%d'
+        for start, count in zip(starts, counts.tolist()):
+            print(f'{time.strftime(fmt, time.localtime(start))}: {count}')
+        if args.exact:
+            print(f':: {total} distinct mac in {len(starts)} {args.unique}s')
+        else:
+            print(f':: about {total} distinct mac in {len(starts)} {args.unique}s (standard error {sketch.ERROR:.1%})')
+        return
+
+    if args.present or args.heatmap:
+        # the presence index has the minutes of each mac and day, other filters do not apply
+        if args.present:
+            mac_ids, count, first, last = present_macs(c, after, before, args.mac, hours)
+            names = mac_names(c, mac_ids)
+            for i in np.lexsort((first, -count)).tolist():
+                address, vendor, laa = names[mac_ids[i]]
+                laa = ' (LAA)' if laa else ''
+                f = time.strftime('%Y-%m-%dT%H:%M', time.localtime(first[i]*presence.MINUTE))
+                l = time.strftime('%Y-%m-%dT%H:%M', time.localtime(last[i]*presence.MINUTE))
+                print(f'{address}{laa} {fit(vendor, MAX_VENDOR_LENGTH)} {count[i]:6d} minutes, first at {f} and last at {l}')
+        else:
+            counts = presence_heatmap(c, after, before, args.mac)
+            print('    ' + ''.join(f'{h:6d}' for h in range(24)))
+            for day, row in zip(('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'), counts.tolist()):
+                print(f'{day} ' + ''.join(f'{n:6d}' for n in row))
+        conn.close()
+        return
+
+    if args.co_present:
+        mac = args.co_present.lower()
+        c.execute('select mac.id,vendor.name from mac inner join vendor on vendor.id=mac.vendor where address=?', (mac,))
+        row = c.fetchone()
+        if row is None:
+            print('Error: mac not found', file=sys.stderr)
+            conn.close()
+            sys.exit(-1)
+        total, mac_ids, shared = co_present(c, row[0], after, before)
+        print(f'MAC: {mac}, VENDOR: {row[1]}, present {total} minutes')
+        names = mac_names(c, mac_ids)
+        for mac_id, n in zip(mac_ids, shared.tolist()):
+            address, vendor, laa = names[mac_id]
+            laa = ' (LAA)' if laa else ''
+            print(f'  {address}{laa}: {n} shared minutes ({n/total:.0%})')
+        conn.close()
+        return
+
+    if args.watch:
+        # the stats are kept since the start, they are not a sliding window
+        watch(c, after, args.mac, args.rssi, args.zero, args.privacy, args.interval, args.jobs)
+        return
 
     if args.log:
         # simply output each log entry to stdout
-        for t, m, mc, ssid, rssi in c.fetchall():
+        rows = query_rows(c, after, before, args.mac, args.rssi, args.zero, False)
+        for t, m, mc, ssid, rssi, laa in rows:
             t = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(t))
-            if is_local_bit_set(m):
+            if laa:
                 m = '%s (LAA)' % m
             # strip mac vendor string to MAX_VENDOR_LENGTH chars, left padded with space
-            if len(mc) > MAX_VENDOR_LENGTH:
-                mc = mc[:MAX_VENDOR_LENGTH-3]+ '...'
-            else:
-                mc = mc.ljust(MAX_VENDOR_LENGTH)
+            mc = fit(mc, MAX_VENDOR_LENGTH)
             # do the same for ssid
-            if len(ssid) > MAX_SSID_LENGTH:
-                ssid = ssid[:MAX_SSID_LENGTH-3]+ '...'
-            else:
-                ssid = ssid.ljust(MAX_SSID_LENGTH)
+            ssid = fit(ssid, MAX_SSID_LENGTH)
             print('\t'.join([t, m, mc, ssid, str(rssi)]))
 
         conn.close()
@@ -203,92 +1099,64 @@ def main():
 
     if args.day_by_day:
         # gather stats day by day for args.mac
-        stats = {}
-        for row in c.fetchall():
-            if row[1] not in list(stats.keys()):
-                stats[row[1]] = {'vendor': row[2]}
-            day = time.strftime('%Y-%m-%d', time.localtime(row[0]))
-            if day in stats[row[1]]:
-                smd = stats[row[1]][day]
-                smd['rssi'].append(row[4])
-                if row[0] > smd['last']:
-                    smd['last'] = row[0]
-                if row[0] < smd['first']:
-                    smd['first'] = row[0]
-            else:
-                stats[row[1]][day] = {'rssi': [row[4]], 'first': row[0], 'last': row[0]}
+        probes = load_groups(c, after, before, args.mac, args.rssi, args.zero, GROUP_BY_DAY, args.jobs)
         conn.close()
+        stats, days = analytics.day_stats(probes)
+        mac_codes, day_codes = np.divmod(stats.keys, len(days))
+        avg = stats.rssi_avg()
+        groups = {}
+        for i, mac in enumerate(mac_codes.tolist()):
+            groups.setdefault(mac, []).append(i)
 
-        for mac in list(stats.keys()):
-            vendor = stats[mac]['vendor']
-            del stats[mac]['vendor']
-            days = sorted(stats[mac].keys())
-            print(f'MAC: {mac}, VENDOR: {vendor}')
-            for d in days:
-                rssi = stats[mac][d]['rssi']
-                first = time.strftime('%H:%M:%S', time.localtime(stats[mac][d]['first']))
-                last = time.strftime('%H:%M:%S', time.localtime(stats[mac][d]['last']))
-                print(f'  {d}: [{first}-{last}]', end=' ')
-                print(f'  RSSI: #: {len(rssi):4d}, min: {min(rssi):3d}, max: {max(rssi):3d}, avg: {sum(rssi)//len(rssi):3d}, median: {median(rssi):3d}')
+        # macs in order of first appearance
+        for mac, idx in sorted(groups.items(), key=lambda x:stats.first[x[1]].min()):
+            print(f'MAC: {probes.macs.names[mac]}, VENDOR: {probes.macs.vendors[mac]}')
+            for i in idx:
+                first = time.strftime('%H:%M:%S', time.localtime(stats.first[i]))
+                last = time.strftime('%H:%M:%S', time.localtime(stats.last[i]))
+                print(f'  {days[day_codes[i]]}: [{first}-{last}]', end=' ')
+                print(f'  RSSI: #: {stats.rssi_count[i]:4d}, min: {stats.rssi_min[i]:3d}, max: {stats.rssi_max[i]:3d}, avg: {avg[i]:3d}, median: {stats.rssi_median[i]:3d}')
         return
 
     if args.list_mac_ssids:
-        ssids = {}
-        for row in c.fetchall():
-            ssid = row[3]
-            if ssid == '' or is_local_bit_set(row[1]):
-                continue
-            if ssid not in ssids:
-                ssids[ssid] = set([row[1]])
-            else:
-                ssids[ssid].add(row[1])
-        si = sorted(list(ssids.items()), key=lambda x:len(x[1]))
+        if after is None and before is None and not args.rssi and not args.zero:
+            # without filters, the mac_ssid table has the answer
+            for k,v in list_ssid_macs(c):
+                print(f'{k}: {v}')
+            conn.close()
+            return
+        probes = load_groups(c, after, before, None, args.rssi, args.zero, GROUP_BY_SSID, args.jobs)
+        conn.close()
+        si = sorted(analytics.ssid_macs(probes), key=lambda x:len(x[1]))
         si.reverse()
         for k,v in si:
             if len(v) > 1:
                 print(f'{k}: {", ".join(v)}')
-
-        conn.close()
         return
-    # gather stats about each mac
-    macs = {}
-    for row in c.fetchall():
-        mac = row[1]
-        if args.privacy and is_local_bit_set(mac):
-            # create virtual mac for LAA mac address
-            mac = 'LAA'
-        if mac not in macs:
-            macs[mac] = {'vendor': row[2], 'ssid': [], 'rssi': [], 'last': row[0], 'first':row[0]}
-        d = macs[mac]
-        if row[3] != '' and row[3] not in d['ssid']:
-            d['ssid'].append(row[3])
-        if row[0] > d['last']:
-            d['last'] = row[0]
-        if row[0] < d['first']:
-            d['first'] = row[0]
-        if row[4] != 0:
-            d['rssi'].append(row[4])
 
+    # gather stats about each mac
+    probes = load_groups(c, after, before, args.mac, args.rssi, args.zero, jobs=args.jobs)
     conn.close()
+    if args.privacy:
+        probes.merge_laa()
+    stats = analytics.mac_stats(probes)
+    macs = probes.macs
+    avg = stats.rssi_avg()
 
-    # sort on frequency of appearence of a mac
-    tmp = [(k,len(v['rssi'])) for k,v in list(macs.items())]
-    tmp = reversed(sorted(tmp, key=lambda k:k[1]))
-
-    # print our stats
-    for k,_ in tmp:
-        v = macs[k]
-        laa = ' (LAA)' if is_local_bit_set(k) else ''
-        print(f'MAC: {k}{laa}, VENDOR: {v["vendor"]}')
-        print(f'  SSIDs: {",".join(sorted(v["ssid"]))}')
-        rssi = v['rssi']
-        if rssi != []:
-            print(f'  RSSI: #: {len(rssi):4d}, min: {min(rssi):3d}, max: {max(rssi):3d}, avg: {sum(rssi)//len(rssi):3d}, median: {median(rssi):3d}')
+    # sort on frequency of appearence of a mac, and print our stats
+    for i in reversed(np.lexsort((stats.first, stats.rssi_count)).tolist()):
+        k = macs.names[stats.keys[i]]
+        laa = ' (LAA)' if macs.laa[stats.keys[i]] and k != 'LAA' else ''
+        # a virtual mac takes the vendor of its first appearance
+        print(f'MAC: {k}{laa}, VENDOR: {macs.vendors[stats.origin[i]]}')
+        print(f'  SSIDs: {",".join(stats.ssids[i])}')
+        if stats.rssi_count[i] > 0:
+            print(f'  RSSI: #: {stats.rssi_count[i]:4d}, min: {stats.rssi_min[i]:3d}, max: {stats.rssi_max[i]:3d}, avg: {avg[i]:3d}, median: {stats.rssi_median[i]:3d}')
         else:
             print('  RSSI: Nothing found.')
 
-        first = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(v['first']))
-        last = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(v['last']))
+        first = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(stats.first[i]))
+        last = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(stats.last[i]))
         print(f'  First seen at {first} and last seen at {last}')
 
 if __name__ == '__main__':
@@ -0,0 +1,164 @@
+# -*- encoding: utf-8 -*-
+# multi-resolution tiles of the timeline of the mac addresses: the number of probe
+# requests and the max RSSI of each mac in the bins of a tile, at levels from a
+# minute to a week. A tile of a level is made of the tiles of the level below, so
+# the closed tiles are built once, in the tile table, and an open one only reads
+# the probe requests of the last minute tile
+
+import hashlib
+import time
+import zlib
+import numpy as np
+
+import archive
+from db import data_range
+
+MINUTE = 60
+HOUR = 60*MINUTE
+DAY = 24*HOUR
+WEEK = 7*DAY
+# tiles are aligned on the first monday of the epoch (UTC)
+ORIGIN = 4*DAY
+# name, size of a bin and span of a tile of each level, from the finest: the span of
+# a tile is a multiple of the one of the level below
+LEVELS = (('minute', MINUTE, DAY), ('10min', 10*MINUTE, WEEK), ('hour', HOUR, 4*WEEK),
+    ('day', DAY, 52*WEEK), ('week', WEEK, 520*WEEK))
+LEVEL_NAMES = [name for name, _, _ in LEVELS]
+# the probe requests of the probe log are in the db after that: the tiles that
+# ended before are closed
+DELAY = 15*60
+# number of mac of a page of a tile, ranked by number of probe requests
+PAGE_SIZE = 64
+# the cells of a tile, stored by column
+DTYPE = np.dtype([('mac', '<i4'), ('bin', '<u2'), ('count', '<u4'), ('rssi', 'i1')])
+# store the cells of a tile, with a hash of them
+TILE_UPSERT = '''insert or replace into tile (level, tile, hash, cells) values (?, ?, ?, ?)'''
+
+def encode(cells):
+    return zlib.compress(b''.join(cells[name].tobytes() for name in DTYPE.names))
+
+def decode(data):
+    data = zlib.decompress(data)
+    count = len(data)//DTYPE.itemsize
+    cells = np.zeros(count, dtype=DTYPE)
+    offset = 0
+    for name in DTYPE.names:
+        size = DTYPE[name].itemsize*count
+        cells[name] = np.frombuffer(data, dtype=DTYPE[name], count=count, offset=offset)
+        offset += size
+    return cells
+
+def tile_range(level, after, before):
+    '''returns the indexes of the tiles of a level overlapping [after, before['''
+    _, _, span = LEVELS[level]
+    return range(int((after - ORIGIN)//span), int(np.ceil((before - ORIGIN)/span)))
+
+def tile_bounds(level, tile):
+    '''returns the start and end of a tile'''
+    _, _, span = LEVELS[level]
+    return ORIGIN + tile*span, ORIGIN + (tile + 1)*span
+
+def aggregate(macs, bins, counts, rssi):
+    '''returns the cells of the (mac, bin) of arrays of counts and RSSI, with the sum of
+    their counts and the max of their RSSI (0 when unknown)'''
+    keys, inv = np.unique(macs.astype(np.int64)*(1 << 16) + bins, return_inverse=True)
+    cells = np.zeros(len(keys), dtype=DTYPE)
+    cells['mac'], cells['bin'] = np.divmod(keys, 1 << 16)
+    cells['count'] = np.bincount(inv, counts, minlength=len(keys))
+    # an unknown RSSI of 0 is lower than any other
+    rssi = np.where(rssi == 0, np.iinfo(np.int8).min, rssi)
+    high = np.full(len(keys), np.iinfo(np.int8).min, dtype=np.int64)
+    np.maximum.at(high, inv, rssi)
+    cells['rssi'] = np.where(high == np.iinfo(np.int8).min, 0, high)
+    return cells
+
+def read_cells(c, start, end):
+    '''returns the cells of the minute tile of the probe requests in [start, end['''
+    c.execute('select date, mac, rssi from probemon where date >= ? and date < ?', (start, end))
+    rows = np.array(c.fetchall(), dtype=np.float64).reshape(-1, 3)
+    dates, macs, rssi = [rows[:, 0]], [rows[:, 1]], [rows[:, 2]]
+    for d, m, _, r in archive.iter_blocks(c, start, end):
+        d = np.array(d)
+        keep = (d >= start) & (d < end)
+        dates.append(d[keep])
+        macs.append(np.array(m, dtype=np.float64)[keep])
+        rssi.append(np.array(r, dtype=np.float64)[keep])
+    dates = np.concatenate(dates)
+    bins = ((dates - start)//MINUTE).astype(np.int64)
+    return aggregate(np.concatenate(macs).astype(np.int64), bins, np.ones(len(dates), dtype=np.int64),
+        np.clip(np.concatenate(rssi), -128, 127).astype(np.int64))
+
+def load(c, level, tile, bounds=None):
+    '''returns the cells of a tile, and the hash of the stored ones (None if it is not
+    stored). A tile that is not stored is made of the tiles of the level below, within
+    the bounds of the data of the db (see data_range)'''
+    c.execute('select hash, cells from tile where level=? and tile=?', (LEVEL_NAMES[level], tile))
+    row = c.fetchone()
+    if row is not None:
+        return decode(row[1]), row[0]
+    if bounds is None:
+        bounds = data_range(c)
+    start, end = tile_bounds(level, tile)
+    if bounds[0] is None or bounds[0] >= end or bounds[1] < start:
+        return np.zeros(0, dtype=DTYPE), None
+    if level == 0:
+        return read_cells(c, start, end), None
+    # the bins of the tiles below are merged into the ones of this tile
+    _, size, _ = LEVELS[level]
+    parts = []
+    for child in tile_range(level - 1, start, end):
+        cells, _ = load(c, level - 1, child, bounds)
+        offset = tile_bounds(level - 1, child)[0] - start
+        bins = (offset + cells['bin'].astype(np.int64)*LEVELS[level - 1][1])//size
+        parts.append((cells['mac'], bins, cells['count'], cells['rssi']))
+    macs, bins, counts, rssi = (np.concatenate(p) for p in zip(*parts))
+    return aggregate(macs, bins, counts, rssi.astype(np.int64)), None
+
+def build(c, before=None, verbose=False, limit=None):
+    '''store the tiles closed before a timestamp (by default, the ones ended DELAY ago)
+    that are not yet stored, from the finest level, stopping after limit tiles.
+    Returns the number of tiles stored'''
+    if before is None:
+        before = time.time() - DELAY
+    bounds = data_range(c)
+    if bounds[0] is None:
+        return 0
+    count = 0
+    for level, name in enumerate(LEVEL_NAMES):
+        c.execute('select tile from tile where level=?', (name,))
+        stored = set(row[0] for row in c.fetchall())
+        for tile in tile_range(level, bounds[0], min(before, bounds[1] + 1)):
+            if tile in stored or tile_bounds(level, tile)[1] > before:
+                continue
+            if count == limit:
+                return count
+            cells, _ = load(c, level, tile, bounds)
+            data = encode(cells)
+            c.execute(TILE_UPSERT, (name, tile, hashlib.blake2b(data, digest_size=8).hexdigest(), data))
+            count += 1
+            if verbose:
+                print(f':: Built {name} tile {tile} ({len(cells)} cells)')
+    return count
+
+def invalidate(c, first, last):
+    '''delete the stored tiles with probe requests in [first, last], to build them
+    again with the ones added'''
+    for level, name in enumerate(LEVEL_NAMES):
+        tiles = tile_range(level, first, last + 1)
+        c.execute('delete from tile where level=? and tile >= ? and tile < ?', (name, tiles.start, tiles.stop))
+
+def hashes(c, level, tiles):
+    '''returns the hash of the stored tiles of a level in the range of tiles'''
+    c.execute('select tile, hash from tile where level=? and tile >= ? and tile < ?',
+        (LEVEL_NAMES[level], tiles.start, tiles.stop))
+    return dict(c.fetchall())
+
+def ranks(cells, ignored=()):
+    '''returns the mac ids of the cells, from the one with the most probe requests,
+    without the ignored ones'''
+    macs, inv = np.unique(cells['mac'], return_inverse=True)
+    counts = np.bincount(inv, cells['count'], minlength=len(macs))
+    keep = ~np.isin(macs, list(ignored))
+    macs, counts = macs[keep], counts[keep]
+    order = np.lexsort((macs, -counts))
+    return macs[order], counts[order].astype(np.int64)
@@ -7,10 +7,17 @@ import sys
 from pathlib import Path
 import tempfile
 import atexit
+import numpy as np
 import probe_pb2
 
 sys.path.insert(0, '..')
-from stats import is_local_bit_set, build_sql_query, median
+from stats import (load_probes, load_groups, search_ssids, unique_counts, present_macs, co_present,
+    presence_heatmap, mac_names, mac_id, latest_probes, GROUP_BY_DAY, NUMOFSECSINADAY)
+import analytics
+import presence
+import sketch
+import tiles
+from db import check_version, VersionError
 import config
 config.MERGED = tuple(m[:8] for m in config.MERGED)
 
@@ -53,6 +60,7 @@ def create_app():
         db = getattr(g, '_database', None)
         if db is None:
             db = g._database = sqlite3.connect(f'file:{DATABASE}?mode=ro', uri=True)
+            check_version(db.cursor())
         return db
 
     @app.teardown_appcontext
@@ -102,46 +110,27 @@ def create_app():
         else:
             # return day-by-day stats for macs
             try:
-                params = ','.join(['?']*len(macs))
-                sql = f'''select date,mac.address,rssi,ssid.name from probemon
-                 inner join ssid on ssid.id=probemon.ssid
-                 inner join mac on mac.id=probemon.mac
-                 where mac.address in ({params})'''
-                sql_args = macs
-                cur.execute(sql, sql_args)
+                probes = load_groups(cur, None, None, macs, None, False, GROUP_BY_DAY)
             except sqlite3.OperationalError as e:
                 return jsonify({'status': 'error', 'message': 'sqlite3 db is not accessible'}), 500
-            # WARNING: this is copy-pasted from stats.py
-            stats = {}
-            for row in cur.fetchall():
-                if row[1] not in list(stats.keys()):
-                    stats[row[1]] = {'ssids': set()}
-                stats[row[1]]['ssids'].add(row[3])
-                day = time.strftime('%Y%m%d', time.localtime(row[0]))
-                if day in stats[row[1]]:
-                    smd = stats[row[1]][day]
-                    smd['rssi'].append(row[2])
-                    if row[0] > smd['last']:
-                        smd['last'] = row[0]
-                    if row[0] < smd['first']:
-                        smd['first'] = row[0]
-                else:
-                    stats[row[1]][day] = {'rssi': [row[2]], 'first': row[0], 'last': row[0]}
+            stats, days = analytics.day_stats(probes, '%Y%m%d')
+            mac_codes, day_codes = np.divmod(stats.keys, len(days))
+            mac_codes, day_codes = mac_codes.tolist(), day_codes.tolist()
+            count, first, last = stats.rssi_count.tolist(), stats.first.tolist(), stats.last.tolist()
+            rmin, rmax, avg, med = (stats.rssi_min.tolist(), stats.rssi_max.tolist(),
+                stats.rssi_avg().tolist(), stats.rssi_median.tolist())
+            md = {}
+            for i, mac in enumerate(mac_codes):
+                md.setdefault(mac, []).append({'day': days[day_codes[i]], 'count': count[i],
+                    'last': int(last[i]*1000), 'first': int(first[i]*1000),
+                    'min': rmin[i], 'max': rmax[i], 'avg': avg[i], 'median': med[i]})
+            macs = analytics.mac_stats(probes)
 
             data = []
-            for mac in list(stats.keys()):
-                md = []
-                for d in sorted(stats[mac].keys()):
-                    if d == 'ssids':
-                        continue
-                    rssi = stats[mac][d]['rssi']
-                    md.append({'day':d, 'count':len(rssi),
-                        'last': int(stats[mac][d]['last']*1000), 'first': int(stats[mac][d]['first']*1000),
-                        'min': min(rssi), 'max': max(rssi), 'avg': sum(rssi)//len(rssi), 'median': median(rssi)})
-                ssids = list(stats[mac]['ssids'])
-                if '' in ssids:
-                    ssids.remove('')
-                data.append({'mac': mac, 'days': md, 'ssids': ssids})
+            # macs in order of first appearance
+            for i in np.argsort(macs.first, kind='stable').tolist():
+                mac = int(macs.keys[i])
+                data.append({'mac': probes.macs.names[mac], 'days': md[mac], 'ssids': macs.ssids[i]})
             return jsonify(data)
 
     @app.route('/api/stats/timestamp')
@@ -176,51 +165,238 @@ def create_app():
         sql = 'pragma temp_store = 2;'
         cur.execute(sql)
 
-        sql, sql_args = build_sql_query(after, before, macs, rssi, zero, day)
         try:
-            cur.execute(sql, sql_args)
+            probes = load_groups(cur, after, before, macs, rssi, zero)
         except sqlite3.OperationalError as e:
             return jsonify({'status': 'error', 'message': 'sqlite3 db is not accessible'}), 500
-
-        # gather stats about each mac, same code as in stats.py
-        # TODO: just import that
-        macs = {}
-        for row in cur.fetchall():
-            mac = row[1]
-            if is_local_bit_set(mac):
-                # create virtual mac for LAA mac address
-                mac = 'LAA'
-            if mac not in macs:
-                macs[mac] = {'vendor': row[2], 'ssid': [], 'rssi': [], 'last': row[0], 'first':row[0]}
-            d = macs[mac]
-            if row[3] != '' and row[3] not in d['ssid']:
-                d['ssid'].append(row[3])
-            if row[0] > d['last']:
-                d['last'] = row[0]
-            if row[0] < d['first']:
-                d['first'] = row[0]
-            if row[4] != 0:
-                d['rssi'].append(row[4])
-
-        # sort on frequency of appearence of a mac
-        tmp = [(k,len(v['rssi'])) for k,v in macs.items()]
-        tmp = [m for m,_ in reversed(sorted(tmp, key=lambda k:k[1]))]
+        # LAA mac are merged into a virtual 'LAA' mac
+        probes.merge_laa()
+        stats = analytics.mac_stats(probes)
+        keys, origin = stats.keys.tolist(), stats.origin.tolist()
+        count, first, last = stats.rssi_count.tolist(), stats.first.tolist(), stats.last.tolist()
+        rmin, rmax, rsum, med = (stats.rssi_min.tolist(), stats.rssi_max.tolist(),
+            stats.rssi_sum.tolist(), stats.rssi_median.tolist())
 
         data = []
-        # dump our stats
-        for m in tmp:
-            v = macs[m]
-            first = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(v['first']))
-            last = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(v['last']))
-            t = {'mac': m, 'vendor': v['vendor'], 'ssids': sorted(v['ssid']), 'first': first, 'last': last}
-            rssi = v['rssi']
-            if rssi != []:
-                t.update({'rssi': {'count': len(rssi), 'min': min(rssi), 'max': max(rssi),
-                 'avg': sum(rssi)/len(rssi), 'median': int(median(rssi))}})
+        # sort on frequency of appearence of a mac, and dump our stats
+        for i in reversed(np.lexsort((stats.first, stats.rssi_count)).tolist()):
+            f = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(first[i]))
+            l = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(last[i]))
+            t = {'mac': probes.macs.names[keys[i]], 'vendor': probes.macs.vendors[origin[i]],
+                'ssids': stats.ssids[i], 'first': f, 'last': l}
+            if count[i] > 0:
+                t.update({'rssi': {'count': count[i], 'min': rmin[i], 'max': rmax[i],
+                 'avg': rsum[i]/count[i], 'median': med[i]}})
             data.append(t)
 
         return jsonify(data)
 
+    def parse_interval():
+        '''returns the after and before parameters as timestamps'''
+        after = request.args.get('after')
+        if after is not None:
+            try:
+                after = time.mktime(time.strptime(after, '%Y-%m-%dT%H:%M:%S'))
+            except ValueError as v:
+                raise InvalidUsage('Invalid after parameter')
+        before = request.args.get('before')
+        if before is not None:
+            try:
+                before = time.mktime(time.strptime(before, '%Y-%m-%dT%H:%M:%S'))
+            except ValueError as v:
+                raise InvalidUsage('Invalid before parameter')
+        return after, before
+
+    @app.route('/api/stats/unique')
+    @cache.cached(timeout=60, query_string=True)
+    def unique():
+        '''returns the number of distinct macs seen in each hour or day between timestamps'''
+        level = request.args.get('level', 'day')
+        if level not in sketch.LEVELS:
+            raise InvalidUsage('Invalid level parameter')
+        after, before = parse_interval()
+        # the counts are estimated from the sketches unless exact is set
+        exact = request.args.get('exact', '0') not in ('0', 'false')
+
+        cur = get_db().cursor()
+        try:
+            starts, counts, total = unique_counts(cur, level, after, before, exact)
+        except sqlite3.OperationalError as e:
+            return jsonify({'status': 'error', 'message': 'sqlite3 db is not accessible'}), 500
+
+        fmt = '%Y-%m-%dT%H:%M:%S'
+        series = [{'start': time.strftime(fmt, time.localtime(start)), 'count': count}
+            for start, count in zip(starts, counts.tolist())]
+        data = {'level': level, 'exact': exact, 'error': 0 if exact else sketch.ERROR, 'total': total,
+            'series': series}
+        return jsonify(data)
+
+    @app.route('/api/presence')
+    @cache.cached(timeout=60, query_string=True)
+    def present():
+        '''returns the macs present between timestamps, from the presence index'''
+        after, before = parse_interval()
+        macs = request.args.getlist('macs')
+        hours = request.args.get('hours')
+        if hours is not None:
+            try:
+                hours = tuple(int(h) for h in hours.split('-'))
+                if len(hours) != 2 or not 0 <= hours[0] < hours[1] <= 24:
+                    raise ValueError
+            except ValueError as v:
+                raise InvalidUsage('Invalid hours parameter')
+
+        cur = get_db().cursor()
+        try:
+            mac_ids, count, first, last = present_macs(cur, after, before, macs, hours)
+            names = mac_names(cur, mac_ids)
+        except sqlite3.OperationalError as e:
+            return jsonify({'status': 'error', 'message': 'sqlite3 db is not accessible'}), 500
+
+        data = []
+        fmt = '%Y-%m-%dT%H:%M:%S'
+        for i in np.lexsort((first, -count)).tolist():
+            address, vendor, laa = names[mac_ids[i]]
+            data.append({'mac': address, 'vendor': vendor, 'laa': laa, 'minutes': int(count[i]),
+                'first': time.strftime(fmt, time.localtime(first[i]*presence.MINUTE)),
+                'last': time.strftime(fmt, time.localtime(last[i]*presence.MINUTE))})
+        return jsonify(data)
+
+    @app.route('/api/presence/co')
+    @cache.cached(timeout=60, query_string=True)
+    def present_with():
+        '''returns the macs present in the same minutes as a mac between timestamps'''
+        mac = request.args.get('mac')
+        if mac is None:
+            raise InvalidUsage('Missing mac parameter')
+        after, before = parse_interval()
+
+        cur = get_db().cursor()
+        try:
+            target = mac_id(cur, mac)
+            if target is None:
+                raise InvalidUsage('Unknown mac', status_code=404)
+            total, mac_ids, shared = co_present(cur, target, after, before)
+            names = mac_names(cur, mac_ids)
+        except sqlite3.OperationalError as e:
+            return jsonify({'status': 'error', 'message': 'sqlite3 db is not accessible'}), 500
+
+        macs = [{'mac': names[i][0], 'vendor': names[i][1], 'laa': names[i][2], 'minutes': n}
+            for i, n in zip(mac_ids, shared.tolist())]
+        return jsonify({'mac': mac.lower(), 'minutes': total, 'macs': macs})
+
+    @app.route('/api/presence/heatmap')
+    @cache.cached(timeout=60, query_string=True)
+    def heatmap():
+        '''returns the number of (mac, day) present in each hour of each weekday between
+        timestamps, monday first'''
+        after, before = parse_interval()
+        macs = request.args.getlist('macs')
+
+        cur = get_db().cursor()
+        try:
+            counts = presence_heatmap(cur, after, before, macs)
+        except sqlite3.OperationalError as e:
+            return jsonify({'status': 'error', 'message': 'sqlite3 db is not accessible'}), 500
+        return jsonify(counts.tolist())
+
+    @app.route('/api/ssids/search')
+    @cache.cached(timeout=60, query_string=True)
+    def ssids_search():
+        '''returns the ssids containing the words of q, with the macs that probed them'''
+        q = request.args.get('q')
+        if q is None or q.strip() == '':
+            raise InvalidUsage('Missing q parameter')
+
+        cur = get_db().cursor()
+        try:
+            ssids = search_ssids(cur, q)
+        except sqlite3.OperationalError as e:
+            return jsonify({'status': 'error', 'message': 'sqlite3 db is not accessible'}), 500
+
+        data = [{'ssid': name, 'text': text, 'macs': macs} for name, text, macs in ssids]
+        return jsonify(data)
+
+    @app.route('/api/tiles')
+    @cache.cached(timeout=3600)
+    def tile_levels():
+        '''returns the levels of the tiles of the timeline'''
+        levels = [{'level': name, 'bin': size, 'span': span} for name, size, span in tiles.LEVELS]
+        return jsonify({'origin': tiles.ORIGIN, 'page_size': tiles.PAGE_SIZE, 'levels': levels})
+
+    @app.route('/api/tiles/<level>')
+    @cache.cached(timeout=60, query_string=True)
+    def tile_list(level):
+        '''returns the tiles of a level between timestamps, with the hash of the closed ones'''
+        if level not in tiles.LEVEL_NAMES:
+            raise InvalidUsage('Invalid level', status_code=404)
+        level = tiles.LEVEL_NAMES.index(level)
+        after, before = parse_interval()
+
+        cur = get_db().cursor()
+        try:
+            if after is None:
+                after = tiles.data_range(cur)[0] or time.time()
+            if before is None:
+                before = time.time()
+            indexes = tiles.tile_range(level, after, before)
+            hashes = tiles.hashes(cur, level, indexes)
+        except sqlite3.OperationalError as e:
+            return jsonify({'status': 'error', 'message': 'sqlite3 db is not accessible'}), 500
+
+        data = []
+        for tile in indexes:
+            start, end = tiles.tile_bounds(level, tile)
+            data.append({'tile': tile, 'start': start, 'end': end, 'hash': hashes.get(tile)})
+        return jsonify(data)
+
+    @app.route('/api/tiles/<level>/<int:tile>')
+    @cache.cached(timeout=60, query_string=True)
+    def tile_page(level, tile):
+        '''returns a page of the mac of a tile, ranked by number of probe requests, with
+        their count and max RSSI in each bin. The page of a closed tile requested
+        with its hash (v parameter) never changes'''
+        if level not in tiles.LEVEL_NAMES:
+            raise InvalidUsage('Invalid level', status_code=404)
+        level = tiles.LEVEL_NAMES.index(level)
+        try:
+            page = int(request.args.get('page', 0))
+            if page < 0:
+                raise ValueError
+        except ValueError as v:
+            raise InvalidUsage('Invalid page parameter')
+
+        cur = get_db().cursor()
+        try:
+            cells, hash = tiles.load(cur, level, tile)
+            ignored = []
+            if len(config.IGNORED) > 0:
+                cur.execute('select id from mac where address in (%s)' % ','.join(['?']*len(config.IGNORED)),
+                    config.IGNORED)
+                ignored = [row[0] for row in cur.fetchall()]
+            mac_ids, counts = tiles.ranks(cells, ignored)
+            page_ids = mac_ids[page*tiles.PAGE_SIZE:(page+1)*tiles.PAGE_SIZE]
+            names = mac_names(cur, page_ids.tolist())
+        except sqlite3.OperationalError as e:
+            return jsonify({'status': 'error', 'message': 'sqlite3 db is not accessible'}), 500
+
+        # the cells are sorted by mac and bin
+        lows = np.searchsorted(cells['mac'], page_ids, side='left').tolist()
+        highs = np.searchsorted(cells['mac'], page_ids, side='right').tolist()
+        rows = []
+        for mac_id, count, low, high in zip(page_ids.tolist(), counts[page*tiles.PAGE_SIZE:].tolist(), lows, highs):
+            address, vendor, laa = names[mac_id]
+            rows.append({'mac': address, 'vendor': vendor, 'laa': laa, 'count': count,
+                'bins': cells['bin'][low:high].tolist(), 'counts': cells['count'][low:high].tolist(),
+                'rssi': cells['rssi'][low:high].tolist()})
+        start, end = tiles.tile_bounds(level, tile)
+        data = {'level': tiles.LEVEL_NAMES[level], 'tile': tile, 'start': start, 'end': end,
+            'bin': tiles.LEVELS[level][1], 'hash': hash, 'page': page, 'macs': len(mac_ids), 'rows': rows}
+        resp = make_response(jsonify(data))
+        if hash is not None and request.args.get('v') == hash:
+            resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return resp
+
     @app.route('/api/probes')
     @cache.cached(timeout=60, query_string=True)
     def probes():
@@ -244,9 +420,12 @@ def create_app():
             except ValueError as v:
                 raise InvalidUsage('Invalid rssi value')
 
-        macs = request.args.get('macs')
+        macs = request.args.getlist('macs')
         zero = request.args.get('zero')
         today = request.args.get('today')
+        if today:
+            before = time.time() # now
+            after = before - NUMOFSECSINADAY # since one day in the past
         output = request.args.get('output', default='json')
 
         cur = get_db().cursor()
@@ -254,57 +433,39 @@ def create_app():
         sql = 'pragma temp_store = 2;'
         cur.execute(sql)
 
-        sql, sql_args = build_sql_query(after, before, macs, rssi, zero, today)
         try:
-            cur.execute(sql, sql_args)
+            probes = load_probes(cur, after, before, macs, rssi, zero)
         except sqlite3.OperationalError as e:
             return jsonify({'status': 'error', 'message': 'sqlite3 db is not accessible'}), 500
+        # LAA mac are merged into a virtual 'LAA' mac, and the mac of config.MERGED
+        # into a virtual mac for each vendor
+        real = len(probes.macs)
+        probes.merge_laa()
+        probes.merge_oui(config.MERGED)
 
-        vendor = {}
-        ts = {}
-        # extract data from db
-        for t, mac, vs, ssid, rssi in cur.fetchall():
-            #t = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(t))
-            d = (t, int(rssi), ssid)
-            if is_local_bit_set(mac):
-                mac = 'LAA'
-            if mac not in ts.keys():
-                ts[mac] = [d]
-                vendor[mac] = vs
-            else:
-                ts[mac].append(d)
-
+        ts = (probes.first*1000).astype(np.int64)
         data = []
-        # recollection
-        for m in ts.keys():
-            if m == 'LAA' or m.startswith(config.MERGED):
-                continue # will deal with them later
+        virtual = {}
+        codes, rows = analytics.timelines(probes)
+        for code, idx in zip(codes.tolist(), rows):
+            m = probes.macs.names[code]
+            ssid_codes, ssid_idx = np.unique(probes.ssid[idx], return_inverse=True)
+            ssids = probes.ssids[ssid_codes].tolist()
+            probereq = [{'ts': t, 'rssi': r, 'ssid': s} for t, r, s in
+                zip(ts[idx].tolist(), probes.rssi[idx].tolist(), ssid_idx.tolist())]
+            if code >= real:
+                virtual[m] = {'mac': m, 'vendor': u'UNKNOWN', 'ssids': ssids, 'probereq': probereq}
+                continue
             known = m in config.KNOWNMAC
-            ssids = list(set(f[2] for f in ts[m]))
-            t = {'mac':m, 'known': known, 'vendor': vendor[m], 'ssids': ssids,
-                'probereq': [{'ts': int(f[0]*1000), 'rssi':f[1], 'ssid': ssids.index(f[2])} for f in ts[m]]}
-            if len(t['probereq']) > 3:
+            t = {'mac': m, 'known': known, 'vendor': probes.macs.vendors[code], 'ssids': ssids,
+                'probereq': probereq}
+            if len(probereq) > 3:
                 data.append(t)
         data.sort(key=lambda x:len(x['probereq']), reverse=True)
-        # LAA
-        if 'LAA' in ts.keys():
-            ssids = list(set(f[2] for f in ts['LAA']))
-            t = {'mac':'LAA', 'vendor': u'UNKNOWN', 'ssids': ssids,
-                'probereq': [{'ts': int(f[0]*1000), 'rssi':f[1], 'ssid': ssids.index(f[2])} for f in ts['LAA']]}
-            data.append(t)
-        # MERGED
-        for m in config.MERGED:
-            mm = [ma for ma in ts.keys() if ma.startswith(m)]
-            p = []
-            for n in mm:
-                p.extend(ts[n])
-            ssids = list(set(f[2] for f in p))
-            if len(p) == 0:
-                continue
-            p.sort(key=lambda x: x[0])
-            t = {'mac':m, 'vendor': u'UNKNOWN', 'ssids': ssids,
-                'probereq': [{'ts': int(f[0]*1000), 'rssi':f[1], 'ssid': ssids.index(f[2])} for f in p]}
-            data.append(t)
+        # LAA then MERGED
+        for m in ('LAA',) + config.MERGED:
+            if m in virtual:
+                data.append(virtual[m])
 
         if output == 'json':
             resp = make_response(jsonify(data))
@@ -346,23 +507,17 @@ def create_app():
         sql = 'pragma temp_store = 2;'
         cur.execute(sql)
 
-        sql = '''select date, mac.address, vendor.name, ssid.name, rssi from probemon
-inner join mac on probemon.mac=mac.id
-inner join ssid on probemon.ssid=ssid.id
-inner join vendor on mac.vendor=vendor.id
-order by date desc limit 100'''
-        sql_args = None
         try:
-            cur.execute(sql)
+            rows = latest_probes(cur)
         except sqlite3.OperationalError as e:
             return jsonify({'status': 'error', 'message': 'sqlite3 db is not accessible'}), 500
 
         # extract data from db
         text = ''
-        for t, mac, vs, ssid, rssi in cur.fetchall():
+        for t, mac, vs, ssid, rssi, laa in rows:
             t = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(t))
             d = (t, int(rssi), ssid)
-            if is_local_bit_set(mac):
+            if laa:
                 mac += ' (LAA)'
             text += f'{t}\t{mac}\t{int(rssi)}\t{vs}\n'
 
@@ -379,6 +534,9 @@ order by date desc limit 100'''
         response = jsonify(error.to_dict())
         response.status_code = error.status_code
         return response
+    @app.errorhandler(VersionError)
+    def handle_version_error(error):
+        return jsonify({'status': 'error', 'message': str(error)}), 500
     @app.errorhandler(404)
     def error_404(e):
         return render_template('error.html.j2', error=e), 404
@@ -0,0 +1,48 @@
+# check that merge.py copies all the probe requests of the input db, the archived
+# ones included
+
+import sqlite3
+import random
+import subprocess
+import sys
+import os.path
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+import archive
+import db
+
+START = 1791763200.0
+
+def make_db(path, count):
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    db.init_db(conn, c)
+    rng = random.Random(0)
+    vendor = db.get_vendor_id(c, 'UNKNOWN')
+    macs = [db.get_mac_id(c, ':'.join('%02x' % rng.randrange(256) for _ in range(6)), vendor) for _ in range(50)]
+    ssids = [db.get_ssid_id(c, name) for name in ['', 'home', 'office']]
+    rows = [(START + i*5.0, rng.choice(macs), rng.choice(ssids), rng.randrange(-90, -30)) for i in range(count)]
+    c.executemany('insert into probemon (date, mac, ssid, rssi) values (?, ?, ?, ?)', rows)
+    c.executemany(db.MAC_SSID_UPSERT, [(m, s, d, d, 1) for d, m, s, _ in rows])
+    conn.commit()
+    return conn, c
+
+def counts(path):
+    conn = sqlite3.connect(path)
+    live = conn.execute('select count(*) from probemon').fetchone()[0]
+    archived = conn.execute('select coalesce(sum(count), 0) from archive').fetchone()[0]
+    probes = conn.execute('select sum(count) from mac_ssid').fetchone()[0]
+    conn.close()
+    return live + archived, probes
+
+def test_merge_copies_the_archived_rows(tmp_path):
+    src, out = str(tmp_path / 'in.db'), str(tmp_path / 'out.db')
+    conn, c = make_db(src, 5000)
+    # the first half of the rows are archived
+    assert archive.archive_db(conn, c, START + 2500*5.0, 'zlib') > 0
+    conn.close()
+    subprocess.run([sys.executable, os.path.join(SRC, 'merge.py'), '-i', src, '-o', out], cwd=SRC, check=True)
+    assert counts(out) == (5000, 5000)
+    assert counts(src) == counts(out)
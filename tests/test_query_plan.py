@@ -0,0 +1,114 @@
+# check with explain query plan that the queries of the scripts read the indexes
+# they were written for: a query falling back to a scan of the probemon table, or to
+# a temp b-tree over its rows, is much slower on a big db
+
+import sqlite3
+import random
+import sys
+import os.path
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import db
+import stats
+import tiles
+
+START = 1791763200.0
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    c = conn.cursor()
+    db.init_db(conn, c)
+    rng = random.Random(0)
+    vendor = db.get_vendor_id(c, 'UNKNOWN')
+    macs = [db.get_mac_id(c, ':'.join('%02x' % rng.randrange(256) for _ in range(6)), vendor) for _ in range(200)]
+    ssids = [db.get_ssid_id(c, name) for name in ['', 'home', 'office', 'cafe']]
+    rows = [(START + i*7.5, rng.choice(macs), rng.choice(ssids), rng.randrange(-90, -30)) for i in range(20000)]
+    c.executemany('insert into probemon (date, mac, ssid, rssi) values (?, ?, ?, ?)', rows)
+    c.executemany(db.MAC_SSID_UPSERT, [(m, s, d, d, 1) for d, m, s, _ in rows])
+    c.execute('analyze;')
+    conn.commit()
+    yield conn
+    conn.close()
+
+def traced(conn, fn, *args):
+    '''returns the select statements run by fn, with their parameters'''
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        fn(*args)
+    finally:
+        conn.set_trace_callback(None)
+    return [sql for sql in statements if sql.lstrip().lower().startswith('select')]
+
+def plan(conn, sql):
+    '''returns the steps of the plan of a query, as one string'''
+    return '\n'.join(row[3] for row in conn.execute(f'explain query plan {sql}'))
+
+def probemon_plans(conn, fn, *args):
+    plans = [plan(conn, sql) for sql in traced(conn, fn, *args) if 'from probemon' in sql]
+    assert len(plans) > 0
+    return plans
+
+def test_time_range_reads_the_date_index(conn):
+    for p in probemon_plans(conn, stats.load_probes, conn.cursor(), START + 3600, START + 7200, None, None, False):
+        assert 'idx_probemon_date_cover' in p
+        assert 'TEMP B-TREE' not in p
+
+def test_group_by_reads_the_mac_index_in_order(conn):
+    for p in probemon_plans(conn, stats.load_groups, conn.cursor(), None, None, None, None, False):
+        assert 'idx_probemon_mac_cover' in p
+        assert 'TEMP B-TREE' not in p
+
+def test_mac_filter_reads_the_mac_value_index(conn):
+    c = conn.cursor()
+    address = c.execute('select address from mac limit 1').fetchone()[0]
+    for prefix in (address, address[:5], address[:4].replace(':', '')):
+        plans = [plan(conn, sql) for sql in traced(conn, stats.find_macs, c, [prefix])]
+        assert len(plans) == 1
+        assert 'idx_mac_value' in plans[0]
+
+def test_first_and_last_dates_read_the_date_index(conn):
+    for p in probemon_plans(conn, db.data_range, conn.cursor()):
+        assert 'idx_probemon_date_cover' in p
+        assert 'SCAN' not in p
+
+def test_look_ups_read_the_name_indexes(conn):
+    c = conn.cursor()
+    address, vendor = c.execute('select address, vendor from mac limit 1').fetchone()
+    plans = [plan(conn, sql) for sql in traced(conn, db.get_mac_id, c, address, vendor)]
+    assert len(plans) == 1 and 'idx_mac_address' in plans[0]
+    plans = [plan(conn, sql) for sql in traced(conn, db.get_ssid_id, c, 'home')]
+    assert len(plans) == 1 and 'idx_ssid_name' in plans[0]
+    ssid = c.execute("select id from ssid where name='home'").fetchone()[0]
+    plans = [plan(conn, sql) for sql in traced(conn, stats.macs_of_ssid, c, ssid)]
+    assert any('idx_mac_ssid_ssid' in p for p in plans)
+
+def test_ssid_search_reads_the_trigram_index(conn):
+    c = conn.cursor()
+    if not db.has_ssid_fts(c):
+        pytest.skip('sqlite has no trigram tokenizer')
+    plans = [plan(conn, sql) for sql in traced(conn, stats.search_ssids, c, 'office') if 'group_concat' in sql]
+    assert len(plans) == 1
+    # the ssids matching the words drive the joins
+    assert plans[0].startswith('SCAN ssid_fts VIRTUAL TABLE')
+
+def test_latest_probes_read_the_date_index_backwards(conn):
+    for p in probemon_plans(conn, stats.latest_probes, conn.cursor()):
+        assert 'idx_probemon_date_cover' in p
+        assert 'TEMP B-TREE' not in p
+
+def test_mac_of_an_address_reads_the_address_index(conn):
+    c = conn.cursor()
+    address = c.execute('select address from mac limit 1').fetchone()[0]
+    plans = [plan(conn, sql) for sql in traced(conn, stats.mac_id, c, address)]
+    assert len(plans) == 1 and 'idx_mac_address' in plans[0]
+
+def test_tile_hashes_read_the_tile_key(conn):
+    c = conn.cursor()
+    plans = [plan(conn, sql) for sql in traced(conn, tiles.hashes, c, 0, range(10, 20))]
+    assert len(plans) == 1
+    assert 'SEARCH tile' in plans[0] and 'SCAN' not in plans[0]